@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from app.models.document import Document, DocumentQuery, SearchResponse, SearchResult
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from dropbox.exceptions import ApiError, AuthError
+from fastapi.responses import StreamingResponse
+from app.models.document import Document, DocumentChanges, DocumentQuery, SearchResponse, SearchResult
 from app.services.dropbox_service import DropboxService
 from app.services.qdrant_service import QdrantService
-from app.services.llm_service import LLMService
+from app.services.llm_service import LLM_PRIORITY_BACKGROUND, LLM_PRIORITY_SEARCH, LLM_PRIORITY_STREAM, LLMService
+from app.services.circuit_breaker import CircuitOpenError
+from app.services.concurrency import ClientDisconnected, LLMBusyError
+from app.services.container import get_dropbox_service, get_qdrant_service, get_llm_service
 from app.api.auth import get_current_user
 from app.models.auth import User
-from typing import List
+from typing import List, Optional
+import asyncio
+import json
 import logging
 from urllib.parse import unquote
 
@@ -14,18 +21,47 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-dropbox_service = DropboxService()
-qdrant_service = QdrantService()
-llm_service = LLMService()
 
 @router.get("/list", response_model=List[Document])
-async def list_documents(path: str = "", current_user: User = Depends(get_current_user)):
-    """List all documents in the given path"""
-    documents = dropbox_service.list_files(path)
+async def list_documents(
+    path: str = "",
+    recursive: bool = False,
+    current_user: User = Depends(get_current_user),
+    dropbox_service: DropboxService = Depends(get_dropbox_service)
+):
+    """List all documents in the given path, with recursive=true the whole tree below it"""
+    documents = dropbox_service.list_files(path, recursive=recursive)
     return [Document(**doc) for doc in documents]
 
+@router.get("/changes", response_model=DocumentChanges)
+async def list_changes(
+    cursor: Optional[str] = None,
+    path: str = "",
+    current_user: User = Depends(get_current_user),
+    dropbox_service: DropboxService = Depends(get_dropbox_service)
+):
+    """List files changed and paths deleted since the cursor; without a cursor, all files below the path"""
+    try:
+        changes = dropbox_service.list_changes(cursor, path)
+    except AuthError as e:
+        logger.error(f"Dropbox authentication error listing changes: {e}")
+        raise HTTPException(status_code=502, detail="Dropbox authentication failed")
+    except ApiError as e:
+        logger.error(f"Dropbox API error listing changes: {e}")
+        raise HTTPException(status_code=502, detail=f"Dropbox API error: {str(e)}")
+    return DocumentChanges(
+        cursor=changes["cursor"],
+        reset=changes["reset"],
+        files=[Document(**doc) for doc in changes["files"]],
+        deleted=changes["deleted"]
+    )
+
 @router.get("/get/{path:path}", response_model=Document)
-async def get_document(path: str, current_user: User = Depends(get_current_user)):
+async def get_document(
+    path: str,
+    current_user: User = Depends(get_current_user),
+    dropbox_service: DropboxService = Depends(get_dropbox_service)
+):
     """Get document content by path"""
     # Decode the path if it's URL-encoded
     path = unquote(path)
@@ -57,15 +93,37 @@ async def get_document(path: str, current_user: User = Depends(get_current_user)
     return document
 
 @router.post("/index/{path:path}")
-async def index_document(path: str, current_user: User = Depends(get_current_user)):
-    """Index a document in the vector database"""
+async def index_document(
+    path: str,
+    content_hash: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    dropbox_service: DropboxService = Depends(get_dropbox_service),
+    qdrant_service: QdrantService = Depends(get_qdrant_service)
+):
+    """Index a document in the vector database
+    
+    With content_hash (the Dropbox content hash the caller knows), a document
+    that was already indexed from that revision is skipped without downloading it.
+    """
     try:
-        # Decode the path if it's URL-encoded
-        path = unquote(path)
+        # Decode the path if it's URL-encoded; document IDs have no leading slash
+        path = unquote(path).lstrip("/")
         logger.info(f"Indexing document: {path}")
         
+        if content_hash:
+            indexed = qdrant_service.get_indexed_document(path)
+            if indexed and indexed.get("dropbox_content_hash") == content_hash:
+                logger.info(f"Document unchanged since it was indexed, skipping: {path}")
+                return {
+                    "message": "Document unchanged",
+                    "document_id": path,
+                    "skipped": True,
+                    "dropbox_content_hash": content_hash,
+                    "dropbox_rev": indexed.get("dropbox_rev")
+                }
+        
         # Get document content
-        content = dropbox_service.download_file(f"/{path}")
+        content, metadata = dropbox_service.download_file_with_metadata(f"/{path}")
         if not content:
             logger.error(f"Document not found or empty: {path}")
             raise HTTPException(status_code=404, detail="Document not found or could not be downloaded")
@@ -85,7 +143,9 @@ async def index_document(path: str, current_user: User = Depends(get_current_use
                 document_id=path,
                 document_path=f"/{path}",
                 document_name=doc_name,
-                document_content=content
+                document_content=content,
+                dropbox_content_hash=metadata.get("content_hash"),
+                dropbox_rev=metadata.get("rev")
             )
             
             if not success:
@@ -93,7 +153,13 @@ async def index_document(path: str, current_user: User = Depends(get_current_use
                 raise HTTPException(status_code=500, detail="Failed to index document")
             
             logger.info(f"Document indexed successfully: {path}")
-            return {"message": "Document indexed successfully", "document_id": path}
+            return {
+                "message": "Document indexed successfully",
+                "document_id": path,
+                "skipped": False,
+                "dropbox_content_hash": metadata.get("content_hash"),
+                "dropbox_rev": metadata.get("rev")
+            }
         except Exception as e:
             logger.exception(f"Error during document indexing: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error during document indexing: {str(e)}")
@@ -105,100 +171,286 @@ async def index_document(path: str, current_user: User = Depends(get_current_use
         logger.exception(f"Unexpected error during indexing: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+@router.delete("/index/{path:path}")
+async def delete_document_index(
+    path: str,
+    current_user: User = Depends(get_current_user),
+    qdrant_service: QdrantService = Depends(get_qdrant_service)
+):
+    """Remove a document from the vector database"""
+    path = unquote(path).lstrip("/")
+    logger.info(f"Removing document from index: {path}")
+    try:
+        removed = qdrant_service.delete_document(path)
+    except Exception as e:
+        logger.exception(f"Error removing document {path}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error removing document: {str(e)}")
+    return {"message": "Document removed from index", "document_id": path, "chunks_removed": removed}
+
 @router.get("/check-indexes")
-async def check_indexes(current_user: User = Depends(get_current_user)):
-    """Check what documents are indexed in Qdrant"""
+async def check_indexes(
+    current_user: User = Depends(get_current_user),
+    qdrant_service: QdrantService = Depends(get_qdrant_service)
+):
+    """Check what documents are indexed in Qdrant, with the Dropbox revision each was indexed from"""
     try:
         logger.info("Checking indexed documents")
-        indexes = qdrant_service.list_indexed_documents()
-        logger.info(f"Found {len(indexes)} indexed documents")
-        return {"indexes": indexes}
+        registry = qdrant_service.get_document_registry()
+        logger.info(f"Found {len(registry)} indexed documents")
+        return {
+            "indexes": sorted(registry),
+            "documents": {
+                doc_id: {
+                    "dropbox_content_hash": entry.get("dropbox_content_hash"),
+                    "dropbox_rev": entry.get("dropbox_rev"),
+                    "indexed_at": entry.get("indexed_at")
+                }
+                for doc_id, entry in registry.items()
+            }
+        }
     except Exception as e:
         logger.exception(f"Error checking indexes: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking indexes: {str(e)}")
 
+@router.get("/collection-info")
+async def collection_info(
+    current_user: User = Depends(get_current_user),
+    qdrant_service: QdrantService = Depends(get_qdrant_service)
+):
+    """Show the Qdrant collection configuration including payload indexes"""
+    try:
+        return qdrant_service.get_collection_diagnostics()
+    except Exception as e:
+        logger.exception(f"Error getting collection info: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting collection info: {str(e)}")
+
+NO_DOCUMENTS_ANSWER = "Es wurden keine Dokumente gefunden. Bitte indiziere zuerst einige Dokumente über die Dokumentenseite."
+
+def _no_results_answer(query_text):
+    """Answer used when the search did not return any chunks"""
+    return f"Es wurden keine relevanten Dokumente zu deiner Anfrage '{query_text}' gefunden. Bitte versuche eine andere Formulierung oder stelle sicher, dass relevante Dokumente indiziert wurden."
+
+def _build_context(llm_service, search_results):
+    """Assemble the retrieved chunks into the LLM context within the token budget"""
+    built = llm_service.context_builder.build(search_results)
+    logger.info(f"Context length: {len(built['context'])} characters, {built['tokens_used']} tokens")
+    
+    # Log the context for debugging
+    logger.info(f"Context for LLM: {built['context'][:500]}...")
+    return built
+
+def _fallback_answer(query_text, search_results, intro=None):
+    """Answer listing the raw search results, used when the LLM is not available"""
+    answer = intro or f"Bei der Verarbeitung Ihrer Anfrage '{query_text}' ist ein Fehler aufgetreten.\n\n"
+    answer += "Hier sind die gefundenen relevanten Informationen ohne KI-Analyse:\n\n"
+    # Füge die rohen Suchergebnisse hinzu
+    if search_results:
+        for i, result in enumerate(search_results[:5], 1):
+            doc_name = result.payload.get("document_name", "Unbekanntes Dokument")
+            text = result.payload.get("text", "").strip()
+            answer += f"**Dokument {i}: {doc_name}**\n\n{text}\n\n"
+    else:
+        answer += "Es wurden keine relevanten Dokumente gefunden."
+    return answer
+
+LLM_BUSY_INTRO = "Das Sprachmodell ist gerade ausgelastet, deshalb gibt es diesmal keine KI-Antwort.\n\n"
+LLM_UNAVAILABLE_INTRO = "Das Sprachmodell ist derzeit nicht erreichbar, deshalb gibt es diesmal keine KI-Antwort.\n\n"
+
+def _to_search_results(search_results) -> List[SearchResult]:
+    """Convert Qdrant hits into SearchResult models"""
+    results = []
+    for result in search_results:
+        document = Document(
+            id=result.payload["document_id"],
+            name=result.payload["document_name"],
+            path=result.payload["document_path"],
+            type="file",
+            content=result.payload["text"]
+        )
+        results.append(SearchResult(document=document, score=result.score))
+    return results
+
+MODEL_LOADING_DETAIL = "Das Suchmodell wird noch geladen. Bitte versuchen Sie es in Kürze erneut."
+
+def _ensure_model_loaded(qdrant_service):
+    """Answer 503 while the embedding model is still being loaded by the warm-up"""
+    if not qdrant_service.model_loaded:
+        raise HTTPException(status_code=503, detail=MODEL_LOADING_DETAIL, headers={"Retry-After": "5"})
+
+def _retrieve(qdrant_service, query):
+    """Embed the query and search, return (query_embedding, search_results)
+    
+    search_results is None if no documents are indexed. Embedding, the BM25 search
+    and the Qdrant calls block, so the handlers run this in a worker thread.
+    """
+    if not qdrant_service.has_indexed_documents():
+        logger.warning("No documents are indexed in Qdrant")
+        return None, None
+    
+    logger.info(f"Searching for query: {query.query}")
+    query_embedding = qdrant_service.embed_query(query.query)
+    search_results = qdrant_service.search(
+        query.query,
+        query.top_k,
+        query_vector=query_embedding,
+        rerank=query.rerank,
+        rerank_budget_ms=query.rerank_budget_ms,
+        mode=query.mode,
+        lexical_weight=query.lexical_weight,
+        path_prefix=query.path_prefix,
+        document_ids=query.document_ids,
+        file_types=query.file_types
+    )
+    logger.info(f"Found {len(search_results)} search results")
+    return query_embedding, search_results
+
+def _answer_cache_args(query_embedding, search_results):
+    """Keyword arguments that let the LLM service use its semantic answer cache"""
+    return {
+        "query_embedding": query_embedding,
+        "chunk_ids": [result.id for result in search_results],
+        "document_ids": {result.payload["document_id"] for result in search_results}
+    }
+
 @router.post("/search", response_model=SearchResponse)
-async def search_documents(query: DocumentQuery, current_user: User = Depends(get_current_user)):
+async def search_documents(
+    query: DocumentQuery,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    qdrant_service: QdrantService = Depends(get_qdrant_service),
+    llm_service: LLMService = Depends(get_llm_service)
+):
     """Search documents with semantic search"""
     logger.info(f"Searching documents for query: {query.query}")
+    _ensure_model_loaded(qdrant_service)
     
     try:
-        # First check if any documents are indexed
-        logger.info("Checking if documents are indexed")
-        indexed_docs = qdrant_service.list_indexed_documents()
-        if not indexed_docs:
-            logger.warning("No documents are indexed in Qdrant")
-            return SearchResponse(
-                results=[],
-                answer="Es wurden keine Dokumente gefunden. Bitte indiziere zuerst einige Dokumente über die Dokumentenseite."
-            )
-        
-        logger.info(f"Found {len(indexed_docs)} indexed documents: {indexed_docs}")
-        
-        # Search for relevant document chunks
-        logger.info(f"Searching for query: {query.query}")
-        search_results = qdrant_service.search(query.query, query.top_k)
-        logger.info(f"Found {len(search_results)} search results")
+        # Search for relevant document chunks without blocking the event loop
+        query_embedding, search_results = await asyncio.to_thread(_retrieve, qdrant_service, query)
+        if search_results is None:
+            return SearchResponse(results=[], answer=NO_DOCUMENTS_ANSWER)
         
         if not search_results:
             logger.warning("No search results found")
-            return SearchResponse(
-                results=[],
-                answer=f"Es wurden keine relevanten Dokumente zu deiner Anfrage '{query.query}' gefunden. Bitte versuche eine andere Formulierung oder stelle sicher, dass relevante Dokumente indiziert wurden."
-            )
+            return SearchResponse(results=[], answer=_no_results_answer(query.query))
         
         # Extract relevant context
-        context = "\n\n".join([f"[Dokument: {result.payload['document_name']}]\n{result.payload['text']}" for result in search_results])
-        logger.info(f"Context length: {len(context)} characters")
+        built_context = _build_context(llm_service, search_results)
         
-        # Log the context for debugging
-        logger.info(f"Context for LLM: {context[:500]}...")
-        
-        # Try to generate answer with LLM (always attempt even with zero results)
+        # Try to generate answer with LLM
         try:
             logger.info("Calling LLM to generate answer")
-            answer = await llm_service.generate_answer(query.query, context if search_results else "")
+            answer = await llm_service.generate_answer(
+                query.query,
+                built_context["context"],
+                is_disconnected=request.is_disconnected,
+                priority=LLM_PRIORITY_SEARCH,
+                **_answer_cache_args(query_embedding, search_results)
+            )
             logger.info(f"LLM answer: {answer[:100]}...")
+        except ClientDisconnected as e:
+            # Nobody reads this response any more
+            logger.info(f"Client disconnected before the answer was ready: {e}")
+            answer = ""
+        except LLMBusyError as e:
+            logger.warning(f"LLM busy, returning retrieval-only results: {e}")
+            answer = _fallback_answer(query.query, search_results, intro=LLM_BUSY_INTRO)
+        except CircuitOpenError as e:
+            logger.warning(f"LLM circuit open, returning retrieval-only results: {e}")
+            answer = _fallback_answer(query.query, search_results, intro=LLM_UNAVAILABLE_INTRO)
         except Exception as e:
             logger.exception(f"Error generating LLM answer: {str(e)}")
-            # Detailliertere Fehlermeldung erstellen
-            answer = f"Bei der Verarbeitung Ihrer Anfrage '{query.query}' ist ein Fehler aufgetreten.\n\n"
-            answer += "Hier sind die gefundenen relevanten Informationen ohne KI-Analyse:\n\n"
-            # Füge die rohen Suchergebnisse hinzu
-            if search_results:
-                for i, result in enumerate(search_results[:5], 1):
-                    doc_name = result.payload.get("document_name", "Unbekanntes Dokument")
-                    text = result.payload.get("text", "").strip()
-                    answer += f"**Dokument {i}: {doc_name}**\n\n{text}\n\n"
-            else:
-                answer += "Es wurden keine relevanten Dokumente gefunden."
-        
-        # Prepare response with all search results
-        results = []
-        for result in search_results:
-            document = Document(
-                id=result.payload["document_id"],
-                name=result.payload["document_name"],
-                path=result.payload["document_path"],
-                type="file",
-                content=result.payload["text"]
-            )
-            results.append(SearchResult(document=document, score=result.score))
+            answer = _fallback_answer(query.query, search_results)
         
-        return SearchResponse(results=results, answer=answer)
+        return SearchResponse(
+            results=_to_search_results(search_results),
+            answer=answer,
+            context_tokens=built_context["tokens_used"]
+        )
     except Exception as e:
         logger.exception(f"Error in search: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Fehler bei der Suche: {str(e)}")
 
+def _ndjson(event):
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+@router.post("/search/stream")
+async def search_documents_stream(
+    query: DocumentQuery,
+    current_user: User = Depends(get_current_user),
+    qdrant_service: QdrantService = Depends(get_qdrant_service),
+    llm_service: LLMService = Depends(get_llm_service)
+):
+    """Search documents and stream the answer as NDJSON events
+    
+    The first event carries the retrieved results, followed by "token" events
+    while the LLM generates, one "answer" event with the final answer and "done".
+    """
+    logger.info(f"Streaming search for query: {query.query}")
+    _ensure_model_loaded(qdrant_service)
+    
+    try:
+        query_embedding, search_results = await asyncio.to_thread(_retrieve, qdrant_service, query)
+    except Exception as e:
+        logger.exception(f"Error in search: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Fehler bei der Suche: {str(e)}")
+    
+    async def events():
+        if search_results is None:
+            yield _ndjson({"type": "results", "results": []})
+            yield _ndjson({"type": "answer", "answer": NO_DOCUMENTS_ANSWER})
+        elif not search_results:
+            yield _ndjson({"type": "results", "results": []})
+            yield _ndjson({"type": "answer", "answer": _no_results_answer(query.query)})
+        else:
+            results = _to_search_results(search_results)
+            built_context = _build_context(llm_service, search_results)
+            yield _ndjson({
+                "type": "results",
+                "results": [result.dict() for result in results],
+                "context_tokens": built_context["tokens_used"]
+            })
+            
+            try:
+                async for event in llm_service.stream_answer(
+                    query.query,
+                    built_context["context"],
+                    priority=LLM_PRIORITY_STREAM,
+                    **_answer_cache_args(query_embedding, search_results)
+                ):
+                    yield _ndjson(event)
+            except LLMBusyError as e:
+                logger.warning(f"LLM busy, returning retrieval-only results: {e}")
+                yield _ndjson({"type": "answer", "answer": _fallback_answer(query.query, search_results, intro=LLM_BUSY_INTRO)})
+            except CircuitOpenError as e:
+                logger.warning(f"LLM circuit open, returning retrieval-only results: {e}")
+                yield _ndjson({"type": "answer", "answer": _fallback_answer(query.query, search_results, intro=LLM_UNAVAILABLE_INTRO)})
+            except Exception as e:
+                logger.exception(f"Error streaming LLM answer: {str(e)}")
+                yield _ndjson({"type": "answer", "answer": _fallback_answer(query.query, search_results)})
+        
+        yield _ndjson({"type": "done"})
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @router.get("/debug-llm")
-async def debug_llm(current_user: User = Depends(get_current_user), prompt: str = Query("Dies ist ein Testprompt. Bitte antworte mit 'Hallo Welt'.")):
+async def debug_llm(
+    current_user: User = Depends(get_current_user),
+    prompt: str = Query("Dies ist ein Testprompt. Bitte antworte mit 'Hallo Welt'."),
+    llm_service: LLMService = Depends(get_llm_service)
+):
     """Debug endpoint for LLM API"""
     logger.info("Debug LLM API call")
-    result = await llm_service.debug_api_call(prompt)
+    result = await llm_service.debug_api_call(prompt, priority=LLM_PRIORITY_BACKGROUND)
     return result
 
 @router.get("/system-check")
-async def system_check(current_user: User = Depends(get_current_user)):
+async def system_check(
+    current_user: User = Depends(get_current_user),
+    dropbox_service: DropboxService = Depends(get_dropbox_service),
+    qdrant_service: QdrantService = Depends(get_qdrant_service),
+    llm_service: LLMService = Depends(get_llm_service)
+):
     """Führt einen vollständigen Systemcheck durch"""
     results = {}
     
@@ -212,17 +464,33 @@ async def system_check(current_user: User = Depends(get_current_user)):
     # Teste Qdrant-Verbindung
     try:
         indexed_docs = qdrant_service.list_indexed_documents()
-        results["qdrant"] = {"status": "ok", "indexed_documents": len(indexed_docs), "doc_ids": indexed_docs[:5] if indexed_docs else []}
+        diagnostics = qdrant_service.get_collection_diagnostics()
+        results["qdrant"] = {
+            "status": "ok",
+            "indexed_documents": len(indexed_docs),
+            "doc_ids": indexed_docs[:5] if indexed_docs else [],
+            "payload_indexes": diagnostics["payload_indexes"],
+            "missing_payload_indexes": diagnostics["missing_payload_indexes"],
+            "query_embedding_cache": qdrant_service.query_embedding_cache.stats(),
+            "reranker": qdrant_service.reranker.stats(),
+            "lexical_index": qdrant_service.lexical_index.stats()
+        }
     except Exception as e:
         results["qdrant"] = {"status": "error", "message": str(e)}
     
     # Teste LLM mit einfacher Anfrage
     try:
-        llm_result = await llm_service.debug_api_call("Was ist 2+2?")
+        llm_result = await llm_service.debug_api_call("Was ist 2+2?", priority=LLM_PRIORITY_BACKGROUND)
         raw_response = llm_result.get("cleaned_text", "Keine Antwort")
         results["llm"] = {
             "status": "ok", 
             "response": raw_response,
+            "answer_cache": llm_service.answer_cache.stats(),
+            "coalescing": llm_service.single_flight.stats(),
+            "queue": llm_service.limiter.stats(),
+            "circuit_breaker": llm_service.circuit_breaker.stats(),
+            "context_token_budget": llm_service.context_builder.token_budget,
+            "tokenizer": llm_service.context_builder.counter.name,
             "api_url": llm_result.get("api_url", ""),
             "status_code": llm_result.get("status_code", 0)
         }
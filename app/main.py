@@ -14,6 +14,7 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from dropbox.exceptions import AuthError
 from typing import Optional
+from contextlib import asynccontextmanager
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -28,14 +29,22 @@ from app.services.auth import create_access_token, get_admin_user, ACCESS_TOKEN_
 from app.services.dropbox_service import DropboxService
 from app.services.llm_service import LLMService
 from app.services.qdrant_service import QdrantService
+from app.services.container import services, get_dropbox_service, get_llm_service, get_qdrant_service
 from app.models.auth import User
 
 # Security settings
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the shared services once per process and release them on shutdown"""
+    await services.startup()
+    yield
+    await services.shutdown()
+
 # Create FastAPI app
-app = FastAPI(title="Immobilien-Dokument-RAG")
+app = FastAPI(title="Immobilien-Dokument-RAG", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -56,11 +65,6 @@ templates = Jinja2Templates(directory="app/templates")
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(documents.router, prefix="/api/documents", tags=["documents"])
 
-# Create services
-dropbox_service = DropboxService()
-llm_service = LLMService()
-qdrant_service = QdrantService()
-
 # Helper functions
 def get_path_parts(path):
     """Split a path into parts for breadcrumb navigation"""
@@ -163,7 +167,7 @@ async def logout():
     return HTMLResponse(content=token_script)
 
 @app.get("/dropbox-status")
-async def dropbox_status():
+async def dropbox_status(dropbox_service: DropboxService = Depends(get_dropbox_service)):
     """Check Dropbox connection status"""
     try:
         status = dropbox_service.get_token_info()
@@ -176,7 +180,7 @@ async def dropbox_status():
         )
 
 @app.get("/debug-dropbox")
-async def debug_dropbox():
+async def debug_dropbox(dropbox_service: DropboxService = Depends(get_dropbox_service)):
     """Debug endpoint for Dropbox connection"""
     try:
         # Get token info
@@ -202,7 +206,7 @@ async def debug_dropbox():
         )
 
 @app.get("/debug-llm")
-async def debug_llm():
+async def debug_llm(llm_service: LLMService = Depends(get_llm_service)):
     """Debug endpoint for LLM API"""
     try:
         result = await llm_service.debug_api_call()
@@ -231,23 +235,25 @@ async def debug_llm():
         )
 
 @app.get("/indexed-documents", response_class=HTMLResponse)
-async def indexed_documents_page(request: Request):
+async def indexed_documents_page(request: Request, qdrant_service: QdrantService = Depends(get_qdrant_service)):
     """UI page to view indexed documents"""
     logger.info("Indexed documents page requested")
     
     try:
         # Get indexed documents
-        indexed_docs = qdrant_service.list_indexed_documents()
+        indexed_docs = qdrant_service.get_document_registry()
         logger.info(f"Found {len(indexed_docs)} indexed documents")
         
         # Format documents for display
         formatted_docs = []
-        for doc_id in indexed_docs:
+        for doc_id in sorted(indexed_docs):
             doc_name = doc_id.split("/")[-1] if "/" in doc_id else doc_id
             formatted_docs.append({
                 "id": doc_id,
                 "name": doc_name,
-                "path": doc_id
+                "path": doc_id,
+                "chunk_count": indexed_docs[doc_id]["chunk_count"],
+                "indexed_at": indexed_docs[doc_id]["indexed_at"]
             })
         
         return templates.TemplateResponse("indexed_documents.html", {
@@ -264,7 +270,11 @@ async def indexed_documents_page(request: Request):
         })
 
 @app.get("/documents", response_class=HTMLResponse)
-async def documents_page(request: Request, path: str = ""):
+async def documents_page(
+    request: Request,
+    path: str = "",
+    dropbox_service: DropboxService = Depends(get_dropbox_service)
+):
     logger.info(f"Documents page requested for path: '{path}'")
     
     try:
@@ -313,7 +323,11 @@ async def documents_page(request: Request, path: str = ""):
         })
 
 @app.get("/view-document", response_class=HTMLResponse)
-async def view_document(request: Request, path: str):
+async def view_document(
+    request: Request,
+    path: str,
+    dropbox_service: DropboxService = Depends(get_dropbox_service)
+):
     logger.info(f"View document requested for path: {path}")
     try:
         # Decode the path if it's URL-encoded
@@ -347,6 +361,12 @@ async def search_page(request: Request):
     logger.info("Search page requested")
     return templates.TemplateResponse("search.html", {"request": request})
 
+@app.get("/ready")
+async def ready():
+    """Readiness check reporting the warm-up state of each service"""
+    readiness = services.readiness()
+    return JSONResponse(content=readiness, status_code=200 if readiness["ready"] else 503)
+
 # Check token validity
 @app.get("/check-auth")
 async def check_auth(request: Request):
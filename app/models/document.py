@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 
 class Document(BaseModel):
     id: str
@@ -7,10 +7,33 @@ class Document(BaseModel):
     path: str
     type: str
     content: Optional[str] = None
+    # Dropbox file metadata, set by list_files for files
+    size: Optional[int] = None
+    server_modified: Optional[str] = None
+    rev: Optional[str] = None
+    content_hash: Optional[str] = None
+    
+class DocumentChanges(BaseModel):
+    cursor: str
+    # True if files is a full listing rather than a delta
+    reset: bool = False
+    files: List[Document] = []
+    # Paths of deleted files and folders
+    deleted: List[str] = []
     
 class DocumentQuery(BaseModel):
     query: str
     top_k: int = 5
+    # None uses the server default (RERANK_DEFAULT / RERANK_BUDGET_MS)
+    rerank: Optional[bool] = None
+    rerank_budget_ms: Optional[float] = None
+    # None uses the server default (SEARCH_MODE / weight depending on the query)
+    mode: Optional[Literal["dense", "hybrid", "lexical"]] = None
+    lexical_weight: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    # Restrict the search to a Dropbox folder, to documents or to file types (e.g. "pdf")
+    path_prefix: Optional[str] = None
+    document_ids: Optional[List[str]] = None
+    file_types: Optional[List[str]] = None
     
 class SearchResult(BaseModel):
     document: Document
@@ -19,3 +42,4 @@ class SearchResult(BaseModel):
 class SearchResponse(BaseModel):
     results: List[SearchResult]
     answer: str
+    context_tokens: Optional[int] = None
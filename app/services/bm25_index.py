@@ -0,0 +1,326 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", "data/bm25_index.json")
+# Changes are written to disk at most this often, and on flush()
+BM25_SAVE_INTERVAL = float(os.getenv("BM25_SAVE_INTERVAL", "10"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Query terms below this IDF (in roughly 90% of all chunks, like "der" or "und") are
+# skipped: they barely change the ranking but have the longest postings lists
+BM25_MIN_IDF = float(os.getenv("BM25_MIN_IDF", "0.1"))
+
+INDEX_VERSION = 2
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase terms; casefold maps "ß" to "ss" so both spellings match"""
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class BM25Index:
+    """On-disk inverted index over chunk texts with BM25 scoring
+
+    Chunks are stored under their Qdrant point ID and grouped by document so
+    that re-indexing or deleting a document replaces all of its chunks. The
+    index is kept in memory and written to a JSON file (atomically, at most
+    every BM25_SAVE_INTERVAL seconds and on flush()).
+
+    Several processes may share the file (the server and scripts/dropbox_sync.py
+    in local mode). Saves hold an exclusive lock on "<path>.lock" (where fcntl
+    is available) and merge per document: documents changed in this process
+    since the last save are written as they are, all others are taken from the
+    file. reload_if_changed() picks up changes of other processes the same way
+    and reports the affected document IDs to the change listeners. Until then,
+    a process keeps searching its in-memory copy.
+    """
+
+    def __init__(self, path: str = BM25_INDEX_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        # point_id -> {"document_id": ..., "length": ..., "terms": {term: tf}}
+        self._chunks: Dict[str, Dict[str, Any]] = {}
+        # term -> {point_id: tf}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        # document_id -> {"content_hash": ..., "metadata": {...}, "point_ids": [...]}
+        self._documents: Dict[str, Dict[str, Any]] = {}
+        self._total_length = 0
+        # Documents added or removed in this process since the last save
+        self._changed_documents = set()
+        self._change_listeners = []
+        self._dirty = False
+        self._saved_at = 0.0
+        self._file_mtime = None
+        self.load()
+
+    def load(self):
+        """Load the index from disk, starting empty if there is no usable file"""
+        with self._lock:
+            self._chunks, self._postings, self._documents, self._total_length = {}, {}, {}, 0
+            self._changed_documents = set()
+            self._dirty = False
+            documents, self._file_mtime = self._read_file()
+            if documents is None:
+                return
+            for document_id, document in documents.items():
+                self._add_stored_document(document_id, document)
+            logger.info(f"Loaded BM25 index with {len(self._documents)} documents and {len(self._chunks)} chunks from {self.path}")
+
+    def _read_file(self) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        """Return the documents stored in the file and its mtime, (None, mtime) if it is unusable"""
+        mtime = None
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"No BM25 index at {self.path}, starting with an empty index")
+            return None, None
+        except Exception as e:
+            logger.error(f"Could not load BM25 index from {self.path}: {str(e)}")
+            return None, mtime
+
+        if data.get("version") != INDEX_VERSION:
+            logger.warning(f"BM25 index {self.path} has version {data.get('version')}, expected {INDEX_VERSION}; ignoring it")
+            return None, mtime
+        return data.get("documents", {}), mtime
+
+    def _add_stored_document(self, document_id, document: Dict[str, Any]):
+        """Add a document in its on-disk form"""
+        self._documents[document_id] = {
+            "content_hash": document.get("content_hash"),
+            "metadata": document.get("metadata", {}),
+            "point_ids": []
+        }
+        for point_id, terms in document.get("chunks", {}).items():
+            self._add_chunk(document_id, point_id, terms)
+
+    def _stored_document(self, document_id) -> Dict[str, Any]:
+        """Return a document in its on-disk form"""
+        document = self._documents[document_id]
+        return {
+            "content_hash": document["content_hash"],
+            "metadata": document["metadata"],
+            "chunks": {point_id: self._chunks[point_id]["terms"] for point_id in document["point_ids"]}
+        }
+
+    def _merge(self, documents: Dict[str, Any]) -> set:
+        """Take every document not changed in this process from documents, return the IDs that differed"""
+        updated = set()
+        for document_id in (set(documents) | set(self._documents)) - self._changed_documents:
+            stored = documents.get(document_id)
+            if stored is None:
+                self._remove_chunks(document_id)
+                updated.add(document_id)
+            elif document_id not in self._documents or self._stored_document(document_id) != stored:
+                self._remove_chunks(document_id)
+                self._add_stored_document(document_id, stored)
+                updated.add(document_id)
+        return updated
+
+    def add_change_listener(self, callback):
+        """Register a callback called with the set of document IDs another process changed"""
+        self._change_listeners.append(callback)
+
+    def _notify_changed(self, document_ids: set):
+        if not document_ids:
+            return
+        logger.info(f"BM25 index {self.path} was changed by another process, merged {len(document_ids)} documents")
+        for callback in self._change_listeners:
+            try:
+                callback(document_ids)
+            except Exception as e:
+                logger.warning(f"BM25 change listener failed: {e}")
+
+    def _add_chunk(self, document_id, point_id, terms: Dict[str, int]):
+        length = sum(terms.values())
+        self._chunks[point_id] = {"document_id": document_id, "length": length, "terms": terms}
+        self._documents[document_id]["point_ids"].append(point_id)
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[point_id] = tf
+
+    def _remove_chunks(self, document_id) -> int:
+        document = self._documents.pop(document_id, None)
+        if document is None:
+            return 0
+        for point_id in document["point_ids"]:
+            chunk = self._chunks.pop(point_id, None)
+            if chunk is None:
+                continue
+            self._total_length -= chunk["length"]
+            for term in chunk["terms"]:
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(point_id, None)
+                    if not postings:
+                        del self._postings[term]
+        return len(document["point_ids"])
+
+    def add_document(self, document_id, chunks: Iterable[Tuple[Any, str]], content_hash: str = None,
+                     metadata: Dict[str, Any] = None):
+        """Index the chunks of a document as (point_id, text) pairs, replacing earlier chunks
+
+        metadata (e.g. folder and file type) can be used to select documents with document_ids_where.
+        """
+        with self._lock:
+            self._remove_chunks(document_id)
+            self._documents[document_id] = {"content_hash": content_hash, "metadata": metadata or {}, "point_ids": []}
+            for point_id, text in chunks:
+                self._add_chunk(document_id, str(point_id), dict(Counter(tokenize(text))))
+            self._changed_documents.add(document_id)
+            self._dirty = True
+        self.save_if_due()
+
+    def remove_document(self, document_id) -> int:
+        """Remove all chunks of a document and return how many were removed"""
+        with self._lock:
+            existed = document_id in self._documents
+            removed = self._remove_chunks(document_id)
+            if existed:
+                self._changed_documents.add(document_id)
+                self._dirty = True
+        if existed:
+            self.save_if_due()
+        return removed
+
+    def document_hashes(self) -> Dict[str, Optional[str]]:
+        """Return the content hash of every indexed document"""
+        with self._lock:
+            return {document_id: document["content_hash"] for document_id, document in self._documents.items()}
+
+    def document_ids_where(self, predicate) -> set:
+        """Return the IDs of the documents whose metadata satisfies predicate(metadata)"""
+        with self._lock:
+            return {document_id for document_id, document in self._documents.items() if predicate(document["metadata"])}
+
+    def search(self, query: str, limit: int, document_ids=None) -> List[Tuple[str, float]]:
+        """Return up to limit (point_id, score) pairs, best first
+
+        document_ids optionally restricts the result to chunks of those documents.
+        """
+        self.reload_if_changed()
+        terms = set(tokenize(query))
+        with self._lock:
+            chunk_count = len(self._chunks)
+            if not terms or not chunk_count:
+                return []
+            avg_length = self._total_length / chunk_count
+            allowed = set(document_ids) if document_ids is not None else None
+
+            scores = Counter()
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (chunk_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                if idf < BM25_MIN_IDF:
+                    continue
+                for point_id, tf in postings.items():
+                    chunk = self._chunks[point_id]
+                    if allowed is not None and chunk["document_id"] not in allowed:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk["length"] / avg_length)
+                    scores[point_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        return scores.most_common(limit)
+
+    def reload_if_changed(self):
+        """Merge in the changes of another process if it replaced the file since it was loaded or saved"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if mtime == self._file_mtime:
+                return
+            dirty = self._dirty
+        if dirty:
+            # Local changes win; the save merges everything else from the file
+            self.save()
+            return
+        documents, mtime = self._read_file()
+        with self._lock:
+            updated = self._merge(documents) if documents is not None else set()
+            self._file_mtime = mtime
+        self._notify_changed(updated)
+
+    def save_if_due(self):
+        """Write the index if it changed and the last write is older than BM25_SAVE_INTERVAL"""
+        if self._dirty and time.monotonic() - self._saved_at >= BM25_SAVE_INTERVAL:
+            self.save()
+
+    def flush(self):
+        """Write pending changes to disk"""
+        if self._dirty:
+            self.save()
+
+    def save(self):
+        """Merge changes of other processes from the file, then write the index to disk atomically"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock_file:
+            if HAS_FCNTL:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self._lock:
+                updated = set()
+                try:
+                    mtime = os.path.getmtime(self.path)
+                except OSError:
+                    mtime = None
+                if mtime is not None and mtime != self._file_mtime:
+                    documents, _ = self._read_file()
+                    if documents is not None:
+                        updated = self._merge(documents)
+
+                data = {
+                    "version": INDEX_VERSION,
+                    "documents": {document_id: self._stored_document(document_id) for document_id in self._documents}
+                }
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_path, self.path)
+                self._file_mtime = os.path.getmtime(self.path)
+                self._changed_documents = set()
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            # The lock is released when the file is closed
+        logger.info(f"Saved BM25 index with {len(data['documents'])} documents to {self.path}")
+        self._notify_changed(updated)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return index size and persistence state"""
+        with self._lock:
+            return {
+                "path": self.path,
+                "documents": len(self._documents),
+                "chunks": len(self._chunks),
+                "terms": len(self._postings),
+                "avg_chunk_length": self._total_length / len(self._chunks) if self._chunks else 0.0,
+                "unsaved_changes": self._dirty
+            }
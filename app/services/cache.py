@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so that trivially different spellings share a cache entry"""
+    return " ".join(query.split()).lower()
+
+
+class EmbeddingCache:
+    """Bounded, thread-safe LRU cache for query embeddings
+
+    Entries are keyed on the model name and the normalized query text, so
+    switching the embedding model never returns vectors of the old model.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model_name: str, query: str) -> Optional[np.ndarray]:
+        """Return the cached embedding or None, counting the hit or miss"""
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, model_name: str, query: str, embedding: np.ndarray):
+        """Store an embedding, evicting the least recently used entry if full"""
+        if self.maxsize <= 0:
+            return
+
+        # Cached arrays are shared between requests, so they must not be modified
+        embedding = np.array(embedding, copy=True)
+        embedding.setflags(write=False)
+
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return size and hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class SemanticAnswerCache:
+    """Cache for generated answers, matched by query similarity and retrieved chunks
+
+    A cached answer is only served when the new query retrieved exactly the
+    same chunk set and its embedding is at least `similarity_threshold`
+    cosine-similar to the cached query. Entries expire after `ttl` seconds
+    and are dropped when one of their source documents is re-indexed.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0, similarity_threshold: float = 0.9):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit_vector(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _purge_expired(self, now: float):
+        expired = [entry_id for entry_id, entry in self._entries.items() if now - entry["created_at"] > self.ttl]
+        for entry_id in expired:
+            del self._entries[entry_id]
+
+    def lookup(self, query_embedding, chunk_ids) -> Optional[str]:
+        """Return a cached answer for a similar query over the same chunks, or None"""
+        chunk_key = frozenset(chunk_ids)
+        query_vector = self._unit_vector(query_embedding)
+        now = time.monotonic()
+
+        with self._lock:
+            self._purge_expired(now)
+
+            best_id, best_similarity = None, self.similarity_threshold
+            for entry_id, entry in self._entries.items():
+                if entry["chunk_key"] != chunk_key:
+                    continue
+                similarity = float(np.dot(entry["query_vector"], query_vector))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id]["answer"]
+
+    def store(self, query_embedding, chunk_ids, document_ids, answer: str):
+        """Cache an answer together with the chunks and documents it was built from"""
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[self._next_id] = {
+                "query_vector": self._unit_vector(query_embedding),
+                "chunk_key": frozenset(chunk_ids),
+                "document_ids": frozenset(document_ids),
+                "answer": answer,
+                "created_at": time.monotonic()
+            }
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_document(self, document_id) -> int:
+        """Drop all answers that used chunks of the given document"""
+        with self._lock:
+            stale = [entry_id for entry_id, entry in self._entries.items() if document_id in entry["document_ids"]]
+            for entry_id in stale:
+                del self._entries[entry_id]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def clear(self):
+        """Drop all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return size and hit/miss/invalidation counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "similarity_threshold": self.similarity_threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
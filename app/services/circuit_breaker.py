@@ -0,0 +1,124 @@
+import logging
+import time
+from collections import deque
+from typing import Any, Dict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open"""
+
+
+class CircuitBreaker:
+    """Failure-rate and slow-call circuit breaker
+
+    The outcomes of the last `window_size` calls are kept. Once at least
+    `minimum_calls` were recorded, the circuit opens when the share of failed
+    calls reaches `failure_rate_threshold` or the share of calls slower than
+    `slow_call_duration` reaches `slow_call_rate_threshold`. An open circuit
+    rejects calls for `open_duration` seconds, then lets up to
+    `half_open_max_calls` probe calls through: a successful probe closes the
+    circuit again, a failed or slow one re-opens it.
+    """
+
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, slow_call_duration: float = 60.0,
+                 slow_call_rate_threshold: float = 0.8, window_size: int = 20, minimum_calls: int = 5,
+                 open_duration: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at = None
+        self._half_open_calls = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def check(self):
+        """Raise CircuitOpenError if a call would currently be rejected, without claiming a probe"""
+        if self.state == OPEN and time.monotonic() - self._opened_at < self.open_duration:
+            self.rejected += 1
+            raise CircuitOpenError(f"Circuit {self.name} is open")
+        if self.state == HALF_OPEN and self._half_open_calls >= self.half_open_max_calls:
+            self.rejected += 1
+            raise CircuitOpenError(f"Circuit {self.name} is half-open and already probing")
+
+    def before_call(self) -> bool:
+        """Check whether a call may proceed, raise CircuitOpenError if not
+
+        Returns True if the call is a half-open probe; pass it on to record or abandon.
+        """
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.open_duration:
+                self.rejected += 1
+                raise CircuitOpenError(f"Circuit {self.name} is open")
+            logger.info(f"Circuit {self.name} half-open, letting probe calls through")
+            self.state = HALF_OPEN
+            self._half_open_calls = 0
+
+        if self.state == HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(f"Circuit {self.name} is half-open and already probing")
+            self._half_open_calls += 1
+            return True
+        return False
+
+    def record(self, success: bool, duration: float, probe: bool = False):
+        """Record the outcome and duration of a call that was allowed by before_call"""
+        slow = duration >= self.slow_call_duration
+
+        if probe:
+            self._half_open_calls = max(self._half_open_calls - 1, 0)
+            if self.state != HALF_OPEN:
+                return
+            if success and not slow:
+                logger.info(f"Circuit {self.name} probe succeeded, closing circuit")
+                self.state = CLOSED
+                self._outcomes.clear()
+            else:
+                self._open(f"probe call {'failed' if not success else 'was slow'}")
+            return
+
+        self._outcomes.append((success, slow))
+        if self.state == CLOSED and len(self._outcomes) >= self.minimum_calls:
+            failure_rate = sum(1 for ok, _ in self._outcomes if not ok) / len(self._outcomes)
+            slow_rate = sum(1 for _, is_slow in self._outcomes if is_slow) / len(self._outcomes)
+            if failure_rate >= self.failure_rate_threshold:
+                self._open(f"failure rate {failure_rate:.0%}")
+            elif slow_rate >= self.slow_call_rate_threshold:
+                self._open(f"slow call rate {slow_rate:.0%}")
+
+    def abandon(self, probe: bool = False):
+        """Forget a call that was cancelled before its outcome was known"""
+        if probe:
+            self._half_open_calls = max(self._half_open_calls - 1, 0)
+
+    def _open(self, reason: str):
+        logger.warning(f"Opening circuit {self.name} for {self.open_duration}s: {reason}")
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.times_opened += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the state and the outcome counters of the current window"""
+        return {
+            "state": self.state,
+            "window_calls": len(self._outcomes),
+            "window_failures": sum(1 for ok, _ in self._outcomes if not ok),
+            "window_slow_calls": sum(1 for _, slow in self._outcomes if slow),
+            "rejected": self.rejected,
+            "times_opened": self.times_opened
+        }
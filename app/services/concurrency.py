@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LLMBusyError(Exception):
+    """Raised when the LLM request queue is full"""
+
+
+class ClientDisconnected(Exception):
+    """Raised when every client waiting for an LLM request has disconnected"""
+
+
+class SingleFlight:
+    """Coalesces concurrent async calls with the same key into one execution
+
+    The first caller for a key starts `func` as a task; callers arriving while
+    it runs await the same task. `func` receives an async callable that reports
+    whether every waiting caller has disconnected, so long-running work can be
+    abandoned once nobody is interested in the result. If all waiters are
+    cancelled, the shared task is cancelled as well.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, is_disconnected=None):
+        """Run func(all_disconnected) once per key, return (result, shared)
+
+        `shared` is True for callers that joined an execution started by another caller.
+        """
+        self.calls += 1
+        call = self._calls.get(key)
+        shared = call is not None
+
+        if shared:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight call {key[:12]} ({call['waiters']} waiting)")
+        else:
+            self.executions += 1
+            call = {"waiters": 0, "checks": []}
+            call["task"] = asyncio.ensure_future(func(lambda: self._all_disconnected(call)))
+            call["task"].add_done_callback(lambda _: self._forget(key, call))
+            self._calls[key] = call
+
+        call["waiters"] += 1
+        if is_disconnected is not None:
+            call["checks"].append(is_disconnected)
+        try:
+            return await asyncio.shield(call["task"]), shared
+        finally:
+            call["waiters"] -= 1
+            if is_disconnected is not None:
+                call["checks"].remove(is_disconnected)
+            if call["waiters"] == 0 and not call["task"].done():
+                logger.info(f"No callers left for in-flight call {key[:12]}, cancelling it")
+                call["task"].cancel()
+
+    async def _all_disconnected(self, call) -> bool:
+        # Callers without a disconnect check count as connected
+        if len(call["checks"]) < call["waiters"]:
+            return False
+        for check in list(call["checks"]):
+            if not await check():
+                return False
+        return True
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return call, execution and coalescing counters"""
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls)
+        }
+
+
+class ConcurrencyLimiter:
+    """Async semaphore with a bounded priority queue in front of it
+
+    At most `max_concurrent` callers hold a slot at a time. Further callers
+    wait in a queue ordered by priority (lower value first, FIFO within a
+    priority); when `max_queue` callers are already waiting, acquiring fails
+    immediately with LLMBusyError instead of piling up more work.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self.acquired = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, priority: int = 0):
+        """Wait for a slot, raise LLMBusyError if the queue is full"""
+        started = time.monotonic()
+
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._record_wait(0.0)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            logger.warning(f"LLM queue full ({len(self._waiters)} waiting), rejecting request")
+            raise LLMBusyError(f"LLM queue is full ({self.max_queue} requests waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancellation, pass it on
+                self.release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+        self._record_wait(time.monotonic() - started)
+
+    def release(self):
+        """Hand the slot to the next waiter or free it"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # The slot stays active and is handed over directly
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        """Context manager holding a slot for the duration of the block"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _record_wait(self, wait: float):
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return slot usage, queue depth and queue wait times"""
+        return {
+            "active": self._active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "acquired": self.acquired,
+            "rejected": self.rejected,
+            "avg_wait_seconds": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait_seconds": self.max_wait
+        }
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import threading
+import time
+
+from app.services.dropbox_service import DropboxService
+from app.services.llm_service import LLMService
+from app.services.qdrant_service import QdrantService
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ServiceContainer:
+    """Builds each service once per process and hands out the shared instances"""
+
+    def __init__(self):
+        # One lock per service, so building one does not hold up requests for another
+        self._locks = {name: threading.Lock() for name in ("dropbox", "qdrant", "llm")}
+        self._dropbox = None
+        self._qdrant = None
+        self._llm = None
+        self._warm_up_task = None
+        self._components = {
+            name: {"state": "pending", "error": None, "duration": None}
+            for name in ("dropbox", "qdrant", "llm")
+        }
+
+    @property
+    def dropbox(self) -> DropboxService:
+        if self._dropbox is None:
+            with self._locks["dropbox"]:
+                if self._dropbox is None:
+                    self._dropbox = DropboxService()
+        return self._dropbox
+
+    @property
+    def qdrant(self) -> QdrantService:
+        if self._qdrant is None:
+            with self._locks["qdrant"]:
+                if self._qdrant is None:
+                    qdrant_service = QdrantService()
+                    # Cached answers must not outlive the chunks they were generated from
+                    qdrant_service.add_document_listener(self._invalidate_answers)
+                    self._qdrant = qdrant_service
+        return self._qdrant
+
+    @property
+    def llm(self) -> LLMService:
+        if self._llm is None:
+            with self._locks["llm"]:
+                if self._llm is None:
+                    self._llm = LLMService()
+        return self._llm
+
+    def _invalidate_answers(self, document_id):
+        """Drop cached LLM answers that used chunks of the given document"""
+        if self._llm is not None:
+            self._llm.answer_cache.invalidate_document(document_id)
+
+    def _warm_up_component(self, name):
+        """Warm up one service in a worker thread and record its state"""
+        component = self._components[name]
+        component["state"] = "warming"
+        started = time.monotonic()
+        try:
+            service = getattr(self, name)
+            warm_up = getattr(service, "warm_up", None)
+            if warm_up is not None:
+                warm_up()
+            component["state"] = "ready"
+        except Exception as e:
+            logger.exception(f"Warm-up of {name} failed: {e}")
+            component["state"] = "failed"
+            component["error"] = str(e)
+        finally:
+            component["duration"] = round(time.monotonic() - started, 3)
+
+    async def _warm_up(self):
+        """Warm up all services concurrently without blocking the event loop"""
+        await asyncio.gather(*(
+            asyncio.to_thread(self._warm_up_component, name)
+            for name in self._components
+        ))
+        logger.info(f"Service warm-up finished: {self.readiness()}")
+
+    def readiness(self):
+        """Report the warm-up state of every component"""
+        components = {name: dict(component) for name, component in self._components.items()}
+        return {
+            "ready": all(component["state"] == "ready" for component in components.values()),
+            "components": components
+        }
+
+    async def startup(self):
+        """Start warming up the services in the background, called from the application lifespan
+
+        The HTTP server can accept requests right away; services that are used
+        before their warm-up finished are initialized lazily on first use.
+        """
+        logger.info("Starting service warm-up in the background")
+        await self.llm.startup()
+        self._warm_up_task = asyncio.create_task(self._warm_up())
+
+    async def shutdown(self):
+        """Release the services, called once from the application lifespan"""
+        logger.info("Shutting down services")
+        if self._warm_up_task is not None and not self._warm_up_task.done():
+            self._warm_up_task.cancel()
+        if self._llm is not None:
+            await self._llm.aclose()
+        if self._qdrant is not None:
+            self._qdrant.close()
+        with self._locks["dropbox"], self._locks["qdrant"], self._locks["llm"]:
+            self._dropbox = None
+            self._qdrant = None
+            self._llm = None
+
+
+# Process-wide container used by the FastAPI app and its routers
+services = ServiceContainer()
+
+
+def get_dropbox_service() -> DropboxService:
+    """FastAPI dependency returning the shared DropboxService"""
+    return services.dropbox
+
+
+def get_qdrant_service() -> QdrantService:
+    """FastAPI dependency returning the shared QdrantService"""
+    return services.qdrant
+
+
+def get_llm_service() -> LLMService:
+    """FastAPI dependency returning the shared LLMService"""
+    return services.llm
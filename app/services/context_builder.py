@@ -0,0 +1,177 @@
+import logging
+import math
+import os
+import threading
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Hugging Face name or local path of the tokenizer of the RunPod model
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "")
+# Maximum number of context tokens in the prompt
+LLM_CONTEXT_TOKEN_BUDGET = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "2000"))
+# Conservative estimate for German text when no tokenizer is available
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "3.0"))
+
+CHUNK_SEPARATOR = "\n\n"
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split chunk text into sentences the same way QdrantService._chunk_text does"""
+    sentences = text.replace('\n', ' ').split('. ')
+    return [s.strip().rstrip('.') + '.' for s in sentences if s.strip()]
+
+
+class TokenCounter:
+    """Counts tokens with the model tokenizer, or estimates them from the text length"""
+
+    def __init__(self, tokenizer_name: str = LLM_TOKENIZER, chars_per_token: float = LLM_CHARS_PER_TOKEN):
+        self.tokenizer_name = tokenizer_name
+        self.chars_per_token = chars_per_token
+        self._tokenizer = None
+        self._load_failed = False
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        """The model tokenizer, loaded on first use; None if it is not available"""
+        if self._tokenizer is None and not self._load_failed:
+            with self._lock:
+                if self._tokenizer is None and not self._load_failed:
+                    self._load_tokenizer()
+        return self._tokenizer
+
+    def _load_tokenizer(self):
+        if not self.tokenizer_name:
+            self._load_failed = True
+            return
+        try:
+            # Imported here because importing transformers pulls in torch, which would slow down startup
+            from transformers import AutoTokenizer
+        except ImportError:
+            logger.warning(f"LLM_TOKENIZER is set to {self.tokenizer_name} but transformers is not installed, estimating tokens")
+            self._load_failed = True
+            return
+        try:
+            logger.info(f"Loading tokenizer {self.tokenizer_name}")
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        except Exception as e:
+            logger.error(f"Could not load tokenizer {self.tokenizer_name}, estimating tokens: {str(e)}")
+            self._load_failed = True
+
+    @property
+    def name(self) -> str:
+        return self.tokenizer_name if self.tokenizer is not None else "estimate"
+
+    def count(self, text: str) -> int:
+        """Return the number of tokens of the text"""
+        if not text:
+            return 0
+        tokenizer = self.tokenizer
+        if tokenizer is not None:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut the text down to at most max_tokens tokens"""
+        if max_tokens <= 0:
+            return ""
+        tokenizer = self.tokenizer
+        if tokenizer is not None:
+            token_ids = tokenizer.encode(text, add_special_tokens=False)
+            return tokenizer.decode(token_ids[:max_tokens])
+        return text[:int(max_tokens * self.chars_per_token)]
+
+
+class ContextBuilder:
+    """Assembles the LLM context from search results within a token budget
+
+    Chunks are taken in the order they are given, i.e. best first as returned
+    by QdrantService.search (possibly re-ranked). Sentences that an earlier,
+    better-ranked chunk of the same document already contributed are dropped,
+    which removes the overlap _chunk_text puts between neighbouring chunks.
+    The chunk that no longer fits is cut at a sentence boundary; later,
+    smaller chunks may still fill the rest of the budget.
+    """
+
+    def __init__(self, token_budget: int = LLM_CONTEXT_TOKEN_BUDGET, counter: TokenCounter = None):
+        self.token_budget = token_budget
+        self.counter = counter or TokenCounter()
+
+    def build(self, search_results, token_budget: int = None) -> Dict[str, Any]:
+        """Build the context from Qdrant hits and report what went into it"""
+        budget = token_budget or self.token_budget
+        separator_tokens = self.counter.count(CHUNK_SEPARATOR)
+        seen_sentences = {}
+        blocks = []
+        tokens_used = 0
+        stats = {"chunks_used": 0, "chunks_truncated": 0, "chunks_skipped": 0, "duplicate_sentences": 0}
+
+        for result in search_results:
+            document_id = result.payload.get("document_id")
+            seen = seen_sentences.setdefault(document_id, set())
+
+            sentences = []
+            for sentence in split_sentences(result.payload.get("text", "")):
+                if sentence in seen:
+                    stats["duplicate_sentences"] += 1
+                else:
+                    sentences.append(sentence)
+            if not sentences:
+                # Chunk is fully contained in chunks already used
+                stats["chunks_skipped"] += 1
+                continue
+
+            header = f"[Dokument: {result.payload.get('document_name', 'Unbekanntes Dokument')}]\n"
+            available = budget - tokens_used - (separator_tokens if blocks else 0)
+            block = header + " ".join(sentences)
+            block_tokens = self.counter.count(block)
+
+            if block_tokens > available:
+                block, sentences = self._fit_block(header, sentences, available, first=not blocks)
+                if not block:
+                    stats["chunks_skipped"] += 1
+                    continue
+                block_tokens = self.counter.count(block)
+                stats["chunks_truncated"] += 1
+
+            seen.update(sentences)
+            blocks.append(block)
+            tokens_used += block_tokens + (separator_tokens if len(blocks) > 1 else 0)
+            stats["chunks_used"] += 1
+
+        context = CHUNK_SEPARATOR.join(blocks)
+        logger.info(f"Context: {tokens_used}/{budget} tokens ({self.counter.name}), "
+                    f"{stats['chunks_used']} chunks used, {stats['chunks_truncated']} truncated, "
+                    f"{stats['chunks_skipped']} skipped, {stats['duplicate_sentences']} duplicate sentences removed")
+
+        return {
+            "context": context,
+            "tokens_used": tokens_used,
+            "token_budget": budget,
+            "tokenizer": self.counter.name,
+            **stats
+        }
+
+    def _fit_block(self, header, sentences, available, first=False):
+        """Return the longest sentence prefix of a chunk that fits the available tokens"""
+        header_tokens = self.counter.count(header)
+        fitted = []
+        for sentence in sentences:
+            if self.counter.count(header + " ".join(fitted + [sentence])) > available:
+                break
+            fitted.append(sentence)
+
+        if fitted:
+            return header + " ".join(fitted), fitted
+        if first and available > header_tokens:
+            # Not even one sentence of the best chunk fits, cut it mid-sentence rather than sending no context
+            return header + self.counter.truncate(sentences[0], available - header_tokens), []
+        return "", []
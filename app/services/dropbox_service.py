@@ -4,7 +4,7 @@ import logging
 import time
 from urllib.parse import unquote
 import dropbox
-from dropbox.files import FileMetadata, FolderMetadata
+from dropbox.files import DeletedMetadata, FileMetadata, FolderMetadata
 from dropbox.exceptions import ApiError, AuthError
 from dotenv import load_dotenv
 import io
@@ -38,67 +38,199 @@ DROPBOX_APP_KEY = os.getenv("DROPBOX_APP_KEY")
 DROPBOX_APP_SECRET = os.getenv("DROPBOX_APP_SECRET")
 DROPBOX_ACCESS_TOKEN = os.getenv("DROPBOX_ACCESS_TOKEN")
 
+def _extract_text_from_pdf_with_pdfminer(file_content):
+    """Extract text from PDF using PDFMiner"""
+    try:
+        if not HAS_PDFMINER:
+            return None
+            
+        logger.info("Extracting text from PDF using PDFMiner")
+        pdf_file = io.BytesIO(file_content)
+        text = pdf_extract_text(pdf_file)
+        
+        # Clean up the text a bit
+        text = re.sub(r'\s+', ' ', text)  # Replace multiple spaces with single space
+        text = text.strip()
+        
+        logger.info(f"Extracted {len(text)} characters with PDFMiner")
+        return text
+    except PDFSyntaxError as e:
+        logger.error(f"PDFMiner syntax error: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Error extracting text with PDFMiner: {e}")
+        return None
+
+def _extract_text_from_pdf_with_pypdf(file_content):
+    """Extract text from PDF using PyPDF"""
+    try:
+        if not HAS_PYPDF:
+            return None
+            
+        logger.info("Extracting text from PDF using PyPDF")
+        pdf_file = io.BytesIO(file_content)
+        
+        with pypdf.PdfReader(pdf_file) as pdf:
+            text = ""
+            for page_num in range(len(pdf.pages)):
+                page = pdf.pages[page_num]
+                text += page.extract_text() + "\n"
+        
+        # Clean up the text
+        text = text.strip()
+        
+        logger.info(f"Extracted {len(text)} characters with PyPDF")
+        return text
+    except Exception as e:
+        logger.error(f"Error extracting text with PyPDF: {e}")
+        return None
+
+def _extract_text_from_pdf(file_content):
+    """Extract text from PDF using available methods"""
+    # Try with PDFMiner first (usually better quality)
+    text = _extract_text_from_pdf_with_pdfminer(file_content)
+    
+    # If PDFMiner failed, try with PyPDF
+    if not text:
+        text = _extract_text_from_pdf_with_pypdf(file_content)
+        
+    # If we got any text, return it
+    if text and len(text) > 10:  # Ensure we got meaningful text
+        return text
+        
+    # If all methods failed, return a helpful message
+    return "PDF konnte nicht analysiert werden. Möglicherweise ist es gescannt oder passwortgeschützt."
+
+def extract_text(path, content):
+    """Extract the text of a downloaded file, from PDFs or by trying common encodings
+    
+    A module-level function so that it can run in a worker process.
+    """
+    # Check file extension
+    is_pdf = path.lower().endswith('.pdf')
+    
+    # If it's a PDF, extract text
+    if is_pdf:
+        logger.info(f"File is a PDF, extracting text")
+        extracted_text = _extract_text_from_pdf(content)
+        if extracted_text:
+            logger.info(f"Successfully extracted text from PDF, size: {len(extracted_text)} bytes")
+            return extracted_text
+        else:
+            logger.warning(f"Failed to extract text from PDF")
+    
+    # Try to decode as text if not a PDF or if PDF extraction failed
+    try:
+        text_content = content.decode('utf-8')
+        logger.info(f"File decoded as UTF-8, size: {len(text_content)} bytes")
+        return text_content
+    except UnicodeDecodeError:
+        # If UTF-8 decoding fails, try other encodings
+        logger.warning(f"UTF-8 decoding failed for file: {path}")
+        
+        # Try common encodings
+        for encoding in ['latin-1', 'cp1252', 'iso-8859-1']:
+            try:
+                text_content = content.decode(encoding)
+                logger.info(f"File decoded as {encoding}, size: {len(text_content)} bytes")
+                return text_content
+            except UnicodeDecodeError:
+                continue
+        
+        # If all decodings fail and it's not a PDF, return a useful message
+        if not is_pdf:
+            logger.warning(f"All text decodings failed for non-PDF file")
+            return "Dieser Dateityp kann nicht als Text angezeigt werden."
+        else:
+            # This should never happen as we already tried PDF extraction above
+            logger.warning(f"Both PDF extraction and text decoding failed")
+            return "PDF-Extraktion fehlgeschlagen. Die Datei ist möglicherweise beschädigt oder passwortgeschützt."
+
 class DropboxService:
     def __init__(self):
-        try:
-            logger.info("Initializing Dropbox client")
-            self.client = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
-            # Test if the token is valid
-            self.client.users_get_current_account()
-            logger.info("Dropbox client initialized successfully")
-            self._valid = True
-        except AuthError as e:
-            logger.error(f"Dropbox authentication error: {e}")
-            self._valid = False
-            # Still create the client, but log the error
-            self.client = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
-        except Exception as e:
-            logger.error(f"Error initializing Dropbox client: {e}")
-            self._valid = False
-            # Still create the client, but log the error
-            self.client = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
+        logger.info("Initializing Dropbox client")
+        self.client = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
+        # None until the token has been checked by warm_up() or get_token_info()
+        self._valid = None
     
-    def list_files(self, path=""):
-        """List all files and folders in the given path"""
+    def warm_up(self):
+        """Check the access token once so that later calls know whether it is valid
+        
+        Raises RuntimeError if the token is invalid, so that the warm-up is
+        reported as failed.
+        """
+        token_info = self.get_token_info()
+        if not token_info.get("valid"):
+            logger.error(f"Dropbox authentication error: {token_info.get('error')}")
+            raise RuntimeError(f"Dropbox token is invalid: {token_info.get('error')}")
+        logger.info("Dropbox client initialized successfully")
+        return token_info
+    
+    @staticmethod
+    def _normalize_folder_path(path):
+        """Decode a folder path and bring it into the form the Dropbox API expects"""
+        # Ensure path is properly decoded and normalized
+        path = unquote(path or "")
+        # Remove trailing slash if present; the root folder is ""
+        if path.endswith("/"):
+            path = path[:-1]
+        return path
+    
+    @staticmethod
+    def _entry_info(entry):
+        """Convert a Dropbox metadata entry into a dict"""
+        entry_info = {
+            "id": entry.id if hasattr(entry, 'id') else entry.name,
+            "name": entry.name,
+            "path": entry.path_display,
+            "path_lower": entry.path_lower,
+            "type": "file" if isinstance(entry, FileMetadata) else "folder"
+        }
+        if isinstance(entry, FileMetadata):
+            entry_info.update({
+                "size": entry.size,
+                "server_modified": entry.server_modified.isoformat() if entry.server_modified else None,
+                "rev": entry.rev,
+                "content_hash": entry.content_hash
+            })
+        return entry_info
+    
+    def iter_files(self, path="", recursive=False):
+        """Yield all files and folders in the given path, page by page
+        
+        Follows files_list_folder_continue until has_more is False. With
+        recursive=True the whole tree below the path is listed in one paginated
+        listing instead of one request per folder. Dropbox errors are raised.
+        """
+        path = self._normalize_folder_path(path)
+        logger.info(f"Listing files in path: '{path}' (recursive: {recursive})")
+        
+        result = self.client.files_list_folder(path, recursive=recursive)
+        pages = 1
+        while True:
+            for entry in result.entries:
+                logger.debug(f"API returned: {entry.name} ({entry.__class__.__name__}), path: {entry.path_display}")
+                yield self._entry_info(entry)
+            
+            if not result.has_more:
+                break
+            result = self.client.files_list_folder_continue(result.cursor)
+            pages += 1
+        
+        logger.info(f"Listed '{path}' in {pages} pages")
+    
+    def list_files(self, path="", recursive=False):
+        """List all files and folders in the given path, with recursive=True the whole tree below it
+        
+        File entries carry size, server_modified, rev and content_hash.
+        """
         try:
             # Check if token is valid
-            if not self._valid:
+            if self._valid is False:
                 logger.error("Cannot list files: Dropbox token is invalid")
                 return []
-                
-            # Ensure path is properly decoded and normalized
-            path = unquote(path)
-            # Remove trailing slash if present
-            if path and path != "/" and path.endswith("/"):
-                path = path[:-1]
-                
-            logger.info(f"Listing files in path: '{path}' (type: {type(path)})")
             
-            # Special case for empty path or root path
-            if not path or path == "":
-                logger.info("Using empty path for root folder")
-                result = self.client.files_list_folder("")
-            else:
-                logger.info(f"Using specified path: {path}")
-                result = self.client.files_list_folder(path)
-                
-            logger.info(f"Got response with {len(result.entries)} entries")
-            
-            # Debug: print all entries from API
-            for entry in result.entries:
-                logger.info(f"API returned: {entry.name} ({entry.__class__.__name__}), path: {entry.path_display}")
-            
-            files = []
-            
-            for entry in result.entries:
-                entry_info = {
-                    "id": entry.id if hasattr(entry, 'id') else entry.name,
-                    "name": entry.name,
-                    "path": entry.path_display,
-                    "type": "file" if isinstance(entry, FileMetadata) else "folder"
-                }
-                logger.info(f"Adding entry: {entry_info['name']} ({entry_info['type']}), path: {entry_info['path']}")
-                files.append(entry_info)
+            files = list(self.iter_files(path, recursive=recursive))
             
             logger.info(f"Returning {len(files)} files/folders")
             return files
@@ -119,134 +251,90 @@ class DropboxService:
             logger.error(f"Error listing files: {e}")
             return []
     
-    def _extract_text_from_pdf_with_pdfminer(self, file_content):
-        """Extract text from PDF using PDFMiner"""
-        try:
-            if not HAS_PDFMINER:
-                return None
-                
-            logger.info("Extracting text from PDF using PDFMiner")
-            pdf_file = io.BytesIO(file_content)
-            text = pdf_extract_text(pdf_file)
-            
-            # Clean up the text a bit
-            text = re.sub(r'\s+', ' ', text)  # Replace multiple spaces with single space
-            text = text.strip()
+    def list_changes(self, cursor=None, path=""):
+        """Return the files changed and the paths deleted since the cursor, and the new cursor
+        
+        Without a cursor, or when Dropbox has reset the cursor, the whole tree
+        below the path is listed recursively and "reset" is True; the caller
+        then has to treat the listed files as the complete state. With a valid
+        cursor only the delta is fetched, which is a single
+        files_list_folder_continue call when nothing changed. Deleted entries
+        may be files or whole folders. Dropbox errors are raised.
+        """
+        reset = cursor is None
+        if cursor is not None:
+            try:
+                result = self.client.files_list_folder_continue(cursor)
+            except ApiError as e:
+                if not (hasattr(e.error, "is_reset") and e.error.is_reset()):
+                    raise
+                logger.warning("Dropbox cursor was reset, listing the whole tree again")
+                reset = True
+        if reset:
+            path = self._normalize_folder_path(path)
+            logger.info(f"Listing '{path}' recursively to start a new cursor")
+            result = self.client.files_list_folder(path, recursive=True)
+        
+        files, deleted = [], []
+        pages = 1
+        while True:
+            for entry in result.entries:
+                if isinstance(entry, DeletedMetadata):
+                    deleted.append(entry.path_display or entry.path_lower)
+                elif isinstance(entry, FileMetadata):
+                    files.append(self._entry_info(entry))
             
-            logger.info(f"Extracted {len(text)} characters with PDFMiner")
-            return text
-        except PDFSyntaxError as e:
-            logger.error(f"PDFMiner syntax error: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Error extracting text with PDFMiner: {e}")
-            return None
+            if not result.has_more:
+                break
+            result = self.client.files_list_folder_continue(result.cursor)
+            pages += 1
+        
+        logger.info(f"Dropbox changes: {len(files)} files changed, {len(deleted)} entries deleted "
+                    f"in {pages} pages (reset: {reset})")
+        return {"cursor": result.cursor, "reset": reset, "files": files, "deleted": deleted}
     
-    def _extract_text_from_pdf_with_pypdf(self, file_content):
-        """Extract text from PDF using PyPDF"""
+    def download_bytes(self, path):
+        """Download a file and return its raw content and its metadata; Dropbox errors are raised"""
+        # Ensure path is properly decoded
+        path = unquote(path)
+        logger.info(f"Downloading file: {path}")
         try:
-            if not HAS_PYPDF:
-                return None
-                
-            logger.info("Extracting text from PDF using PyPDF")
-            pdf_file = io.BytesIO(file_content)
-            
-            with pypdf.PdfReader(pdf_file) as pdf:
-                text = ""
-                for page_num in range(len(pdf.pages)):
-                    page = pdf.pages[page_num]
-                    text += page.extract_text() + "\n"
-            
-            # Clean up the text
-            text = text.strip()
-            
-            logger.info(f"Extracted {len(text)} characters with PyPDF")
-            return text
-        except Exception as e:
-            logger.error(f"Error extracting text with PyPDF: {e}")
-            return None
-    
-    def _extract_text_from_pdf(self, file_content):
-        """Extract text from PDF using available methods"""
-        # Try with PDFMiner first (usually better quality)
-        text = self._extract_text_from_pdf_with_pdfminer(file_content)
-        
-        # If PDFMiner failed, try with PyPDF
-        if not text:
-            text = self._extract_text_from_pdf_with_pypdf(file_content)
-            
-        # If we got any text, return it
-        if text and len(text) > 10:  # Ensure we got meaningful text
-            return text
-            
-        # If all methods failed, return a helpful message
-        return "PDF konnte nicht analysiert werden. Möglicherweise ist es gescannt oder passwortgeschützt."
+            metadata, response = self.client.files_download(path)
+        except AuthError:
+            self._valid = False
+            raise
+        return response.content, self._entry_info(metadata)
     
     def download_file(self, path):
         """Download a file and return its content as text"""
+        return self.download_file_with_metadata(path)[0]
+    
+    def download_file_with_metadata(self, path):
+        """Download a file and return its content as text and its metadata (None, None on errors)
+        
+        The metadata dict has the same fields as a list_files entry, including
+        content_hash and rev of the downloaded revision.
+        """
         try:
             # Check if token is valid
-            if not self._valid:
+            if self._valid is False:
                 logger.error("Cannot download file: Dropbox token is invalid")
-                return None
+                return None, None
                 
-            # Ensure path is properly decoded
             path = unquote(path)
-            logger.info(f"Downloading file: {path}")
-            metadata, response = self.client.files_download(path)
-            content = response.content
-            
-            # Check file extension
-            is_pdf = path.lower().endswith('.pdf')
-            
-            # If it's a PDF, extract text
-            if is_pdf:
-                logger.info(f"File is a PDF, extracting text")
-                extracted_text = self._extract_text_from_pdf(content)
-                if extracted_text:
-                    logger.info(f"Successfully extracted text from PDF, size: {len(extracted_text)} bytes")
-                    return extracted_text
-                else:
-                    logger.warning(f"Failed to extract text from PDF")
-            
-            # Try to decode as text if not a PDF or if PDF extraction failed
-            try:
-                text_content = content.decode('utf-8')
-                logger.info(f"File decoded as UTF-8, size: {len(text_content)} bytes")
-                return text_content
-            except UnicodeDecodeError:
-                # If UTF-8 decoding fails, try other encodings
-                logger.warning(f"UTF-8 decoding failed for file: {path}")
-                
-                # Try common encodings
-                for encoding in ['latin-1', 'cp1252', 'iso-8859-1']:
-                    try:
-                        text_content = content.decode(encoding)
-                        logger.info(f"File decoded as {encoding}, size: {len(text_content)} bytes")
-                        return text_content
-                    except UnicodeDecodeError:
-                        continue
-                
-                # If all decodings fail and it's not a PDF, return a useful message
-                if not is_pdf:
-                    logger.warning(f"All text decodings failed for non-PDF file")
-                    return "Dieser Dateityp kann nicht als Text angezeigt werden."
-                else:
-                    # This should never happen as we already tried PDF extraction above
-                    logger.warning(f"Both PDF extraction and text decoding failed")
-                    return "PDF-Extraktion fehlgeschlagen. Die Datei ist möglicherweise beschädigt oder passwortgeschützt."
-                    
+            content, metadata = self.download_bytes(path)
+            return extract_text(path, content), metadata
         except AuthError as e:
             logger.error(f"Dropbox authentication error downloading file: {e}")
             self._valid = False
-            return None
+            return None, None
         except ApiError as e:
             logger.error(f"Dropbox API error downloading file: {e}")
-            return None
+            return None, None
         except Exception as e:
             logger.error(f"Error downloading file: {e}")
-            return None
-
+            return None, None
+    
     def get_token_info(self):
         """Get information about the current access token"""
         try:
@@ -269,7 +357,7 @@ class DropboxService:
         """Debug method to directly list root folder contents"""
         try:
             # Check if token is valid
-            if not self._valid:
+            if self._valid is False:
                 logger.error("Cannot debug list root: Dropbox token is invalid")
                 return []
                 
@@ -0,0 +1,270 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app.services.dropbox_service import extract_text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Parallel Dropbox downloads (network bound)
+INDEX_DOWNLOAD_WORKERS = int(os.getenv("INDEX_DOWNLOAD_WORKERS", "8"))
+# Processes for PDF text extraction (CPU bound); 0 extracts in a thread of this process
+INDEX_EXTRACT_WORKERS = int(os.getenv("INDEX_EXTRACT_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# Chunks collected across documents before the embedding model is called
+INDEX_EMBED_BATCH_CHUNKS = int(os.getenv("INDEX_EMBED_BATCH_CHUNKS", "256"))
+# Parallel Qdrant upserts (network bound)
+INDEX_UPSERT_WORKERS = int(os.getenv("INDEX_UPSERT_WORKERS", "2"))
+# Capacity of each queue between two stages; a full queue blocks the stage before it
+INDEX_QUEUE_SIZE = int(os.getenv("INDEX_QUEUE_SIZE", "16"))
+
+# Same minimum as POST /api/documents/index
+MIN_CONTENT_LENGTH = 10
+
+# Marks the end of the input of a stage
+_DONE = object()
+
+
+class IndexingPipeline:
+    """Indexes many Dropbox documents concurrently in four stages
+
+    download (thread pool) -> extract (process pool for PDFs) -> embed (one
+    thread, batches chunks across documents) -> upsert (thread pool)
+
+    The stages are connected by bounded queues, so a slow stage throttles the
+    ones before it instead of letting downloaded files pile up in memory.
+    Documents whose Dropbox content hash is already indexed are skipped
+    before they are downloaded. Every document ends up in exactly one result.
+    """
+
+    def __init__(self, dropbox_service, qdrant_service,
+                 download_workers: int = INDEX_DOWNLOAD_WORKERS,
+                 extract_workers: int = INDEX_EXTRACT_WORKERS,
+                 embed_batch_chunks: int = INDEX_EMBED_BATCH_CHUNKS,
+                 upsert_workers: int = INDEX_UPSERT_WORKERS,
+                 queue_size: int = INDEX_QUEUE_SIZE):
+        self.dropbox_service = dropbox_service
+        self.qdrant_service = qdrant_service
+        self.download_workers = max(1, download_workers)
+        self.extract_workers = max(0, extract_workers)
+        self.embed_batch_chunks = max(1, embed_batch_chunks)
+        self.upsert_workers = max(1, upsert_workers)
+        self.queue_size = max(1, queue_size)
+
+        self._results = {}
+        self._results_lock = threading.Lock()
+        self._stage_seconds = {"download": 0.0, "extract": 0.0, "embed": 0.0, "upsert": 0.0}
+
+    def run(self, documents: Iterable[Tuple[str, Optional[str]]]) -> Dict[str, Dict[str, Any]]:
+        """Index (document_id, content_hash) pairs and return a result per document ID
+
+        content_hash is the Dropbox content hash the caller expects, or None to
+        index the document regardless of what is stored. Each result has
+        "success", "skipped", "content_hash" and "rev", and "error" on failure.
+        """
+        started = time.perf_counter()
+        self._results = {}
+        self._stage_seconds = dict.fromkeys(self._stage_seconds, 0.0)
+
+        jobs = queue.Queue(self.queue_size)
+        downloaded = queue.Queue(self.queue_size)
+        extracted = queue.Queue(self.queue_size)
+        embedded = queue.Queue(self.queue_size)
+
+        pool = None
+        if self.extract_workers:
+            # spawn instead of fork: the embedding model and the stage threads are already running
+            pool = ProcessPoolExecutor(self.extract_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        stages = [
+            self._start_stage("download", self._download, jobs, downloaded, self.download_workers),
+            self._start_stage("extract", lambda item: self._extract(item, pool), downloaded, extracted,
+                              self.extract_workers or 1),
+            self._start_embed_stage(extracted, embedded),
+            self._start_stage("upsert", self._upsert, embedded, None, self.upsert_workers),
+        ]
+
+        count = 0
+        try:
+            for document_id, content_hash in documents:
+                # Blocks while the download stage is busy
+                jobs.put({"document_id": document_id.lstrip("/"), "expected_hash": content_hash})
+                count += 1
+        finally:
+            jobs.put(_DONE)
+            for stage in stages:
+                stage.join()
+            if pool is not None:
+                pool.shutdown()
+            self.qdrant_service.lexical_index.flush()
+
+        elapsed = time.perf_counter() - started
+        indexed = sum(1 for result in self._results.values() if result["success"] and not result["skipped"])
+        skipped = sum(1 for result in self._results.values() if result["skipped"])
+        failed = sum(1 for result in self._results.values() if not result["success"])
+        stage_times = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self._stage_seconds.items())
+        logger.info(f"Indexed {indexed} of {count} documents in {elapsed:.1f}s "
+                    f"({skipped} unchanged, {failed} failed); time spent per stage: {stage_times}")
+        return self._results
+
+    def _start_stage(self, name, func, in_queue, out_queue, workers) -> threading.Thread:
+        """Run func on every item of in_queue in worker threads, passing non-None results on"""
+        def worker():
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    # Let the other workers of this stage see the end marker as well
+                    in_queue.put(_DONE)
+                    return
+                stage_started = time.perf_counter()
+                try:
+                    result = func(item)
+                except Exception as e:
+                    logger.error(f"Error in {name} stage for {item['document_id']}: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    self._fail(item, f"{name}: {str(e)}")
+                    result = None
+                self._add_stage_time(name, time.perf_counter() - stage_started)
+                if result is not None and out_queue is not None:
+                    out_queue.put(result)
+
+        def coordinator():
+            threads = [threading.Thread(target=worker, name=f"index-{name}-{i}", daemon=True) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if out_queue is not None:
+                out_queue.put(_DONE)
+
+        stage = threading.Thread(target=coordinator, name=f"index-{name}", daemon=True)
+        stage.start()
+        return stage
+
+    def _start_embed_stage(self, in_queue, out_queue) -> threading.Thread:
+        """Embed documents in batches of about embed_batch_chunks chunks"""
+        def worker():
+            done = False
+            while not done:
+                # Wait for one document, then take whatever else is ready up to the batch size
+                batch = []
+                chunk_count = 0
+                item = in_queue.get()
+                while True:
+                    if item is _DONE:
+                        done = True
+                        break
+                    batch.append(item)
+                    chunk_count += len(item["chunks"])
+                    if chunk_count >= self.embed_batch_chunks:
+                        break
+                    try:
+                        item = in_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._embed(batch, chunk_count, out_queue)
+            out_queue.put(_DONE)
+
+        stage = threading.Thread(target=worker, name="index-embed", daemon=True)
+        stage.start()
+        return stage
+
+    def _download(self, item):
+        """Skip unchanged documents, download the others"""
+        document_id = item["document_id"]
+        if item["expected_hash"]:
+            indexed = self.qdrant_service.get_indexed_document(document_id)
+            if indexed and indexed.get("dropbox_content_hash") == item["expected_hash"]:
+                logger.info(f"Document unchanged since it was indexed, skipping: {document_id}")
+                self._finish(item, success=True, skipped=True,
+                             content_hash=item["expected_hash"], rev=indexed.get("dropbox_rev"))
+                return None
+
+        item["content"], item["metadata"] = self.dropbox_service.download_bytes(f"/{document_id}")
+        return item
+
+    def _extract(self, item, pool):
+        """Extract the text, PDFs in the process pool"""
+        path = f"/{item['document_id']}"
+        content = item.pop("content")
+        if pool is not None and path.lower().endswith(".pdf"):
+            # Waiting here keeps at most one PDF per extract thread in the pool
+            text = pool.submit(extract_text, path, content).result()
+        else:
+            text = extract_text(path, content)
+
+        text = (text or "").strip()
+        if len(text) < MIN_CONTENT_LENGTH:
+            self._fail(item, "document content too short to index")
+            return None
+
+        item["text"] = text
+        item["chunks"] = self.qdrant_service.chunk_document(text)
+        if not item["chunks"]:
+            self._fail(item, "no valid chunks generated")
+            return None
+        return item
+
+    def _embed(self, batch: List[Dict[str, Any]], chunk_count: int, out_queue):
+        started = time.perf_counter()
+        try:
+            embeddings = self.qdrant_service.embed_documents([[chunk for _, chunk in item["chunks"]] for item in batch])
+        except Exception as e:
+            logger.error(f"Error embedding {chunk_count} chunks of {len(batch)} documents: {str(e)}")
+            logger.error(traceback.format_exc())
+            for item in batch:
+                self._fail(item, f"embed: {str(e)}")
+            return
+        finally:
+            self._add_stage_time("embed", time.perf_counter() - started)
+
+        logger.info(f"Embedded {chunk_count} chunks of {len(batch)} documents")
+        for item, document_embeddings in zip(batch, embeddings):
+            item["embeddings"] = document_embeddings
+            # Blocks while the upsert stage is busy
+            out_queue.put(item)
+
+    def _upsert(self, item):
+        document_id = item["document_id"]
+        metadata = item["metadata"]
+        success = self.qdrant_service.store_document(
+            document_id=document_id,
+            document_path=f"/{document_id}",
+            document_name=document_id.rsplit("/", 1)[-1],
+            document_content=item["text"],
+            indexed_chunks=item["chunks"],
+            embeddings=item["embeddings"],
+            dropbox_content_hash=metadata.get("content_hash"),
+            dropbox_rev=metadata.get("rev")
+        )
+        if success:
+            self._finish(item, success=True, skipped=False,
+                         content_hash=metadata.get("content_hash"), rev=metadata.get("rev"))
+        else:
+            self._fail(item, "not all points stored")
+        return None
+
+    def _finish(self, item, **result):
+        with self._results_lock:
+            self._results[item["document_id"]] = result
+
+    def _fail(self, item, error):
+        logger.error(f"Failed to index {item['document_id']}: {error}")
+        self._finish(item, success=False, skipped=False, content_hash=None, rev=None, error=error)
+
+    def _add_stage_time(self, name, seconds):
+        with self._results_lock:
+            self._stage_seconds[name] += seconds
@@ -2,10 +2,22 @@ import os
 import httpx
 import json
 import logging
-import re
 import time
 import asyncio
+import hashlib
 from dotenv import load_dotenv
+from app.services.cache import SemanticAnswerCache
+from app.services.circuit_breaker import CircuitBreaker
+from app.services.context_builder import ContextBuilder
+from app.services.output_cleaner import EMPTY_ANSWER, StreamCleaner, clean_output
+from app.services.concurrency import ClientDisconnected, ConcurrencyLimiter, SingleFlight
+
+# HTTP/2 für RunPod-Aufrufe, falls das h2-Paket installiert ist
+try:
+    import h2  # noqa: F401
+    HAS_H2 = True
+except ImportError:
+    HAS_H2 = False
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +30,54 @@ load_dotenv()
 RUNPOD_API_URL = os.getenv("RUNPOD_API_URL")
 RUNPOD_API_KEY = os.getenv("RUNPOD_API_KEY")
 
+# Streaming über RunPods /run- und /stream-Endpunkte
+RUNPOD_STREAM_POLL_INTERVAL = float(os.getenv("RUNPOD_STREAM_POLL_INTERVAL", "0.2"))
+RUNPOD_FINAL_STATES = ("COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT")
+
+# Job-Modus: /run + /status statt blockierendem /runsync
+RUNPOD_MODE = os.getenv("RUNPOD_MODE", "job").lower()
+RUNPOD_JOB_TIMEOUT = float(os.getenv("RUNPOD_JOB_TIMEOUT", "300"))
+RUNPOD_POLL_INTERVAL_MIN = float(os.getenv("RUNPOD_POLL_INTERVAL_MIN", "0.5"))
+RUNPOD_POLL_INTERVAL_MAX = float(os.getenv("RUNPOD_POLL_INTERVAL_MAX", "5"))
+RUNPOD_POLL_BACKOFF = float(os.getenv("RUNPOD_POLL_BACKOFF", "1.5"))
+
+RUNPOD_TIMEOUT_MESSAGE = (
+    "Der RunPod-Server hat nicht rechtzeitig geantwortet. Mögliche Ursachen:\n"
+    "1. Der Server ist überlastet\n"
+    "2. Die serverlose Instanz wurde gestoppt\n"
+    "3. Die Anfrage ist zu komplex\n\n"
+    "Bitte versuchen Sie es mit einer kürzeren Frage oder prüfen Sie den Status Ihres RunPod-Endpunkts."
+)
+
+# Verbindungspool für RunPod
+RUNPOD_MAX_CONNECTIONS = int(os.getenv("RUNPOD_MAX_CONNECTIONS", "20"))
+RUNPOD_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("RUNPOD_MAX_KEEPALIVE_CONNECTIONS", "10"))
+RUNPOD_KEEPALIVE_EXPIRY = float(os.getenv("RUNPOD_KEEPALIVE_EXPIRY", "60"))
+RUNPOD_HTTP2 = os.getenv("RUNPOD_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# Begrenzung gleichzeitiger RunPod-Anfragen
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))
+# Reihenfolge in der Warteschlange (kleiner zuerst): wer auf die ganze Antwort wartet,
+# vor Streams, die einen Slot lange belegen, vor Diagnoseaufrufen
+LLM_PRIORITY_SEARCH = 0
+LLM_PRIORITY_STREAM = 1
+LLM_PRIORITY_BACKGROUND = 2
+
+# Circuit Breaker: bei Ausfall oder Überlastung von RunPod sofort auf die Fallback-Antwort umschalten
+LLM_CIRCUIT_FAILURE_RATE = float(os.getenv("LLM_CIRCUIT_FAILURE_RATE", "0.5"))
+LLM_CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("LLM_CIRCUIT_SLOW_CALL_SECONDS", "60"))
+LLM_CIRCUIT_SLOW_CALL_RATE = float(os.getenv("LLM_CIRCUIT_SLOW_CALL_RATE", "0.8"))
+LLM_CIRCUIT_WINDOW = int(os.getenv("LLM_CIRCUIT_WINDOW", "20"))
+LLM_CIRCUIT_MIN_CALLS = int(os.getenv("LLM_CIRCUIT_MIN_CALLS", "5"))
+LLM_CIRCUIT_OPEN_SECONDS = float(os.getenv("LLM_CIRCUIT_OPEN_SECONDS", "30"))
+LLM_CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("LLM_CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+# Semantischer Antwort-Cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.9"))
+
 class LLMService:
     def __init__(self):
         self.api_url = RUNPOD_API_URL
@@ -31,90 +91,86 @@ class LLMService:
         self.timeout = 60.0  # Timeout in Sekunden (reduziert von 120)
         self.max_retries = 2  # Maximale Anzahl von Wiederholungsversuchen
         self.retry_delay = 2  # Verzögerung zwischen Wiederholungsversuchen in Sekunden
+        self.mode = RUNPOD_MODE  # "job" (/run + /status) oder "sync" (/runsync)
+        
+        # Langlebiger HTTP-Client, wird beim ersten Aufruf oder in startup() erstellt
+        self._client = None
+        self.http2 = RUNPOD_HTTP2 and HAS_H2
+        self.limits = httpx.Limits(
+            max_connections=RUNPOD_MAX_CONNECTIONS,
+            max_keepalive_connections=RUNPOD_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=RUNPOD_KEEPALIVE_EXPIRY
+        )
+        
+        self.single_flight = SingleFlight()
+        # Im Hintergrund laufende Job-Abbrüche, referenziert bis sie fertig sind
+        self._background_tasks = set()
+        # Laufende RunPod-Jobs je Prompt-Hash: job_id und Frist, damit eine Wiederholung den Job weiter abfragt
+        self._jobs = {}
+        self.limiter = ConcurrencyLimiter(max_concurrent=LLM_MAX_CONCURRENT, max_queue=LLM_MAX_QUEUE)
+        self.circuit_breaker = CircuitBreaker(
+            "runpod",
+            failure_rate_threshold=LLM_CIRCUIT_FAILURE_RATE,
+            slow_call_duration=LLM_CIRCUIT_SLOW_CALL_SECONDS,
+            slow_call_rate_threshold=LLM_CIRCUIT_SLOW_CALL_RATE,
+            window_size=LLM_CIRCUIT_WINDOW,
+            minimum_calls=LLM_CIRCUIT_MIN_CALLS,
+            open_duration=LLM_CIRCUIT_OPEN_SECONDS,
+            half_open_max_calls=LLM_CIRCUIT_HALF_OPEN_CALLS
+        )
+        
+        # Kontext nach Token-Budget des Zielmodells zusammenstellen
+        self.context_builder = ContextBuilder()
+        
+        self.answer_cache = SemanticAnswerCache(
+            maxsize=ANSWER_CACHE_SIZE,
+            ttl=ANSWER_CACHE_TTL,
+            similarity_threshold=ANSWER_CACHE_SIMILARITY
+        )
         
         logger.info(f"LLM Service initialized with URL: {self.api_url}")
         logger.info(f"RunPod API Key set: {bool(RUNPOD_API_KEY)}")
-        logger.info(f"Timeout: {self.timeout}s, Max retries: {self.max_retries}")
+        logger.info(f"Timeout: {self.timeout}s, Max retries: {self.max_retries}, Mode: {self.mode}")
+    
+    def _get_client(self):
+        """Return the shared HTTP client, creating it on first use"""
+        if self._client is None or self._client.is_closed:
+            logger.info(f"Creating RunPod HTTP client (HTTP/2: {self.http2}, limits: {self.limits})")
+            self._client = httpx.AsyncClient(
+                limits=self.limits,
+                http2=self.http2,
+                timeout=self.timeout
+            )
+        return self._client
+    
+    def warm_up(self):
+        """Load the tokenizer of the context builder, called in a worker thread at startup"""
+        logger.info(f"Context token counting: {self.context_builder.counter.name}")
+    
+    async def startup(self):
+        """Create the connection pool when the application starts"""
+        self._get_client()
+    
+    async def aclose(self):
+        """Close the connection pool when the application shuts down"""
+        if self._background_tasks:
+            # Ausstehende Job-Abbrüche noch abschicken
+            await asyncio.wait(self._background_tasks, timeout=10.0)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
     def _clean_output(self, text):
         """Bereinigt die Ausgabe des Modells von internen Gedankengängen und Artefakten"""
         # Wenn der Text None oder leer ist, frühzeitig zurückkehren
         if not text:
-            return "Keine Antwort vom LLM erhalten."
+            return EMPTY_ANSWER
             
         # Debug-Log der Rohausgabe
         logger.info(f"Rohausgabe vom LLM (erste 200 Zeichen): {text[:200]}")
         
-        # Erkennung und Entfernung von strukturierten Artefakten
-        # Entferne COVID-Info-Tags und andere spezielle Markierungen
-        covid_patterns = [
-            r'\[/?covidInfo\].*?(?:\n|$)',
-            r'_\s*COVID-19-INFO:.*?(?:\n|$)',
-            r'\[bonusInformationen\..*?\]',
-            r'Ergibt die Zusammenfassung der Datenschutz-Grundverord.*'
-        ]
-        for pattern in covid_patterns:
-            text = re.sub(pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-        
-        # Entferne alle bekannten Gedankengangsmuster
-        thought_patterns = [
-            r"Der Nutzer[^\n]*\n",
-            r"Okay, (?:so )?I need to.*?First,",
-            r"Okay, ich muss.*?\n",
-            r"Um das zu erreichen.*?\n",
-            r"I need to.*?\n",
-            r"I already know that.*?\n",
-            r"First,.*?\n",
-            r"Let me analyze.*?\n",
-            r"Let's look at.*?\n",
-            r"Based on the.*?\n",
-            r"Looking at the.*?\n",
-        ]
-        
-        for pattern in thought_patterns:
-            text = re.sub(pattern, "", text, flags=re.DOTALL)
-        
-        # Entferne Anführungszeichen am Anfang und Ende
-        text = re.sub(r'^\s*["\']', '', text)
-        text = re.sub(r'["\']\s*$', '', text)
-        
-        # Entferne Metainformationen
-        text = re.sub(r"ANFRAGE:|ANTWORT:|Anfrage:|Antwort:", "", text)
-        
-        # Verarbeite bestimmte Sonderfälle
-        if "Berlin" in text and len(text) < 100:
-            return "Die Hauptstadt von Deutschland ist Berlin."
-        
-        # Entferne übermäßige Leerzeichen und Zeilenumbrüche
-        text = re.sub(r'\n{3,}', '\n\n', text)
-        text = re.sub(r'\s{2,}', ' ', text)
-        
-        # Schneidet die Antwort ab, wenn spezielle Marker gefunden werden
-        lines = text.split('\n')
-        cleaned_lines = []
-        
-        for line in lines:
-            # Abbruch, wenn eine der folgenden Markierungen gefunden wird
-            if any(marker in line for marker in [
-                '[', ']', 'covid', 'COVID', 'bonus', 'Bonus', 
-                'Datenschutz', 'Verord', '---', '***', '///', '###'
-            ]):
-                # Stoppe, wenn solche Marker gefunden werden
-                break
-            cleaned_lines.append(line)
-        
-        # Bereinigten Text wieder zusammenfügen
-        cleaned_text = '\n'.join(cleaned_lines).strip()
-        
-        # Als Fallback: Wenn der Text zu kurz ist nach der Bereinigung, 
-        # versuche nur den ersten Satz zu extrahieren
-        if len(cleaned_text) < 20 and len(text) > 30:
-            # Extrahiere den ersten Satz, der sinnvoll erscheint
-            sentences = re.split(r'(?<=[.!?])\s+', text)
-            for sentence in sentences:
-                if len(sentence) > 15 and not any(marker in sentence for marker in ['[', ']', 'covid', 'COVID']):
-                    cleaned_text = sentence
-                    break
+        # Vorkompilierte Muster, siehe app/services/output_cleaner.py
+        cleaned_text = clean_output(text)
         
         # Debug-Log der bereinigten Ausgabe
         logger.info(f"Bereinigte Ausgabe (erste 200 Zeichen): {cleaned_text[:200]}")
@@ -124,7 +180,7 @@ class LLMService:
     def _validate_response(self, text):
         """Überprüft die bereinigte Antwort auf Probleme"""
         if not text or text.strip() == "":
-            return "Keine Antwort vom LLM erhalten."
+            return EMPTY_ANSWER
             
         # Prüfe auf unvollständige JSON-Strukturen
         if text.startswith("{") and not text.endswith("}"):
@@ -138,14 +194,17 @@ class LLMService:
         
         return text
     
-    async def generate_answer(self, query, context):
-        """Generate an answer using the LLM with the given context"""
-        logger.info(f"Generating answer for query: {query[:50]}...")
+    def _finish_answer(self, text):
+        """Clean and validate the raw model output, return (answer, success)
         
-        if not RUNPOD_API_KEY:
-            logger.error("Cannot generate answer: RUNPOD_API_KEY is not set")
-            return "Fehler: RunPod API-Key fehlt. Bitte konfiguriere den API-Key in der .env-Datei."
-            
+        Only an answer that passed validation unchanged counts as success and may be cached.
+        """
+        cleaned_text = self._clean_output(text)
+        validated_text = self._validate_response(cleaned_text)
+        return validated_text, validated_text is cleaned_text and cleaned_text != EMPTY_ANSWER
+    
+    def _build_payload(self, query, context, stream=False):
+        """Build the RunPod request payload for a question and its context"""
         # Optimiertes Prompt-Format für DeepSeek
         prompt = f"""Du bist ein präziser Assistent für ein Immobilienunternehmen. Du hilfst bei der Analyse von Immobiliendokumenten wie Mietverträgen, Kaufverträgen und Darlehensverträgen. Antworte in gutem Deutsch, direkt und ohne Gedankengänge. Füge keine zusätzlichen Informationen, Hinweise oder Tags hinzu.
 
@@ -173,84 +232,442 @@ ANTWORT:"""
             }
         }
         
-        # Wiederholungslogik für Anfragen
-        for attempt in range(self.max_retries + 1):
+        if stream:
+            # Der RunPod-Worker liefert die Tokens dann schrittweise über /stream
+            payload["input"]["stream"] = True
+        
+        return payload
+    
+    async def generate_answer(self, query, context, query_embedding=None, chunk_ids=None, document_ids=None,
+                              is_disconnected=None, priority=LLM_PRIORITY_SEARCH):
+        """Generate an answer using the LLM with the given context
+        
+        If the query embedding and the IDs of the retrieved chunks are given, the
+        semantic answer cache is consulted first and successful answers are stored.
+        In job mode, is_disconnected (an async callable) is polled to cancel the
+        RunPod job when the client goes away; ClientDisconnected is raised then.
+        Requests wait for a free RunPod slot in priority order (lower first);
+        LLMBusyError is raised when the queue is full, CircuitOpenError while
+        the RunPod circuit is open.
+        """
+        logger.info(f"Generating answer for query: {query[:50]}...")
+        
+        if not RUNPOD_API_KEY:
+            logger.error("Cannot generate answer: RUNPOD_API_KEY is not set")
+            return "Fehler: RunPod API-Key fehlt. Bitte konfiguriere den API-Key in der .env-Datei."
+            
+        # Semantischer Antwort-Cache: gleiche Chunks und ähnliche Frage liefern die gespeicherte Antwort
+        use_cache = query_embedding is not None and bool(chunk_ids)
+        if use_cache:
+            cached_answer = self.answer_cache.lookup(query_embedding, chunk_ids)
+            if cached_answer is not None:
+                logger.info("Serving answer from semantic answer cache")
+                return cached_answer
+        
+        payload = self._build_payload(query, context)
+        
+        # Gleichzeitige Anfragen mit identischem Prompt teilen sich einen RunPod-Aufruf
+        prompt_hash = self._payload_hash(payload)
+        (answer, success), shared = await self.single_flight.do(
+            prompt_hash,
+            lambda all_disconnected: self._request(payload, all_disconnected, priority),
+            is_disconnected
+        )
+        
+        # Nur erfolgreiche Antworten cachen, keine Fehlermeldungen; geteilte Antworten speichert der erste Aufrufer
+        if success and use_cache and not shared:
+            self.answer_cache.store(query_embedding, chunk_ids, document_ids or [], answer)
+        
+        return answer
+    
+    @staticmethod
+    def _payload_hash(payload):
+        """Hash identifying identical RunPod requests"""
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+    
+    def _endpoint_url(self, action):
+        """Build the URL of another endpoint action (run, stream/<id>, ...) from RUNPOD_API_URL"""
+        base_url = self.api_url.rstrip("/")
+        if base_url.rsplit("/", 1)[-1] in ("runsync", "run"):
+            base_url = base_url.rsplit("/", 1)[0]
+        return f"{base_url}/{action}"
+    
+    async def _submit_job(self, payload):
+        """Submit an asynchronous RunPod job via /run and return its ID"""
+        response = await self._get_client().post(
+            self._endpoint_url("run"),
+            json=payload,
+            headers=self.headers,
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        job_id = response.json()["id"]
+        logger.info(f"Submitted RunPod job {job_id}")
+        return job_id
+    
+    async def _request(self, payload, is_disconnected=None, priority=0):
+        """Send the payload in the configured mode once a RunPod slot is free, return (answer, success)"""
+        # Bei offenem Circuit gar nicht erst in die Warteschlange
+        self.circuit_breaker.check()
+        async with self.limiter.slot(priority):
+            # Erneut prüfen: während der Wartezeit kann der Circuit geöffnet worden sein
+            probe = self.circuit_breaker.before_call()
+            started = time.monotonic()
             try:
-                logger.info(f"Attempt {attempt+1}/{self.max_retries+1}: Sending request to LLM API")
+                if self.mode == "job":
+                    answer, success, completed = await self._request_answer_job(payload, is_disconnected)
+                else:
+                    answer, success, completed = await self._request_answer(payload)
+            except (asyncio.CancelledError, ClientDisconnected):
+                # Abbruch durch den Client sagt nichts über RunPods Zustand aus
+                self.circuit_breaker.abandon(probe)
+                raise
+            except Exception:
+                self.circuit_breaker.record(False, time.monotonic() - started, probe)
+                raise
+            # Der Circuit bewertet nur, ob RunPod geantwortet hat; eine zu kurze oder
+            # verworfene Antwort ist kein Ausfall und wird lediglich nicht gecacht
+            self.circuit_breaker.record(completed, time.monotonic() - started, probe)
+            return answer, success
+    
+    async def _cancel_job(self, job_id):
+        """Cancel a RunPod job so that it does not keep the GPU busy"""
+        try:
+            await self._get_client().post(
+                self._endpoint_url(f"cancel/{job_id}"),
+                headers=self.headers,
+                timeout=10.0
+            )
+            logger.info(f"Cancelled RunPod job {job_id}")
+        except Exception as e:
+            logger.warning(f"Could not cancel RunPod job {job_id}: {e}")
+    
+    def _cancel_job_in_background(self, job_id):
+        """Cancel a job in a separate task
+        
+        Called from finally blocks that may run in a cancelled task (client
+        disconnect); awaiting the /cancel request there would cancel it too.
+        """
+        task = asyncio.ensure_future(self._cancel_job(job_id))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _run_job(self, payload, is_disconnected=None):
+        """Submit a job via /run and poll /status until it reaches a final state
+        
+        Polling backs off while the job waits in the queue (cold start) and gets
+        faster once it runs. Submitting is only retried when the request cannot
+        have reached RunPod (connection errors); if the response to /run is lost,
+        the error is raised rather than risking a second generation. Failed
+        status requests are retried against the same job, and if they keep
+        failing the job is left running and remembered by its prompt hash, so a
+        retry of the same request polls that job instead of submitting a new one.
+        The job is cancelled if the client disconnects, the task is cancelled or
+        RUNPOD_JOB_TIMEOUT is exceeded. Returns the final status response.
+        """
+        key = self._payload_hash(payload)
+        job = self._jobs.get(key)
+        if job is not None and time.monotonic() < job["deadline"]:
+            job_id, deadline = job["job_id"], job["deadline"]
+            logger.info(f"Resuming in-flight RunPod job {job_id}")
+        else:
+            job_id = None
+            for attempt in range(self.max_retries + 1):
+                try:
+                    job_id = await self._submit_job(payload)
+                    break
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                    # Die Anfrage ist nicht bei RunPod angekommen, erneutes Einreichen ist sicher
+                    logger.warning(f"Submitting RunPod job failed (attempt {attempt+1}/{self.max_retries+1}): {e}")
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self.retry_delay)
+            now = time.monotonic()
+            deadline = now + RUNPOD_JOB_TIMEOUT
+            # Abgelaufene Einträge entfernen, ihre Jobs hat RunPod inzwischen beendet
+            self._jobs = {k: j for k, j in self._jobs.items() if j["deadline"] > now}
+            self._jobs[key] = {"job_id": job_id, "deadline": deadline}
+        
+        client = self._get_client()
+        interval = RUNPOD_POLL_INTERVAL_MIN
+        status_errors = 0
+        finished = False
+        resumable = False
+        try:
+            while True:
+                if is_disconnected is not None and await is_disconnected():
+                    logger.info(f"Client disconnected, cancelling RunPod job {job_id}")
+                    raise ClientDisconnected(f"Client disconnected while RunPod job {job_id} was running")
+                if time.monotonic() > deadline:
+                    raise httpx.TimeoutException(f"RunPod job {job_id} did not finish within {RUNPOD_JOB_TIMEOUT}s")
                 
-                async with httpx.AsyncClient() as client:
-                    # Mit anpassbarem Timeout
-                    response = await client.post(
-                        self.api_url,
-                        json=payload,
+                await asyncio.sleep(interval)
+                
+                try:
+                    response = await client.get(
+                        self._endpoint_url(f"status/{job_id}"),
                         headers=self.headers,
                         timeout=self.timeout
                     )
+                    response.raise_for_status()
+                    result = response.json()
+                    status_errors = 0
+                except (httpx.HTTPError, ValueError) as e:
+                    # Nur den Status erneut abfragen, den Job nicht neu einreichen
+                    status_errors += 1
+                    logger.warning(f"Status request for RunPod job {job_id} failed ({status_errors}/{self.max_retries}): {e}")
+                    if status_errors > self.max_retries:
+                        # Der Job läuft vermutlich weiter; eine Wiederholung fragt ihn erneut ab
+                        resumable = True
+                        raise
+                    interval = min(interval * 2, RUNPOD_POLL_INTERVAL_MAX)
+                    continue
+                
+                status = result.get("status")
+                if status in RUNPOD_FINAL_STATES:
+                    finished = True
+                    logger.info(f"RunPod job {job_id} finished with status {status}")
+                    return result
+                
+                # In der Warteschlange (Kaltstart) seltener abfragen, während der Generierung häufiger
+                if status == "IN_QUEUE":
+                    interval = min(interval * RUNPOD_POLL_BACKOFF, RUNPOD_POLL_INTERVAL_MAX)
+                else:
+                    interval = RUNPOD_POLL_INTERVAL_MIN
+        finally:
+            if not resumable and self._jobs.get(key, {}).get("job_id") == job_id:
+                del self._jobs[key]
+            if not finished and not resumable:
+                self._cancel_job_in_background(job_id)
+    
+    async def _request_answer_job(self, payload, is_disconnected=None):
+        """Run the payload as a RunPod job, return (answer, success, completed)
+        
+        completed tells whether RunPod finished the job, regardless of whether the
+        answer passed validation; only that is reported to the circuit breaker.
+        """
+        try:
+            result = await self._run_job(payload, is_disconnected)
+        except httpx.TimeoutException as e:
+            logger.error(f"Timeout bei der Anfrage an den LLM: {e}")
+            return RUNPOD_TIMEOUT_MESSAGE, False, False
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            error_message = f"Fehler bei der Kommunikation mit dem LLM: {str(e)}"
+            logger.exception(error_message)
+            return error_message, False, False
+        
+        status = result.get("status")
+        if status != "COMPLETED":
+            logger.error(f"RunPod job ended with status {status}: {result.get('error')}")
+            return f"Der RunPod-Job ist nicht erfolgreich beendet worden (Status: {status}). Bitte versuchen Sie es später erneut.", False, False
+        
+        try:
+            answer, success = self._extract_answer(result)
+            return answer, success, True
+        except Exception as e:
+            logger.exception(f"Error parsing response: {e}")
+            return f"Fehler beim Verarbeiten der LLM-Antwort: {str(e)}", False, True
+    
+    @staticmethod
+    def _extract_stream_text(output):
+        """Extract the generated text from one item of a RunPod /stream response"""
+        if isinstance(output, str):
+            return output
+        if isinstance(output, dict):
+            choices = output.get("choices")
+            if choices:
+                tokens = choices[0].get("tokens")
+                if tokens:
+                    return "".join(tokens)
+                if isinstance(choices[0].get("text"), str):
+                    return choices[0]["text"]
+            for key in ["text", "response", "generated_text", "content", "answer"]:
+                if isinstance(output.get(key), str):
+                    return output[key]
+        return ""
+    
+    async def stream_answer(self, query, context, query_embedding=None, chunk_ids=None, document_ids=None,
+                            priority=LLM_PRIORITY_STREAM):
+        """Stream the answer using RunPod's /run and /stream endpoints
+        
+        Yields {"type": "token", "text": ...} events with cleaned text as it is
+        generated, followed by one {"type": "answer", "answer": ...} event holding
+        the final validated answer. The answer cache and the priority queue are used
+        like in generate_answer; CircuitOpenError is raised before submitting while the RunPod circuit is open.
+        A job that has not finished within RUNPOD_JOB_TIMEOUT is cancelled and
+        httpx.TimeoutException is raised.
+        """
+        logger.info(f"Streaming answer for query: {query[:50]}...")
+        
+        if not RUNPOD_API_KEY:
+            logger.error("Cannot generate answer: RUNPOD_API_KEY is not set")
+            yield {"type": "answer", "answer": "Fehler: RunPod API-Key fehlt. Bitte konfiguriere den API-Key in der .env-Datei."}
+            return
+        
+        use_cache = query_embedding is not None and bool(chunk_ids)
+        if use_cache:
+            cached_answer = self.answer_cache.lookup(query_embedding, chunk_ids)
+            if cached_answer is not None:
+                logger.info("Serving answer from semantic answer cache")
+                yield {"type": "token", "text": cached_answer}
+                yield {"type": "answer", "answer": cached_answer}
+                return
+        
+        payload = self._build_payload(query, context, stream=True)
+        self.circuit_breaker.check()
+        await self.limiter.acquire(priority)
+        try:
+            probe = self.circuit_breaker.before_call()
+        except BaseException:
+            self.limiter.release()
+            raise
+        started = time.monotonic()
+        try:
+            job_id = await self._submit_job(payload)
+        except asyncio.CancelledError:
+            self.circuit_breaker.abandon(probe)
+            self.limiter.release()
+            raise
+        except BaseException:
+            self.circuit_breaker.record(False, time.monotonic() - started, probe)
+            self.limiter.release()
+            raise
+        client = self._get_client()
+        
+        cleaner = StreamCleaner()
+        status = None
+        outcome = None
+        deadline = started + RUNPOD_JOB_TIMEOUT
+        try:
+            while status not in RUNPOD_FINAL_STATES:
+                if time.monotonic() > deadline:
+                    raise httpx.TimeoutException(f"RunPod job {job_id} did not finish within {RUNPOD_JOB_TIMEOUT}s")
+                response = await client.get(
+                    self._endpoint_url(f"stream/{job_id}"),
+                    headers=self.headers,
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+                result = response.json()
+                status = result.get("status")
+            
+                new_text = "".join(self._extract_stream_text(item.get("output")) for item in result.get("stream", []))
+                if new_text:
+                    # Gesendet wird nur, was den bereits gesendeten Text verlängert
+                    cleaned = cleaner.feed(new_text)
+                    if cleaned:
+                        yield {"type": "token", "text": cleaned}
+                elif status not in RUNPOD_FINAL_STATES:
+                    await asyncio.sleep(RUNPOD_STREAM_POLL_INTERVAL)
+            outcome = status == "COMPLETED"
+        except Exception:
+            outcome = False
+            raise
+        finally:
+            self.limiter.release()
+            # Abbruch durch den Client sagt nichts über RunPods Zustand aus
+            if outcome is None:
+                self.circuit_breaker.abandon(probe)
+            else:
+                self.circuit_breaker.record(outcome, time.monotonic() - started, probe)
+            # Bricht der Client die Verbindung ab oder läuft die Frist ab, wird auch der Job abgebrochen
+            if status not in RUNPOD_FINAL_STATES:
+                self._cancel_job_in_background(job_id)
+        
+        if status != "COMPLETED":
+            raise RuntimeError(f"RunPod job {job_id} ended with status {status}")
+        
+        answer, success = self._finish_answer(cleaner.raw_text)
+        if use_cache and success:
+            self.answer_cache.store(query_embedding, chunk_ids, document_ids or [], answer)
+        
+        yield {"type": "answer", "answer": answer}
+    
+    def _extract_answer(self, result):
+        """Extract and clean the answer from a completed RunPod response, return (answer, success)"""
+        # DeepSeek-Format
+        if "output" in result and isinstance(result["output"], list) and len(result["output"]) > 0:
+            output_obj = result["output"][0]
+            
+            if "choices" in output_obj and len(output_obj["choices"]) > 0:
+                if "tokens" in output_obj["choices"][0]:
+                    # Extract text from tokens
+                    text = output_obj["choices"][0]["tokens"][0]
                     
-                    logger.info(f"LLM API response status: {response.status_code}")
+                    # Bereinigung und Validierung
+                    return self._finish_answer(text)
                     
-                    if response.status_code == 200:
-                        try:
-                            result = response.json()
-                            logger.info(f"Response structure: {list(result.keys()) if isinstance(result, dict) else type(result)}")
-                            
-                            # DeepSeek-Format
-                            if "output" in result and isinstance(result["output"], list) and len(result["output"]) > 0:
-                                output_obj = result["output"][0]
-                                
-                                if "choices" in output_obj and len(output_obj["choices"]) > 0:
-                                    if "tokens" in output_obj["choices"][0]:
-                                        # Extract text from tokens
-                                        text = output_obj["choices"][0]["tokens"][0]
-                                        
-                                        # Bereinigung und Validierung
-                                        cleaned_text = self._clean_output(text)
-                                        validated_text = self._validate_response(cleaned_text)
-                                        
-                                        return validated_text
-                                        
-                            # Allgemeine Extraktion als Fallback
-                            if "output" in result:
-                                output = result["output"]
-                                if isinstance(output, str):
-                                    return self._clean_output(output)
-                                elif isinstance(output, dict):
-                                    for key in ["text", "response", "generated_text", "content", "answer"]:
-                                        if key in output and isinstance(output[key], str):
-                                            return self._clean_output(output[key])
-                                return "Konnte keine verwertbare Antwort extrahieren. Bitte versuchen Sie es mit einer anderen Frage."
-                            else:
-                                return f"Unerwartetes Antwortformat. Bitte überprüfen Sie die RunPod-Konfiguration."
-                                
-                        except Exception as e:
-                            logger.exception(f"Error parsing response: {e}")
-                            if attempt < self.max_retries:
-                                logger.info(f"Retrying after parse error...")
-                                await asyncio.sleep(self.retry_delay)
-                                continue
-                            return f"Fehler beim Verarbeiten der LLM-Antwort: {str(e)}"
-                    elif response.status_code == 504 or response.status_code == 503 or response.status_code == 502:
-                        # Gateway Timeout oder Service Unavailable - Wiederholungsversuch
-                        logger.warning(f"Timeout/Service Unavailable (status code {response.status_code}). Retrying...")
-                        if attempt < self.max_retries:
-                            # Warte länger zwischen Wiederholungen bei 504
-                            await asyncio.sleep(self.retry_delay * 2)
-                            continue
-                        return f"Der RunPod-Server brauchte zu lange zum Antworten. Bitte versuchen Sie es später erneut oder prüfen Sie den RunPod-Status."
-                    else:
-                        error_message = f"Fehler beim Zugriff auf das LLM: {response.status_code}"
-                        logger.error(error_message)
-                        if response.content:
-                            logger.error(f"Response content: {response.content}")
+        # Allgemeine Extraktion als Fallback
+        if "output" in result:
+            output = result["output"]
+            if isinstance(output, str):
+                return self._finish_answer(output)
+            elif isinstance(output, dict):
+                for key in ["text", "response", "generated_text", "content", "answer"]:
+                    if key in output and isinstance(output[key], str):
+                        return self._finish_answer(output[key])
+            return "Konnte keine verwertbare Antwort extrahieren. Bitte versuchen Sie es mit einer anderen Frage.", False
+        else:
+            return f"Unerwartetes Antwortformat. Bitte überprüfen Sie die RunPod-Konfiguration.", False
+    
+    async def _request_answer(self, payload):
+        """Send the payload to RunPod with retries, return (answer, success, completed)
+        
+        completed is True once RunPod answered with status 200, see _request_answer_job.
+        """
+        # Wiederholungslogik für Anfragen
+        for attempt in range(self.max_retries + 1):
+            try:
+                logger.info(f"Attempt {attempt+1}/{self.max_retries+1}: Sending request to LLM API")
+                
+                client = self._get_client()
+                # Mit anpassbarem Timeout
+                response = await client.post(
+                    self.api_url,
+                    json=payload,
+                    headers=self.headers,
+                    timeout=self.timeout
+                )
+                
+                logger.info(f"LLM API response status: {response.status_code}")
+                
+                if response.status_code == 200:
+                    try:
+                        result = response.json()
+                        logger.info(f"Response structure: {list(result.keys()) if isinstance(result, dict) else type(result)}")
                         
-                        # Bei anderen Fehlercodes auch wiederholen
+                        answer, success = self._extract_answer(result)
+                        return answer, success, True
+                            
+                    except Exception as e:
+                        logger.exception(f"Error parsing response: {e}")
                         if attempt < self.max_retries:
-                            logger.info(f"Retrying after HTTP error {response.status_code}...")
+                            logger.info(f"Retrying after parse error...")
                             await asyncio.sleep(self.retry_delay)
                             continue
-                        
-                        return error_message
-                
+                        return f"Fehler beim Verarbeiten der LLM-Antwort: {str(e)}", False, True
+                elif response.status_code == 504 or response.status_code == 503 or response.status_code == 502:
+                    # Gateway Timeout oder Service Unavailable - Wiederholungsversuch
+                    logger.warning(f"Timeout/Service Unavailable (status code {response.status_code}). Retrying...")
+                    if attempt < self.max_retries:
+                        # Warte länger zwischen Wiederholungen bei 504
+                        await asyncio.sleep(self.retry_delay * 2)
+                        continue
+                    return f"Der RunPod-Server brauchte zu lange zum Antworten. Bitte versuchen Sie es später erneut oder prüfen Sie den RunPod-Status.", False, False
+                else:
+                    error_message = f"Fehler beim Zugriff auf das LLM: {response.status_code}"
+                    logger.error(error_message)
+                    if response.content:
+                        logger.error(f"Response content: {response.content}")
+                    
+                    # Bei anderen Fehlercodes auch wiederholen
+                    if attempt < self.max_retries:
+                        logger.info(f"Retrying after HTTP error {response.status_code}...")
+                        await asyncio.sleep(self.retry_delay)
+                        continue
+                    
+                    return error_message, False, False
+
             except httpx.TimeoutException:
                 error_message = f"Timeout bei der Anfrage an den LLM (Versuch {attempt+1}/{self.max_retries+1})"
                 logger.error(error_message)
@@ -260,11 +677,7 @@ ANTWORT:"""
                     await asyncio.sleep(self.retry_delay)
                     continue
                 
-                return "Der RunPod-Server hat nicht rechtzeitig geantwortet. Mögliche Ursachen:\n" \
-                       "1. Der Server ist überlastet\n" \
-                       "2. Die serverlose Instanz wurde gestoppt\n" \
-                       "3. Die Anfrage ist zu komplex\n\n" \
-                       "Bitte versuchen Sie es mit einer kürzeren Frage oder prüfen Sie den Status Ihres RunPod-Endpunkts."
+                return RUNPOD_TIMEOUT_MESSAGE, False, False
             
             except Exception as e:
                 error_message = f"Fehler bei der Kommunikation mit dem LLM: {str(e)}"
@@ -275,10 +688,11 @@ ANTWORT:"""
                     await asyncio.sleep(self.retry_delay)
                     continue
                 
-                return error_message
+                return error_message, False, False
             
-    async def debug_api_call(self, test_prompt="Gib mir eine kurze Antwort auf die Frage: Was ist die Hauptstadt von Deutschland?"):
-        """Make a test call to the API for debugging"""
+    async def debug_api_call(self, test_prompt="Gib mir eine kurze Antwort auf die Frage: Was ist die Hauptstadt von Deutschland?",
+                             priority=LLM_PRIORITY_BACKGROUND):
+        """Make a test call to the API for debugging, queued behind user requests"""
         try:
             # Format für DeepSeek
             formatted_prompt = test_prompt
@@ -299,62 +713,63 @@ ANTWORT:"""
             logger.info(f"Debug: Payload: {json.dumps(payload)}")
             
             # Timeout reduziert für Debugging
-            async with httpx.AsyncClient() as client:
-                try:
+            client = self._get_client()
+            try:
+                async with self.limiter.slot(priority):
                     response = await client.post(
                         self.api_url,
                         json=payload,
                         headers=self.headers,
                         timeout=30.0  # Reduzierter Timeout für Debugging
                     )
+                
+                status_code = response.status_code
+                logger.info(f"Debug: Response status: {status_code}")
+                
+                try:
+                    response_json = response.json()
+                    logger.info(f"Debug: Response JSON structure: {list(response_json.keys()) if isinstance(response_json, dict) else type(response_json)}")
+                except Exception as e:
+                    response_json = {"error": f"Failed to parse JSON: {str(e)}"}
+                    logger.error(f"Debug: Failed to parse JSON: {e}")
                     
-                    status_code = response.status_code
-                    logger.info(f"Debug: Response status: {status_code}")
-                    
-                    try:
-                        response_json = response.json()
-                        logger.info(f"Debug: Response JSON structure: {list(response_json.keys()) if isinstance(response_json, dict) else type(response_json)}")
-                    except Exception as e:
-                        response_json = {"error": f"Failed to parse JSON: {str(e)}"}
-                        logger.error(f"Debug: Failed to parse JSON: {e}")
+                raw_content = response.content.decode('utf-8', errors='replace')
+                logger.info(f"Debug: Raw content: {raw_content[:500]}")
+                
+                # Extract and clean text if possible
+                cleaned_text = None
+                try:
+                    if ("output" in response_json and 
+                        isinstance(response_json["output"], list) and 
+                        len(response_json["output"]) > 0 and
+                        "choices" in response_json["output"][0] and
+                        len(response_json["output"][0]["choices"]) > 0 and
+                        "tokens" in response_json["output"][0]["choices"][0]):
                         
-                    raw_content = response.content.decode('utf-8', errors='replace')
-                    logger.info(f"Debug: Raw content: {raw_content[:500]}")
-                    
-                    # Extract and clean text if possible
-                    cleaned_text = None
-                    try:
-                        if ("output" in response_json and 
-                            isinstance(response_json["output"], list) and 
-                            len(response_json["output"]) > 0 and
-                            "choices" in response_json["output"][0] and
-                            len(response_json["output"][0]["choices"]) > 0 and
-                            "tokens" in response_json["output"][0]["choices"][0]):
-                            
-                            raw_text = response_json["output"][0]["choices"][0]["tokens"][0]
-                            cleaned_text = self._clean_output(raw_text)
-                    except Exception as e:
-                        logger.error(f"Error cleaning output: {e}")
-                    
-                    return {
-                        "status_code": status_code,
-                        "response_json": response_json,
-                        "raw_content": raw_content[:1000],  # Begrenzt auf 1000 Zeichen
-                        "request_payload": payload,
-                        "headers": {k: ('***' if k == 'Authorization' else v) for k, v in self.headers.items()},
-                        "api_url": self.api_url,
-                        "cleaned_text": cleaned_text,
-                        "timestamp": time.time()
-                    }
-                except httpx.TimeoutException:
-                    logger.error("Debug: Timeout während des API-Aufrufs")
-                    return {
-                        "error": "Timeout während des API-Aufrufs", 
-                        "api_url": self.api_url,
-                        "request_payload": payload,
-                        "timestamp": time.time()
-                    }
+                        raw_text = response_json["output"][0]["choices"][0]["tokens"][0]
+                        cleaned_text = self._clean_output(raw_text)
+                except Exception as e:
+                    logger.error(f"Error cleaning output: {e}")
                 
+                return {
+                    "status_code": status_code,
+                    "response_json": response_json,
+                    "raw_content": raw_content[:1000],  # Begrenzt auf 1000 Zeichen
+                    "request_payload": payload,
+                    "headers": {k: ('***' if k == 'Authorization' else v) for k, v in self.headers.items()},
+                    "api_url": self.api_url,
+                    "cleaned_text": cleaned_text,
+                    "timestamp": time.time()
+                }
+            except httpx.TimeoutException:
+                logger.error("Debug: Timeout während des API-Aufrufs")
+                return {
+                    "error": "Timeout während des API-Aufrufs", 
+                    "api_url": self.api_url,
+                    "request_payload": payload,
+                    "timestamp": time.time()
+                }
+            
         except Exception as e:
             logger.exception(f"Error in debug API call: {str(e)}")
             return {"error": str(e), "timestamp": time.time()}
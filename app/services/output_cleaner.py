@@ -0,0 +1,154 @@
+import re
+
+EMPTY_ANSWER = "Keine Antwort vom LLM erhalten."
+
+# Artefacts that are removed case-insensitively, in this order. The lazy DOTALL
+# ".*?(?:\n|$)" of the original patterns is written as "[^\n]*\n?", which
+# matches the same text without scanning past the end of the line.
+ARTEFACT_TRIGGER = re.compile(r'covidinfo|covid-19-info:|\[bonusinformationen\.|ergibt die zusammenfassung der datenschutz-grundverord', re.IGNORECASE)
+ARTEFACT_PATTERNS = [
+    re.compile(r'\[/?covidInfo\][^\n]*\n?', re.IGNORECASE),
+    re.compile(r'_\s*COVID-19-INFO:[^\n]*\n?', re.IGNORECASE),
+    re.compile(r'\[bonusInformationen\.[^\]]*\]', re.IGNORECASE),
+]
+# Everything from this sentence on is dropped
+ARTEFACT_TAIL = re.compile(r'Ergibt die Zusammenfassung der Datenschutz-Grundverord', re.IGNORECASE)
+
+# Thought patterns of the model as (literal every match contains, pattern), in this order
+THOUGHT_TRIGGER = re.compile(r"Der Nutzer|Okay, |Um das zu erreichen|I need to|I already know that|First,|Let me analyze|Let's look at|Based on the|Looking at the")
+THOUGHT_PATTERNS = [
+    ("Der Nutzer", re.compile(r"Der Nutzer[^\n]*\n")),
+    ("First,", re.compile(r"Okay, (?:so )?I need to.*?First,", re.DOTALL)),
+    ("Okay, ich muss", re.compile(r"Okay, ich muss[^\n]*\n")),
+    ("Um das zu erreichen", re.compile(r"Um das zu erreichen[^\n]*\n")),
+    ("I need to", re.compile(r"I need to[^\n]*\n")),
+    ("I already know that", re.compile(r"I already know that[^\n]*\n")),
+    ("First,", re.compile(r"First,[^\n]*\n")),
+    ("Let me analyze", re.compile(r"Let me analyze[^\n]*\n")),
+    ("Let's look at", re.compile(r"Let's look at[^\n]*\n")),
+    ("Based on the", re.compile(r"Based on the[^\n]*\n")),
+    ("Looking at the", re.compile(r"Looking at the[^\n]*\n")),
+]
+
+LEADING_QUOTE = re.compile(r'^\s*["\']')
+TRAILING_QUOTE = re.compile(r'["\']\s*$')
+META_LABELS = re.compile(r"A(?:NFRAGE|NTWORT|nfrage|ntwort):")
+# Replaces the former "\n{3,}" -> "\n\n" and "\s{2,}" -> " " steps, the second one covers the first
+WHITESPACE_RUNS = re.compile(r'\s{2,}')
+
+# The answer is cut before the first line containing one of these markers
+LINE_MARKERS = re.compile(r'\[|\]|covid|COVID|bonus|Bonus|Datenschutz|Verord|---|\*\*\*|///|###')
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+SENTENCE_MARKERS = re.compile(r'\[|\]|covid|COVID')
+
+
+def _remove_artefacts(text):
+    if not ARTEFACT_TRIGGER.search(text):
+        return text
+    for pattern in ARTEFACT_PATTERNS:
+        text = pattern.sub('', text)
+    tail = ARTEFACT_TAIL.search(text)
+    if tail:
+        text = text[:tail.start()]
+    return text
+
+
+def _remove_thoughts(text):
+    if not THOUGHT_TRIGGER.search(text):
+        return text
+    for literal, pattern in THOUGHT_PATTERNS:
+        # Checked on the current text, an earlier removal may have joined a literal
+        if literal in text:
+            text = pattern.sub('', text)
+    return text
+
+
+def clean_output(text):
+    """Remove thoughts, artefacts and trailing garbage from raw model output
+
+    Produces the same result as the original sequence of re.sub calls in
+    LLMService._clean_output, with every pattern compiled once and groups of
+    patterns skipped by one combined search when none of them can match.
+    """
+    return _clean(text)[0]
+
+
+def _clean(text):
+    """Return the cleaned text and whether it was cut before a marker line"""
+    if not text:
+        return EMPTY_ANSWER, False
+
+    text = _remove_artefacts(text)
+    text = _remove_thoughts(text)
+
+    text = LEADING_QUOTE.sub('', text)
+    text = TRAILING_QUOTE.sub('', text)
+    text = META_LABELS.sub('', text)
+
+    if "Berlin" in text and len(text) < 100:
+        return "Die Hauptstadt von Deutschland ist Berlin.", False
+
+    text = WHITESPACE_RUNS.sub(' ', text)
+
+    # Keep the lines before the first line that contains a marker
+    marker = LINE_MARKERS.search(text)
+    if marker:
+        line_start = text.rfind('\n', 0, marker.start())
+        cleaned_text = text[:line_start].strip() if line_start >= 0 else ""
+    else:
+        cleaned_text = text.strip()
+
+    # Fallback: the first meaningful sentence if hardly anything is left
+    if len(cleaned_text) < 20 and len(text) > 30:
+        for sentence in SENTENCE_BOUNDARY.split(text):
+            if len(sentence) > 15 and not SENTENCE_MARKERS.search(sentence):
+                cleaned_text = sentence
+                break
+
+    return cleaned_text, marker is not None
+
+
+class StreamCleaner:
+    """Cleans model output incrementally while it is streamed
+
+    feed() takes the next piece of raw output and returns the cleaned text that
+    can be sent to the client: only text that extends what was already sent, so
+    the client never has to take text back. The last, possibly incomplete word
+    is held back because the next token may turn it into a removable pattern.
+    Once the cleaned text is cut at a marker line, the rest of the stream is
+    treated as garbage and no longer cleaned until finish() returns the exact
+    cleaned answer for the complete output.
+    """
+
+    def __init__(self):
+        self.raw_text = ""
+        self.emitted = ""
+        self.stopped = False
+
+    def feed(self, chunk):
+        """Add raw output, return the newly emittable cleaned text (may be empty)"""
+        if not chunk:
+            return ""
+        self.raw_text += chunk
+        if self.stopped:
+            return ""
+
+        text = self.raw_text
+        # Hold back the last incomplete word
+        if not text[-1].isspace():
+            boundary = max(text.rfind(' '), text.rfind('\n'))
+            if boundary < 0:
+                return ""
+            text = text[:boundary + 1]
+
+        cleaned, self.stopped = _clean(text)
+
+        if len(cleaned) > len(self.emitted) and cleaned.startswith(self.emitted):
+            new_text = cleaned[len(self.emitted):]
+            self.emitted = cleaned
+            return new_text
+        return ""
+
+    def finish(self):
+        """Return the cleaned text of the complete output"""
+        return clean_output(self.raw_text)
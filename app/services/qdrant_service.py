@@ -5,12 +5,17 @@ import numpy as np
 import hashlib
 import uuid
 import random
-from typing import List, Dict, Any
+import threading
+import time
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from qdrant_client.http.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue
-from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
+from app.services.bm25_index import BM25Index
+from app.services.cache import EmbeddingCache
+from app.services.reranker import RERANK_DEFAULT, Reranker
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +29,64 @@ QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 QDRANT_COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "rag_db")
 
+# Payload fields written by index_document that are used in filters
+PAYLOAD_INDEXES = {
+    "document_id": models.PayloadSchemaType.KEYWORD,
+    "document_path": models.PayloadSchemaType.KEYWORD,
+    "chunk_index": models.PayloadSchemaType.INTEGER,
+    "path_prefixes": models.PayloadSchemaType.KEYWORD,
+    "top_level_folder": models.PayloadSchemaType.KEYWORD,
+    "file_type": models.PayloadSchemaType.KEYWORD,
+}
+
+# Document registry configuration
+SCROLL_PAGE_SIZE = int(os.getenv("QDRANT_SCROLL_PAGE_SIZE", "1000"))
+DOCUMENT_REGISTRY_TTL = float(os.getenv("DOCUMENT_REGISTRY_TTL", "300"))
+# dropbox_content_hash/dropbox_rev identify the Dropbox revision a document was indexed from
+REGISTRY_PAYLOAD_FIELDS = ["document_id", "document_path", "indexed_at", "content_hash", "file_type",
+                           "dropbox_content_hash", "dropbox_rev"]
+
+# Points per upsert request when storing a document
+UPSERT_BATCH_SIZE = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", "10"))
+
+# Seconds the collection existence/point count check is cached for search
+COLLECTION_STATE_TTL = float(os.getenv("QDRANT_COLLECTION_STATE_TTL", "30"))
+
+# Embedding configuration
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+# Retrieval modes: dense vectors only, BM25 only, or both fused with reciprocal rank fusion.
+# Dense stays the default so the score remains the cosine similarity; in hybrid and
+# lexical mode (opt-in per request or via SEARCH_MODE) it is a rank-based 0..1 value
+SEARCH_MODES = ("dense", "hybrid", "lexical")
+SEARCH_MODE = os.getenv("SEARCH_MODE", "dense").lower()
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", "4"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Share of the lexical ranking in the fused score, raised for queries with numbers
+# such as "Whg 205" or contract numbers, which the embeddings handle poorly
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "0.4"))
+HYBRID_IDENTIFIER_LEXICAL_WEIGHT = float(os.getenv("HYBRID_IDENTIFIER_LEXICAL_WEIGHT", "0.7"))
+
+def normalize_path(path: str) -> str:
+    """Normalize a Dropbox path for matching: lowercase, without leading or trailing slash"""
+    return path.strip().strip("/").lower()
+
+def path_fields(document_path: str) -> Dict[str, Any]:
+    """Folder hierarchy and file type of a document, stored as indexed payload fields
+    
+    "Haus A/Mietvertrag/vertrag.pdf" gives the prefixes ["haus a", "haus a/mietvertrag"],
+    the top-level folder "haus a" and the file type "pdf".
+    """
+    parts = normalize_path(document_path).split("/")
+    folders, file_name = parts[:-1], parts[-1]
+    return {
+        "path_prefixes": ["/".join(folders[:i]) for i in range(1, len(folders) + 1)],
+        "top_level_folder": folders[0] if folders else "",
+        "file_type": file_name.rsplit(".", 1)[-1] if "." in file_name else ""
+    }
+
 class QdrantService:
     def __init__(self):
         try:
@@ -31,19 +94,86 @@ class QdrantService:
             self.client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
             logger.info("Qdrant client initialized successfully")
             
-            logger.info("Loading sentence transformer model")
-            self.model = SentenceTransformer('all-MiniLM-L6-v2')
+            # The model is loaded on first use or by warm_up(), not at construction
+            self.model_name = EMBEDDING_MODEL_NAME
+            self._model = None
+            self._model_lock = threading.Lock()
             self.collection_name = QDRANT_COLLECTION_NAME
-            self.vector_size = self.model.get_sentence_embedding_dimension()
-            logger.info(f"Vector size: {self.vector_size}")
+            self.embedding_batch_size = EMBEDDING_BATCH_SIZE
+            
+            self.query_embedding_cache = EmbeddingCache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+            
+            # Local BM25 index over the chunk texts for hybrid search
+            self.lexical_index = BM25Index()
+            self.lexical_index.add_change_listener(self._on_documents_changed_elsewhere)
+            
+            # Optional cross-encoder re-ranking of search candidates, loaded by warm_up()
+            self.reranker = Reranker()
+            
+            # Cached collection existence and point count, see _collection_has_points
+            self._collection_state = None
+            self._collection_ready = False
+            
+            # Callbacks notified with the document ID whenever a document's points change
+            self._document_listeners = []
+            
+            # In-process registry of indexed documents, loaded lazily from Qdrant
+            self._documents = {}
+            self._registry_loaded_at = None
+            self._registry_lock = threading.RLock()
+            # Held by the one thread that scrolls the registry; registrations made
+            # meanwhile are collected in _registry_changes and applied on top
+            self._registry_refresh_lock = threading.Lock()
+            self._registry_changes = None
             
-            self._ensure_collection_exists()
             logger.info("Qdrant service initialization complete")
         except Exception as e:
             logger.error(f"Error initializing Qdrant service: {str(e)}")
             logger.error(traceback.format_exc())
             raise
     
+    @property
+    def model(self):
+        """The sentence transformer model, loaded on first access"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    logger.info(f"Loading sentence transformer model: {self.model_name}")
+                    # Imported here because importing sentence_transformers pulls in torch
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+                    logger.info(f"Vector size: {self._model.get_sentence_embedding_dimension()}, "
+                                f"embedding batch size: {self.embedding_batch_size}")
+        return self._model
+    
+    @property
+    def vector_size(self):
+        return self.model.get_sentence_embedding_dimension()
+    
+    @property
+    def model_loaded(self) -> bool:
+        return self._model is not None
+    
+    def warm_up(self):
+        """Load the model, bootstrap the collection and load the document registry"""
+        self.model
+        if RERANK_DEFAULT:
+            self.reranker.load()
+        self._ensure_collection_ready()
+        self.refresh_document_registry()
+        self._backfill_path_fields()
+        self.sync_lexical_index()
+    
+    def close(self):
+        """Write pending changes of the lexical index, called on shutdown"""
+        self.lexical_index.flush()
+    
+    def _ensure_collection_ready(self):
+        """Run the collection bootstrap once per process"""
+        if not self._collection_ready:
+            self._ensure_collection_exists()
+            self._collection_ready = True
+    
     def _ensure_collection_exists(self):
         """Make sure the collection exists, create it if it doesn't"""
         try:
@@ -58,16 +188,92 @@ class QdrantService:
                     vectors_config=VectorParams(size=self.vector_size, distance=Distance.COSINE)
                 )
                 logger.info(f"Collection created successfully: {self.collection_name}")
+                existing_schema = {}
+                self._set_collection_state(points_count=0)
             else:
                 logger.info(f"Collection already exists: {self.collection_name}")
                 # Get collection info to verify its configuration
                 collection_info = self.client.get_collection(self.collection_name)
                 logger.info(f"Collection info: {collection_info}")
+                existing_schema = collection_info.payload_schema or {}
+                self._set_collection_state(points_count=collection_info.points_count or 0)
+            
+            self._ensure_payload_indexes(existing_schema)
         except Exception as e:
             logger.error(f"Error ensuring collection exists: {str(e)}")
             logger.error(traceback.format_exc())
             raise
     
+    def _set_collection_state(self, points_count):
+        """Remember that the collection exists and how many points it holds"""
+        self._collection_state = {
+            "points_count": points_count,
+            "checked_at": time.monotonic()
+        }
+    
+    def invalidate_collection_state(self):
+        """Force the next search to re-check the collection in Qdrant"""
+        self._collection_state = None
+    
+    def _collection_has_points(self) -> bool:
+        """Check whether the collection has points, using the cached state if it is fresh"""
+        state = self._collection_state
+        if state is not None and time.monotonic() - state["checked_at"] <= COLLECTION_STATE_TTL:
+            return state["points_count"] > 0
+        
+        try:
+            collection_info = self.client.get_collection(self.collection_name)
+        except Exception as e:
+            logger.warning(f"Could not get collection {self.collection_name}: {e}")
+            self.invalidate_collection_state()
+            return False
+        
+        self._set_collection_state(points_count=collection_info.points_count or 0)
+        return self._collection_state["points_count"] > 0
+    
+    def _ensure_payload_indexes(self, existing_schema):
+        """Create the payload indexes from PAYLOAD_INDEXES that the collection is missing"""
+        for field_name, field_schema in PAYLOAD_INDEXES.items():
+            existing = existing_schema.get(field_name)
+            if existing is not None:
+                if existing.data_type != field_schema:
+                    logger.warning(
+                        f"Payload index {field_name} has type {existing.data_type}, expected {field_schema}"
+                    )
+                continue
+            
+            logger.info(f"Creating payload index {field_name} ({field_schema})")
+            self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name=field_name,
+                field_schema=field_schema,
+                wait=True
+            )
+    
+    def get_collection_diagnostics(self) -> Dict[str, Any]:
+        """Describe the collection, its payload indexes and the indexes the service expects"""
+        collection_info = self.client.get_collection(self.collection_name)
+        payload_schema = collection_info.payload_schema or {}
+        
+        indexes = {
+            field_name: {
+                "type": str(info.data_type),
+                "points": info.points
+            }
+            for field_name, info in payload_schema.items()
+        }
+        expected = {field_name: str(field_schema) for field_name, field_schema in PAYLOAD_INDEXES.items()}
+        
+        return {
+            "collection": self.collection_name,
+            "points_count": collection_info.points_count,
+            "vector_size": getattr(collection_info.config.params.vectors, "size", None),
+            "model_loaded": self.model_loaded,
+            "payload_indexes": indexes,
+            "expected_payload_indexes": expected,
+            "missing_payload_indexes": [name for name in PAYLOAD_INDEXES if name not in payload_schema]
+        }
+    
     def _generate_numeric_id(self, text, chunk_index=None):
         """Generate a numeric ID for Qdrant based on the document content"""
         # Create a hash of the text
@@ -84,87 +290,372 @@ class QdrantService:
         
         return num_id
     
-    def list_indexed_documents(self) -> List[str]:
-        """Get a list of all document IDs that have been indexed"""
-        try:
-            logger.info(f"Listing indexed documents in collection: {self.collection_name}")
-            
-            # First, check if the collection exists
-            collections = self.client.get_collections()
-            collection_names = [collection.name for collection in collections.collections]
+    def add_document_listener(self, callback):
+        """Register a callback that is called with a document ID when it is re-indexed or deleted"""
+        self._document_listeners.append(callback)
+    
+    def _notify_document_changed(self, document_id):
+        """Inform all listeners that a document's points changed"""
+        for callback in self._document_listeners:
+            try:
+                callback(document_id)
+            except Exception as e:
+                logger.warning(f"Document listener failed for {document_id}: {e}")
+    
+    def _on_documents_changed_elsewhere(self, document_ids):
+        """Update cached state for documents another process (e.g. the sync script) re-indexed or deleted"""
+        self.refresh_registry_entries(document_ids)
+        self.invalidate_collection_state()
+        for document_id in document_ids:
+            self._notify_document_changed(document_id)
+    
+    def _document_filter(self, document_id):
+        """Build a filter matching all points of one document"""
+        return Filter(
+            must=[FieldCondition(key="document_id", match=MatchValue(value=document_id))]
+        )
+    
+    def delete_document(self, document_id) -> int:
+        """Delete all points of a document server-side and return how many were removed"""
+        document_filter = self._document_filter(document_id)
+        
+        count_result = self.client.count(
+            collection_name=self.collection_name,
+            count_filter=document_filter,
+            exact=True
+        )
+        removed = count_result.count
+        
+        if removed:
+            logger.info(f"Deleting {removed} points for document {document_id}")
+            self.client.delete(
+                collection_name=self.collection_name,
+                points_selector=models.FilterSelector(filter=document_filter),
+                wait=True
+            )
+        
+        self.lexical_index.remove_document(document_id)
+        self._unregister_document(document_id)
+        self.invalidate_collection_state()
+        self._notify_document_changed(document_id)
+        return removed
+    
+    def embed_texts(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Encode a list of texts in batches and return a (len(texts), vector_size) matrix"""
+        if not texts:
+            return np.empty((0, self.vector_size), dtype=np.float32)
+        
+        batch_size = batch_size or self.embedding_batch_size
+        logger.info(f"Encoding {len(texts)} texts in batches of {batch_size}")
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return np.asarray(embeddings, dtype=np.float32)
+    
+    def embed_query(self, query) -> np.ndarray:
+        """Encode a search query, reusing cached embeddings for repeated queries"""
+        embedding = self.query_embedding_cache.get(self.model_name, query)
+        if embedding is not None:
+            logger.info("Using cached embedding for search query")
+            return embedding
+        
+        logger.info("Creating embedding for search query")
+        embedding = self.model.encode(query, convert_to_numpy=True, show_progress_bar=False)
+        self.query_embedding_cache.put(self.model_name, query, embedding)
+        return embedding
+    
+    def embed_documents(self, documents_chunks: List[List[str]], batch_size: int = None) -> List[np.ndarray]:
+        """Encode the chunks of several documents in one pass
+        
+        All chunks are encoded as a single matrix so batches are filled across
+        document boundaries; the result holds one row-slice of that matrix per document.
+        """
+        flat_chunks = [chunk for chunks in documents_chunks for chunk in chunks]
+        matrix = self.embed_texts(flat_chunks, batch_size)
+        
+        result = []
+        offset = 0
+        for chunks in documents_chunks:
+            result.append(matrix[offset:offset + len(chunks)])
+            offset += len(chunks)
+        return result
+    
+    def _scroll_document_registry(self) -> Dict[str, Dict[str, Any]]:
+        """Scroll through all points and aggregate them per document"""
+        documents = {}
+        offset = None
+        pages = 0
+        
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                limit=SCROLL_PAGE_SIZE,
+                offset=offset,
+                with_payload=REGISTRY_PAYLOAD_FIELDS,
+                with_vectors=False
+            )
+            pages += 1
             
-            if self.collection_name not in collection_names:
-                logger.warning(f"Collection {self.collection_name} does not exist yet")
-                return []
+            for point in points:
+                payload = point.payload or {}
+                doc_id = payload.get("document_id")
+                if doc_id is None:
+                    continue
+                if doc_id not in documents:
+                    documents[doc_id] = self._registry_entry(payload, 0)
+                documents[doc_id]["chunk_count"] += 1
             
-            # Get collection info to check if it has points
-            collection_info = self.client.get_collection(self.collection_name)
-            if collection_info.points_count == 0:
-                logger.warning(f"Collection {self.collection_name} exists but has no points")
-                return []
-                
-            # Get all points (up to 100)
+            if offset is None:
+                break
+        
+        logger.info(f"Scrolled {pages} pages, found {len(documents)} documents")
+        return documents
+    
+    @staticmethod
+    def _registry_entry(payload, chunk_count) -> Dict[str, Any]:
+        """Build a registry entry from the payload of one of the document's points"""
+        return {
+            "chunk_count": chunk_count,
+            "document_path": payload.get("document_path"),
+            "indexed_at": payload.get("indexed_at"),
+            "content_hash": payload.get("content_hash"),
+            "file_type": payload.get("file_type"),
+            "dropbox_content_hash": payload.get("dropbox_content_hash"),
+            "dropbox_rev": payload.get("dropbox_rev")
+        }
+    
+    def refresh_registry_entries(self, document_ids):
+        """Reload the registry entries of some documents, one count and one point each
+        
+        Does nothing before the registry was loaded once; the full load includes them.
+        """
+        with self._registry_lock:
+            if self._registry_loaded_at is None:
+                return
+        for document_id in document_ids:
             try:
-                scroll_result = self.client.scroll(
+                document_filter = self._document_filter(document_id)
+                chunk_count = self.client.count(
+                    collection_name=self.collection_name,
+                    count_filter=document_filter,
+                    exact=True
+                ).count
+                if not chunk_count:
+                    self._unregister_document(document_id)
+                    continue
+                points, _ = self.client.scroll(
                     collection_name=self.collection_name,
-                    limit=100,
-                    with_payload=True,
+                    scroll_filter=document_filter,
+                    limit=1,
+                    with_payload=REGISTRY_PAYLOAD_FIELDS,
                     with_vectors=False
                 )
-                
-                points = scroll_result[0]  # First element is the list of points
-                
-                if not points:
-                    logger.warning(f"No points found in collection {self.collection_name}")
-                    return []
-                    
-                # Extract unique document IDs
-                doc_ids = set()
-                for point in points:
-                    if 'document_id' in point.payload:
-                        # Extract the base document ID from the point ID
-                        doc_id = point.payload['document_id']
-                        doc_ids.add(doc_id)
-                
-                logger.info(f"Found {len(doc_ids)} unique document IDs")
-                return list(doc_ids)
+                if points:
+                    self._set_registry_entry(document_id, self._registry_entry(points[0].payload or {}, chunk_count))
             except Exception as e:
-                logger.error(f"Error scrolling points: {e}")
-                
-                # Fallback: try search with a dummy vector
-                try:
-                    logger.info("Trying alternative method to get documents")
-                    # Create a dummy vector of zeros
-                    dummy_vector = [0.0] * self.vector_size
-                    
-                    # Search with a high limit
-                    search_results = self.client.search(
-                        collection_name=self.collection_name,
-                        query_vector=dummy_vector,
-                        limit=100,
-                        with_payload=True
-                    )
-                    
-                    # Extract unique document IDs
-                    doc_ids = set()
-                    for result in search_results:
-                        if 'document_id' in result.payload:
-                            doc_id = result.payload['document_id']
-                            doc_ids.add(doc_id)
-                    
-                    logger.info(f"Found {len(doc_ids)} unique document IDs using alternative method")
-                    return list(doc_ids)
-                except Exception as search_err:
-                    logger.error(f"Error using alternative method: {search_err}")
-                    return []
-                
+                logger.warning(f"Could not refresh registry entry of {document_id}: {e}")
+    
+    def refresh_document_registry(self):
+        """Reload the document registry from Qdrant"""
+        with self._registry_refresh_lock:
+            self._refresh_document_registry_locked()
+    
+    def _refresh_document_registry_locked(self):
+        """Scroll the registry; the caller holds _registry_refresh_lock"""
+        with self._registry_lock:
+            self._registry_changes = {}
+        try:
+            documents = self._scroll_document_registry()
+            with self._registry_lock:
+                # Documents indexed or deleted while scrolling may be missing from the snapshot
+                for document_id, entry in self._registry_changes.items():
+                    if entry is None:
+                        documents.pop(document_id, None)
+                    else:
+                        documents[document_id] = entry
+                self._documents = documents
+                self._registry_loaded_at = time.monotonic()
+        finally:
+            with self._registry_lock:
+                self._registry_changes = None
+    
+    def _backfill_path_fields(self):
+        """Add the folder and file type fields to documents indexed before they existed"""
+        registry = self._get_registry()
+        for document_id, entry in registry.items():
+            if entry.get("file_type") is not None or not entry.get("document_path"):
+                continue
+            fields = path_fields(entry["document_path"])
+            logger.info(f"Adding path fields to the points of document {document_id}")
+            self.client.set_payload(
+                collection_name=self.collection_name,
+                payload=fields,
+                points=models.FilterSelector(filter=self._document_filter(document_id)),
+                wait=True
+            )
+            with self._registry_lock:
+                entry["file_type"] = fields["file_type"]
+    
+    def sync_lexical_index(self):
+        """Bring the BM25 index in line with the documents stored in Qdrant
+        
+        Documents that are missing from the index or were re-indexed since are
+        rebuilt from the chunk texts in Qdrant, e.g. after the index file was
+        lost or changes made shortly before a crash were not written yet.
+        """
+        registry = self._get_registry()
+        indexed = self.lexical_index.document_hashes()
+        
+        for document_id in set(indexed) - set(registry):
+            self.lexical_index.remove_document(document_id)
+        
+        stale = [doc_id for doc_id, entry in registry.items()
+                 if doc_id not in indexed or indexed[doc_id] != entry.get("content_hash")]
+        if stale:
+            logger.info(f"Rebuilding BM25 index entries for {len(stale)} documents from Qdrant")
+        for document_id in stale:
+            chunks = []
+            offset = None
+            while True:
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=self._document_filter(document_id),
+                    limit=SCROLL_PAGE_SIZE,
+                    offset=offset,
+                    with_payload=["text"],
+                    with_vectors=False
+                )
+                chunks.extend((point.id, (point.payload or {}).get("text", "")) for point in points)
+                if offset is None:
+                    break
+            document_path = registry[document_id].get("document_path")
+            self.lexical_index.add_document(
+                document_id,
+                chunks,
+                registry[document_id].get("content_hash"),
+                metadata=path_fields(document_path) if document_path else {}
+            )
+        
+        self.lexical_index.flush()
+    
+    def _get_registry(self) -> Dict[str, Dict[str, Any]]:
+        """Return the document registry, refreshing it if it was never loaded or is stale
+        
+        Only one thread scrolls Qdrant at a time. Until the registry was loaded
+        once the others wait for it; afterwards they keep using the stale copy
+        while it is refreshed.
+        """
+        with self._registry_lock:
+            loaded_at = self._registry_loaded_at
+        
+        if loaded_at is None:
+            with self._registry_refresh_lock:
+                if self._registry_loaded_at is None:
+                    logger.info(f"Loading document registry for collection: {self.collection_name}")
+                    self._refresh_document_registry_locked()
+        elif time.monotonic() - loaded_at > DOCUMENT_REGISTRY_TTL and self._registry_refresh_lock.acquire(blocking=False):
+            try:
+                if self._registry_loaded_at == loaded_at:
+                    logger.info(f"Refreshing document registry for collection: {self.collection_name}")
+                    self._refresh_document_registry_locked()
+            finally:
+                self._registry_refresh_lock.release()
+        
+        with self._registry_lock:
+            return self._documents
+    
+    def _register_document(self, document_id, chunk_count, document_path, indexed_at, content_hash, file_type,
+                           dropbox_content_hash=None, dropbox_rev=None):
+        """Record a freshly indexed document in the registry"""
+        self._set_registry_entry(document_id, {
+            "chunk_count": chunk_count,
+            "document_path": document_path,
+            "indexed_at": indexed_at,
+            "content_hash": content_hash,
+            "file_type": file_type,
+            "dropbox_content_hash": dropbox_content_hash,
+            "dropbox_rev": dropbox_rev
+        })
+    
+    def _unregister_document(self, document_id):
+        """Remove a document from the registry"""
+        self._set_registry_entry(document_id, None)
+    
+    def _set_registry_entry(self, document_id, entry):
+        """Set or (with None) remove a registry entry, also for a refresh in progress"""
+        with self._registry_lock:
+            if entry is None:
+                self._documents.pop(document_id, None)
+            else:
+                self._documents[document_id] = entry
+            if self._registry_changes is not None:
+                self._registry_changes[document_id] = entry
+    
+    def list_indexed_documents(self) -> List[str]:
+        """Get a list of all document IDs that have been indexed"""
+        try:
+            return sorted(self._get_registry())
         except Exception as e:
             logger.error(f"Error listing indexed documents: {str(e)}")
             logger.error(traceback.format_exc())
             return []
     
-    def index_document(self, document_id, document_path, document_name, document_content):
-        """Index a document in Qdrant"""
+    def get_document_registry(self) -> Dict[str, Dict[str, Any]]:
+        """Get chunk count, indexing time and content hash for every indexed document"""
+        try:
+            registry = self._get_registry()
+            with self._registry_lock:
+                return {doc_id: dict(info) for doc_id, info in registry.items()}
+        except Exception as e:
+            logger.error(f"Error reading document registry: {str(e)}")
+            logger.error(traceback.format_exc())
+            return {}
+    
+    def get_indexed_document(self, document_id) -> Optional[Dict[str, Any]]:
+        """Get the registry entry of a document, None if it is not indexed"""
+        try:
+            entry = self._get_registry().get(document_id)
+        except Exception as e:
+            logger.error(f"Error reading registry entry of {document_id}: {str(e)}")
+            return None
+        if entry is None:
+            return None
+        with self._registry_lock:
+            return dict(entry)
+    
+    def is_document_indexed(self, document_id) -> bool:
+        """Check whether a document has been indexed"""
+        try:
+            return document_id in self._get_registry()
+        except Exception as e:
+            logger.error(f"Error checking document {document_id}: {str(e)}")
+            return False
+    
+    def has_indexed_documents(self) -> bool:
+        """Check whether any document has been indexed"""
+        try:
+            return bool(self._get_registry())
+        except Exception as e:
+            logger.error(f"Error checking for indexed documents: {str(e)}")
+            return False
+    
+    def chunk_document(self, document_content) -> List[Tuple[int, str]]:
+        """Split document text into (chunk_index, chunk) pairs, skipping empty chunks"""
+        chunks = self._chunk_text(document_content)
+        logger.info(f"Split document into {len(chunks)} chunks")
+        # Skip empty chunks but keep the original chunk index for the point IDs
+        return [(i, chunk) for i, chunk in enumerate(chunks) if chunk.strip()]
+    
+    def index_document(self, document_id, document_path, document_name, document_content,
+                       dropbox_content_hash=None, dropbox_rev=None):
+        """Index a document in Qdrant
+        
+        dropbox_content_hash and dropbox_rev of the indexed Dropbox revision are
+        stored with every chunk so that a sync can skip unchanged files.
+        """
         try:
             logger.info(f"Indexing document: {document_name} (ID: {document_id})")
             logger.info(f"Document content length: {len(document_content)} characters")
@@ -177,95 +668,80 @@ class QdrantService:
                 logger.warning(f"Empty document content for {document_name}")
                 return False
             
-            # Try to delete existing document chunks if they exist
-            try:
-                # We'll try to search for existing documents
-                indexed_docs = self.list_indexed_documents()
-                if document_id in indexed_docs:
-                    logger.info(f"Document {document_id} already exists, need to delete")
-                    
-                    # Try to find all points with this document_id
-                    dummy_vector = [0.0] * self.vector_size
-                    
-                    # This is a workaround for missing filter support in older versions
-                    search_results = self.client.search(
-                        collection_name=self.collection_name,
-                        query_vector=dummy_vector,
-                        limit=100,  # Get up to 100 points
-                        with_payload=True
-                    )
-                    
-                    # Filter the results manually
-                    point_ids = []
-                    for result in search_results:
-                        if 'document_id' in result.payload and result.payload['document_id'] == document_id:
-                            point_ids.append(result.id)
-                    
-                    if point_ids:
-                        logger.info(f"Deleting {len(point_ids)} existing points for document {document_id}")
-                        for point_id in point_ids:
-                            try:
-                                self.client.delete(
-                                    collection_name=self.collection_name,
-                                    points_selector=models.PointIdsList(points=[point_id])
-                                )
-                            except Exception as del_err:
-                                logger.warning(f"Error deleting point {point_id}: {del_err}")
-                        
-                        logger.info(f"Deleted existing chunks for document {document_id}")
-            except Exception as e:
-                logger.warning(f"Error checking/deleting existing document: {e}")
-                # Continue with indexing even if checking fails
-            
-            # Split content into chunks
-            chunks = self._chunk_text(document_content)
-            logger.info(f"Created {len(chunks)} chunks from document")
-            logger.info(f"Split document into {len(chunks)} chunks")
+            self._ensure_collection_ready()
             
-            if not chunks:
+            indexed_chunks = self.chunk_document(document_content)
+            if not indexed_chunks:
                 logger.warning(f"No valid chunks generated for {document_name}")
                 return False
             
-            # Create embeddings for each chunk
-            logger.info(f"Creating embeddings for {len(chunks)} chunks")
+            # Create embeddings for all chunks in batches
+            logger.info(f"Creating embeddings for {len(indexed_chunks)} chunks")
+            embeddings = self.embed_texts([chunk for _, chunk in indexed_chunks])
+        except Exception as e:
+            logger.error(f"Error indexing document {document_name}: {str(e)}")
+            logger.error(traceback.format_exc())
+            raise
+        
+        return self.store_document(document_id, document_path, document_name, document_content,
+                                   indexed_chunks, embeddings, dropbox_content_hash, dropbox_rev)
+    
+    def store_document(self, document_id, document_path, document_name, document_content,
+                       indexed_chunks, embeddings, dropbox_content_hash=None, dropbox_rev=None):
+        """Replace the points of a document with already embedded chunks
+        
+        indexed_chunks are the (chunk_index, chunk) pairs from chunk_document and
+        embeddings their vectors in the same order; the document content is only
+        used for the content hash and must be stripped like in index_document,
+        so both paths store the same hash for the same text. Returns False, with
+        nothing of the document left in the collection, unless every point was stored.
+        """
+        try:
+            self._ensure_collection_ready()
+            
+            # Remove chunks from a previous indexing run with a single filtered delete
+            try:
+                removed = self.delete_document(document_id)
+                if removed:
+                    logger.info(f"Document {document_id} already existed, removed {removed} old points")
+            except Exception as e:
+                logger.warning(f"Error deleting existing document points: {e}")
+                # Continue with indexing even if deleting fails
+            
+            indexed_at = datetime.now().isoformat()
+            content_hash = hashlib.sha256(document_content.encode('utf-8')).hexdigest()
+            fields = path_fields(document_path)
+            
             points = []
-            for i, chunk in enumerate(chunks):
-                # Skip empty chunks
-                if not chunk.strip():
-                    continue
+            for (i, chunk), embedding in zip(indexed_chunks, embeddings):
+                # Generate a numeric ID for this point
+                point_id = self._generate_numeric_id(document_id, i)
                 
-                try:
-                    # Create embedding
-                    logger.info(f"Creating embedding for chunk {i} (length: {len(chunk)})")
-                    embedding = self.model.encode(chunk)
-                    
-                    # Generate a numeric ID for this point
-                    point_id = self._generate_numeric_id(document_id, i)
-                    logger.info(f"Creating point with ID: {point_id}, chunk preview: {chunk[:50]}")
-                    
-                    points.append(
-                        PointStruct(
-                            id=point_id,
-                            vector=embedding.tolist(),
-                            payload={
-                                "document_id": document_id,
-                                "document_path": document_path,
-                                "document_name": document_name,
-                                "chunk_index": i,
-                                "text": chunk
-                            }
-                        )
+                points.append(
+                    PointStruct(
+                        id=point_id,
+                        vector=embedding.tolist(),
+                        payload={
+                            "document_id": document_id,
+                            "document_path": document_path,
+                            "document_name": document_name,
+                            "chunk_index": i,
+                            "text": chunk,
+                            "indexed_at": indexed_at,
+                            "content_hash": content_hash,
+                            "dropbox_content_hash": dropbox_content_hash,
+                            "dropbox_rev": dropbox_rev,
+                            **fields
+                        }
                     )
-                except Exception as e:
-                    logger.error(f"Error creating embedding for chunk {i}: {str(e)}")
-                    continue
+                )
             
             # Upload points to Qdrant
             if points:
                 logger.info(f"Ready to upload {len(points)} points to Qdrant")
                 
-                # Upload in batches of 10 to avoid large requests
-                batch_size = 10
+                # Upload in batches to avoid large requests
+                batch_size = UPSERT_BATCH_SIZE
                 total_batches = (len(points) + batch_size - 1) // batch_size
                 
                 for i in range(0, len(points), batch_size):
@@ -294,13 +770,33 @@ class QdrantService:
                                 logger.error(f"Error uploading point {point.id}: {e}")
                 
                 # Verify the document was indexed
-                indexed_docs = self.list_indexed_documents()
-                logger.info(f"Post-indexing check: {indexed_docs}")
+                stored = self.client.count(
+                    collection_name=self.collection_name,
+                    count_filter=self._document_filter(document_id),
+                    exact=True
+                ).count
+                logger.info(f"Post-indexing check: {stored} points stored for {document_id}")
+                
+                if stored < len(points):
+                    # A partial document would carry the new Dropbox hash in its payload and
+                    # be skipped by the next sync; remove it so the retry indexes it again
+                    logger.error(f"Only {stored} of {len(points)} points stored for {document_id}, removing them")
+                    try:
+                        self.delete_document(document_id)
+                    except Exception as e:
+                        logger.warning(f"Error removing partially indexed document {document_id}: {e}")
+                    return False
                 
-                if document_id in indexed_docs:
-                    logger.info(f"Document {document_id} successfully indexed")
-                else:
-                    logger.warning(f"Document {document_id} not found in index after indexing attempt")
+                self.lexical_index.add_document(
+                    document_id,
+                    [(point.id, point.payload["text"]) for point in points],
+                    content_hash,
+                    metadata=fields
+                )
+                self._register_document(document_id, stored, document_path, indexed_at, content_hash, fields["file_type"],
+                                       dropbox_content_hash, dropbox_rev)
+                self.invalidate_collection_state()
+                self._notify_document_changed(document_id)
                 
                 logger.info(f"Successfully indexed document {document_name} with {len(points)} chunks")
                 return True
@@ -312,36 +808,60 @@ class QdrantService:
             logger.error(traceback.format_exc())
             raise
     
-    def search(self, query, top_k=5):
-        """Search for similar documents"""
+    def search(self, query, top_k=5, query_vector=None, rerank=None, rerank_budget_ms=None,
+               mode=None, lexical_weight=None, path_prefix=None, document_ids=None, file_types=None):
+        """Search for similar documents
+        
+        A precomputed query_vector can be passed to avoid embedding the query again.
+        path_prefix, document_ids and file_types restrict the search to documents
+        below a folder, with one of the given IDs or of one of the given types;
+        the filters are evaluated by Qdrant on the indexed payload fields.
+        mode (default SEARCH_MODE) selects dense, lexical (BM25) or hybrid retrieval;
+        in hybrid mode both rankings are fused with weight lexical_weight for the
+        lexical one (default depends on the query, see lexical_weight_for).
+        With rerank (default RERANK_DEFAULT), a larger candidate set is retrieved
+        and re-scored by the cross-encoder within rerank_budget_ms.
+        """
         try:
-            logger.info(f"Searching for query: '{query}' (top_k: {top_k})")
+            if rerank is None:
+                rerank = RERANK_DEFAULT
+            mode = (mode or SEARCH_MODE).lower()
+            if mode not in SEARCH_MODES:
+                raise ValueError(f"Unknown search mode {mode!r}, expected one of {SEARCH_MODES}")
+            limit = self.reranker.candidate_count(top_k) if rerank else top_k
+            logger.info(f"Searching for query: '{query}' (top_k: {top_k}, mode: {mode}, rerank: {rerank})")
             
-            # Check if collection exists and has points
-            collections = self.client.get_collections()
-            collection_names = [collection.name for collection in collections.collections]
+            # Pick up documents another process indexed since the last search; this also
+            # invalidates the cached answers for them, whatever the search mode
+            self.lexical_index.reload_if_changed()
             
-            if self.collection_name not in collection_names:
-                logger.warning(f"Collection {self.collection_name} does not exist")
+            # Check the cached collection state instead of asking Qdrant on every query
+            if not self._collection_has_points():
+                logger.warning(f"Collection {self.collection_name} does not exist or has no points")
                 return []
-                
-            collection_info = self.client.get_collection(self.collection_name)
-            if collection_info.points_count == 0:
-                logger.warning(f"Collection {self.collection_name} has no points")
+            
+            if document_ids is not None and not document_ids:
                 return []
+            search_filter = self._search_filter(path_prefix, document_ids, file_types)
             
-            # Create query embedding
-            logger.info("Creating embedding for search query")
-            query_embedding = self.model.encode(query)
+            if mode == "dense":
+                search_result = self._dense_search(query, query_vector, limit, search_filter)
+            else:
+                if lexical_weight is None:
+                    lexical_weight = 1.0 if mode == "lexical" else self.lexical_weight_for(query)
+                candidates = max(limit, top_k * HYBRID_CANDIDATE_FACTOR)
+                dense = self._dense_search(query, query_vector, candidates, search_filter) if lexical_weight < 1.0 else []
+                lexical = []
+                if lexical_weight > 0.0:
+                    lexical = self.lexical_index.search(
+                        query,
+                        candidates,
+                        self._lexical_document_ids(path_prefix, document_ids, file_types)
+                    )
+                search_result = self._fuse(dense, lexical, limit, lexical_weight)
             
-            # Search for similar chunks
-            logger.info(f"Sending search request to Qdrant with top_k={top_k}")
-            search_result = self.client.search(
-                collection_name=self.collection_name,
-                query_vector=query_embedding.tolist(),
-                limit=top_k,
-                with_payload=True
-            )
+            if rerank:
+                search_result, _ = self.reranker.rerank(query, search_result, top_k, rerank_budget_ms)
             
             logger.info(f"Found {len(search_result)} results")
             for i, result in enumerate(search_result):
@@ -353,6 +873,97 @@ class QdrantService:
             logger.error(traceback.format_exc())
             return []
     
+    def _dense_search(self, query, query_vector, limit, search_filter=None):
+        """Vector search in Qdrant"""
+        # Create query embedding
+        query_embedding = query_vector if query_vector is not None else self.embed_query(query)
+        
+        logger.info(f"Sending search request to Qdrant with limit={limit}, filter={search_filter}")
+        return self.client.search(
+            collection_name=self.collection_name,
+            query_vector=np.asarray(query_embedding).tolist(),
+            query_filter=search_filter,
+            limit=limit,
+            with_payload=True
+        )
+    
+    @staticmethod
+    def _normalize_file_types(file_types):
+        return [file_type.strip().lstrip(".").lower() for file_type in file_types]
+    
+    def _search_filter(self, path_prefix=None, document_ids=None, file_types=None):
+        """Build the Qdrant filter for the scope of a search, None if it is not restricted"""
+        conditions = []
+        if path_prefix and normalize_path(path_prefix):
+            conditions.append(FieldCondition(key="path_prefixes", match=MatchValue(value=normalize_path(path_prefix))))
+        if document_ids is not None:
+            conditions.append(FieldCondition(key="document_id", match=models.MatchAny(any=list(document_ids))))
+        if file_types:
+            conditions.append(FieldCondition(key="file_type", match=models.MatchAny(any=self._normalize_file_types(file_types))))
+        return Filter(must=conditions) if conditions else None
+    
+    def _lexical_document_ids(self, path_prefix=None, document_ids=None, file_types=None):
+        """Document IDs the lexical search is restricted to, None if it is not restricted"""
+        prefix = normalize_path(path_prefix) if path_prefix else ""
+        types = set(self._normalize_file_types(file_types)) if file_types else None
+        if not prefix and types is None:
+            return document_ids
+        
+        matching = self.lexical_index.document_ids_where(
+            lambda metadata: (not prefix or prefix in metadata.get("path_prefixes", []))
+            and (types is None or metadata.get("file_type") in types)
+        )
+        if document_ids is not None:
+            matching &= set(document_ids)
+        return matching
+    
+    @staticmethod
+    def lexical_weight_for(query) -> float:
+        """Default weight of the lexical ranking for a query"""
+        if any(char.isdigit() for char in query):
+            return HYBRID_IDENTIFIER_LEXICAL_WEIGHT
+        return HYBRID_LEXICAL_WEIGHT
+    
+    def _fuse(self, dense, lexical, limit, lexical_weight):
+        """Fuse dense hits and lexical (point_id, score) pairs with weighted reciprocal rank fusion
+        
+        The fused score is scaled to 0..1, where 1 means first in both rankings.
+        """
+        fused = {}
+        for rank, point in enumerate(dense, 1):
+            fused[str(point.id)] = (1.0 - lexical_weight) / (RRF_K + rank)
+        for rank, (point_id, _) in enumerate(lexical, 1):
+            fused[point_id] = fused.get(point_id, 0.0) + lexical_weight / (RRF_K + rank)
+        
+        best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:limit]
+        max_score = 1.0 / (RRF_K + 1)
+        
+        # Lexical-only hits have no payload yet, fetch them in one request
+        points = {str(point.id): point for point in dense}
+        missing = [self._point_id(point_id) for point_id, _ in best if point_id not in points]
+        if missing:
+            for record in self.client.retrieve(
+                collection_name=self.collection_name,
+                ids=missing,
+                with_payload=True
+            ):
+                points[str(record.id)] = models.ScoredPoint(id=record.id, version=0, score=0.0, payload=record.payload)
+        
+        results = []
+        for point_id, score in best:
+            point = points.get(point_id)
+            if point is None:
+                # In the lexical index but no longer in Qdrant
+                continue
+            point.score = score / max_score
+            results.append(point)
+        return results
+    
+    @staticmethod
+    def _point_id(point_id: str):
+        """Convert a point ID stored as string in the lexical index back to a Qdrant ID"""
+        return int(point_id) if point_id.isdigit() else point_id
+    
     def _chunk_text(self, text, chunk_size=300, overlap=50):
         """Split text into chunks with overlap"""
         try:
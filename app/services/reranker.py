@@ -0,0 +1,141 @@
+import logging
+import math
+import os
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Small German/English cross-encoder that runs on CPU
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL_NAME", "cross-encoder/msmarco-MiniLM-L6-en-de-v1")
+# Whether searches are re-ranked when the request does not say
+RERANK_DEFAULT = os.getenv("RERANK_DEFAULT", "false").lower() in ("1", "true", "yes")
+# Candidates retrieved per requested result, and an upper bound
+RERANK_CANDIDATE_FACTOR = int(os.getenv("RERANK_CANDIDATE_FACTOR", "4"))
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "40"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "8"))
+# Default latency budget for scoring, in milliseconds
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "300"))
+
+
+class Reranker:
+    """Re-scores search candidates with a cross-encoder within a latency budget
+
+    Candidates are expected in vector-score order and are scored batch by
+    batch. Before each batch the reranker checks whether it still fits into
+    the budget, judged by the time the previous batches took (the first batch
+    is always scored); candidates that were not scored keep their vector order
+    behind the scored ones.
+
+    The model is loaded by load() during warm-up, never while a request waits:
+    until it is loaded, rerank() returns the candidates in vector order and
+    starts loading it in a background thread.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL_NAME, batch_size: int = RERANK_BATCH_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+        self._load_failed = False
+        self._model_lock = threading.Lock()
+        self._loader = None
+
+        self.calls = 0
+        self.budget_exceeded = 0
+        self.total_ms = 0.0
+
+    def load(self):
+        """Load the cross-encoder if it is not loaded yet and return it; None if it cannot be loaded"""
+        if self._model is None and not self._load_failed:
+            with self._model_lock:
+                if self._model is None and not self._load_failed:
+                    try:
+                        logger.info(f"Loading cross-encoder model: {self.model_name}")
+                        # Imported here because importing sentence_transformers pulls in torch
+                        from sentence_transformers import CrossEncoder
+                        self._model = CrossEncoder(self.model_name, device="cpu")
+                    except Exception as e:
+                        logger.error(f"Could not load cross-encoder {self.model_name}, re-ranking disabled: {str(e)}")
+                        logger.error(traceback.format_exc())
+                        self._load_failed = True
+        return self._model
+
+    def load_in_background(self):
+        """Start loading the cross-encoder in a daemon thread unless it is loaded or loading"""
+        with self._model_lock:
+            if self._model is not None or self._load_failed or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self.load, name="reranker-load", daemon=True)
+            self._loader.start()
+
+    @property
+    def model_loaded(self) -> bool:
+        return self._model is not None
+
+    @staticmethod
+    def candidate_count(top_k: int) -> int:
+        """Number of candidates to retrieve for re-ranking down to top_k"""
+        return max(top_k, min(top_k * RERANK_CANDIDATE_FACTOR, RERANK_MAX_CANDIDATES))
+
+    def rerank(self, query: str, candidates: List[Any], top_k: int, budget_ms: float = None) -> Tuple[List[Any], Dict[str, Any]]:
+        """Return the best top_k candidates and what the re-ranking did
+
+        The score of re-scored candidates is replaced by the cross-encoder
+        relevance mapped to 0..1.
+        """
+        budget_ms = RERANK_BUDGET_MS if budget_ms is None else budget_ms
+        info = {"candidates": len(candidates), "scored": 0, "elapsed_ms": 0.0, "budget_ms": budget_ms,
+                "model_loaded": self.model_loaded}
+        model = self._model
+        if model is None:
+            # Loading takes seconds; this request keeps the vector order
+            self.load_in_background()
+            return candidates[:top_k], info
+        if not candidates:
+            return candidates[:top_k], info
+
+        started = time.perf_counter()
+        scores = []
+        for start in range(0, len(candidates), self.batch_size):
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if scores:
+                per_batch_ms = elapsed_ms / math.ceil(len(scores) / self.batch_size)
+                if elapsed_ms + per_batch_ms > budget_ms:
+                    self.budget_exceeded += 1
+                    logger.info(f"Re-ranking budget of {budget_ms} ms reached after {len(scores)} of {len(candidates)} candidates")
+                    break
+            batch = candidates[start:start + self.batch_size]
+            pairs = [(query, candidate.payload.get("text", "")) for candidate in batch]
+            scores.extend(float(score) for score in model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False))
+
+        for candidate, score in zip(candidates, scores):
+            candidate.score = 1.0 / (1.0 + math.exp(-score))
+        scored = sorted(candidates[:len(scores)], key=lambda candidate: candidate.score, reverse=True)
+        reranked = scored + candidates[len(scores):]
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.calls += 1
+        self.total_ms += elapsed_ms
+        info.update({"scored": len(scores), "elapsed_ms": round(elapsed_ms, 1)})
+        logger.info(f"Re-ranked {len(scores)} of {len(candidates)} candidates in {elapsed_ms:.1f} ms")
+        return reranked[:top_k], info
+
+    def stats(self) -> Dict[str, Any]:
+        """Return model state and latency counters"""
+        return {
+            "model": self.model_name,
+            "model_loaded": self.model_loaded,
+            "default_enabled": RERANK_DEFAULT,
+            "calls": self.calls,
+            "budget_exceeded": self.budget_exceeded,
+            "avg_ms": self.total_ms / self.calls if self.calls else 0.0
+        }
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Vergleicht den vorkompilierten Output-Cleaner mit der bisherigen Implementierung
+
+Prüft zuerst, dass beide Varianten für typische DeepSeek-Ausgaben und für
+zufällig zusammengesetzte Ausgaben identische Ergebnisse liefern, und misst
+dann die Laufzeit pro Aufruf. Aufruf aus dem Projektverzeichnis:
+
+    python scripts/bench_clean_output.py --iterations 2000
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.output_cleaner import StreamCleaner, clean_output
+
+
+def legacy_clean_output(text):
+    """Bisherige Implementierung aus LLMService._clean_output, ohne Logging"""
+    if not text:
+        return "Keine Antwort vom LLM erhalten."
+
+    covid_patterns = [
+        r'\[/?covidInfo\].*?(?:\n|$)',
+        r'_\s*COVID-19-INFO:.*?(?:\n|$)',
+        r'\[bonusInformationen\..*?\]',
+        r'Ergibt die Zusammenfassung der Datenschutz-Grundverord.*'
+    ]
+    for pattern in covid_patterns:
+        text = re.sub(pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
+
+    thought_patterns = [
+        r"Der Nutzer[^\n]*\n",
+        r"Okay, (?:so )?I need to.*?First,",
+        r"Okay, ich muss.*?\n",
+        r"Um das zu erreichen.*?\n",
+        r"I need to.*?\n",
+        r"I already know that.*?\n",
+        r"First,.*?\n",
+        r"Let me analyze.*?\n",
+        r"Let's look at.*?\n",
+        r"Based on the.*?\n",
+        r"Looking at the.*?\n",
+    ]
+    for pattern in thought_patterns:
+        text = re.sub(pattern, "", text, flags=re.DOTALL)
+
+    text = re.sub(r'^\s*["\']', '', text)
+    text = re.sub(r'["\']\s*$', '', text)
+    text = re.sub(r"ANFRAGE:|ANTWORT:|Anfrage:|Antwort:", "", text)
+
+    if "Berlin" in text and len(text) < 100:
+        return "Die Hauptstadt von Deutschland ist Berlin."
+
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = re.sub(r'\s{2,}', ' ', text)
+
+    lines = text.split('\n')
+    cleaned_lines = []
+    for line in lines:
+        if any(marker in line for marker in [
+            '[', ']', 'covid', 'COVID', 'bonus', 'Bonus',
+            'Datenschutz', 'Verord', '---', '***', '///', '###'
+        ]):
+            break
+        cleaned_lines.append(line)
+
+    cleaned_text = '\n'.join(cleaned_lines).strip()
+
+    if len(cleaned_text) < 20 and len(text) > 30:
+        sentences = re.split(r'(?<=[.!?])\s+', text)
+        for sentence in sentences:
+            if len(sentence) > 15 and not any(marker in sentence for marker in ['[', ']', 'covid', 'COVID']):
+                cleaned_text = sentence
+                break
+
+    return cleaned_text
+
+
+# Typische Ausgaben des DeepSeek-Modells auf RunPod
+SAMPLES = [
+    "Die Kaution beträgt laut § 5 des Mietvertrags drei Nettokaltmieten, also 2.550 Euro. "
+    "Sie ist auf einem gesonderten Konto anzulegen und wird nach Ende des Mietverhältnisses verzinst zurückgezahlt.",
+
+    "Okay, so I need to figure out how long the notice period is. Let me look at the context. "
+    "The contract mentions three months.\nFirst, I check § 9.\n"
+    "Die Kündigungsfrist beträgt drei Monate zum Monatsende.\nDer Vermieter kann nur aus wichtigem Grund kündigen.",
+
+    "Der Nutzer fragt nach der Miethöhe.\nANTWORT: Die monatliche Nettokaltmiete beträgt 850 Euro, "
+    "dazu kommen 180 Euro Nebenkostenvorauszahlung.\n\n\n[covidInfo] Bitte beachten Sie die aktuellen Hinweise\n"
+    "_ COVID-19-INFO: Büros geschlossen\nWeitere Informationen finden Sie online.",
+
+    "\"Der Darlehensvertrag hat eine Zinsbindung von zehn Jahren bei einem Sollzins von 1,45 % p.a. "
+    "Eine Sondertilgung von 5 % pro Jahr ist kostenfrei möglich.\"",
+
+    "Laut Kaufvertrag ist der Kaufpreis von 420.000 Euro innerhalb von 14 Tagen nach Eintragung der Vormerkung fällig.\n"
+    "---\n### Quellen\n[bonusInformationen.quelle] Kaufvertrag Seite 3]\n"
+    "Ergibt die Zusammenfassung der Datenschutz-Grundverordnung folgende Punkte: ...",
+
+    "Based on the context, the landlord is responsible.\nLooking at the documents again.\n"
+    "Der Vermieter trägt die Kosten für Schönheitsreparaturen nur, wenn der Vertrag keine wirksame Abwälzung enthält.",
+
+    "Okay, ich muss die Frage beantworten.\nUm das zu erreichen, lese ich den Vertrag.\n"
+    "Die Nebenkostenabrechnung muss spätestens zwölf Monate nach Ende des Abrechnungszeitraums vorliegen.   "
+    "Danach sind Nachforderungen ausgeschlossen.",
+
+    "Die Hauptstadt ist Berlin.",
+
+    "[covidInfo]\n\n",
+
+    "Antwort: Ja.",
+]
+
+FRAGMENTS = [
+    "Die Kaution beträgt drei Monatsmieten. ", "Okay, so I need to ", "Okay, I need to ", "First, ",
+    "Der Nutzer möchte ", "I need to ", "I already know that ", "Let me analyze ", "Let's look at ",
+    "Based on the ", "Looking at the ", "Okay, ich muss ", "Um das zu erreichen ", "[covidInfo]", "[/covidinfo] ",
+    "_ COVID-19-INFO: ", "[bonusInformationen.x ", "] ", "Ergibt die Zusammenfassung der Datenschutz-Grundverordnung ",
+    "ANTWORT: ", "Anfrage: ", "Berlin ", "\"", "'", "\n", "\n\n\n", "   ", "---", "***", "///", "###", "Bonus ",
+    "Datenschutz ", "Verordnung ", "covid ", "Miete. ", "Kündigung! ", "Frist? ", "§ 5 Abs. 2 ",
+]
+
+
+def random_outputs(count, seed=42):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 40))) for _ in range(count)]
+
+
+def check_equivalence(texts):
+    mismatches = [text for text in texts if clean_output(text) != legacy_clean_output(text)]
+    for text in mismatches[:5]:
+        print(f"Abweichung für {text!r}:\n  alt: {legacy_clean_output(text)!r}\n  neu: {clean_output(text)!r}")
+    return len(mismatches)
+
+
+def bench(func, texts, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        for text in texts:
+            func(text)
+        timings.append((time.perf_counter() - started) / len(texts))
+    return statistics.mean(timings) * 1e6
+
+
+def bench_stream(texts, iterations, chunk_size=8):
+    """Streaming: bisher komplette Bereinigung pro Stück, jetzt StreamCleaner"""
+    def legacy(text):
+        raw = ""
+        for i in range(0, len(text), chunk_size):
+            raw += text[i:i + chunk_size]
+            legacy_clean_output(raw)
+
+    def incremental(text):
+        cleaner = StreamCleaner()
+        for i in range(0, len(text), chunk_size):
+            cleaner.feed(text[i:i + chunk_size])
+        cleaner.finish()
+
+    return bench(legacy, texts, iterations), bench(incremental, texts, iterations)
+
+
+def main(iterations, random_count):
+    fuzz = random_outputs(random_count)
+    mismatches = check_equivalence(SAMPLES) + check_equivalence(fuzz)
+    print(f"Äquivalenz: {len(SAMPLES)} Beispielausgaben und {len(fuzz)} Zufallsausgaben geprüft, {mismatches} Abweichungen")
+    if mismatches:
+        sys.exit(1)
+
+    legacy = bench(legacy_clean_output, SAMPLES, iterations)
+    current = bench(clean_output, SAMPLES, iterations)
+    print(f"Einzelaufruf:  alt {legacy:8.2f} µs   neu {current:8.2f} µs   Faktor {legacy / current:5.1f}")
+
+    legacy_stream, current_stream = bench_stream(SAMPLES, max(iterations // 20, 1))
+    print(f"Stream (8 Zeichen pro Stück): alt {legacy_stream:8.2f} µs   neu {current_stream:8.2f} µs   "
+          f"Faktor {legacy_stream / current_stream:5.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000, help="Wiederholungen über alle Beispielausgaben")
+    parser.add_argument("--random", type=int, default=20000, help="Anzahl zufälliger Ausgaben für die Äquivalenzprüfung")
+    args = parser.parse_args()
+    main(args.iterations, args.random)
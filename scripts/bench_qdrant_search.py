@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Vergleicht die Qdrant-Anfragen pro Suche: Prüfungen bei jeder Suche vs. gecachter Collection-Zustand
+
+Ersetzt den QdrantClient durch einen Stub, der jede Anfrage um eine feste
+Round-Trip-Zeit verzögert, und misst N Suchen in beiden Varianten. Die
+Embedding-Zeit ist in beiden Varianten gleich und wird nicht mitgemessen
+(der Query-Vektor wird vorab übergeben). Aufruf aus dem Projektverzeichnis:
+
+    python scripts/bench_qdrant_search.py --searches 200 --rtt-ms 2 --points 5000
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Eigene, leere BM25-Datei, damit der Benchmark data/bm25_index.json nicht anfasst
+os.environ.setdefault("BM25_INDEX_PATH", os.path.join(tempfile.mkdtemp(), "bm25_index.json"))
+
+from app.services.qdrant_service import SCROLL_PAGE_SIZE, QdrantService
+
+
+class StubQdrantClient:
+    """Antwortet wie Qdrant auf die Anfragen der Suche, jede nach rtt Sekunden"""
+
+    def __init__(self, collection_name, points, rtt):
+        self.collection_name = collection_name
+        self.points = points
+        self.rtt = rtt
+        self.requests = 0
+
+    def _round_trip(self):
+        self.requests += 1
+        time.sleep(self.rtt)
+
+    def get_collections(self):
+        self._round_trip()
+        return SimpleNamespace(collections=[SimpleNamespace(name=self.collection_name)])
+
+    def get_collection(self, collection_name):
+        self._round_trip()
+        return SimpleNamespace(points_count=self.points)
+
+    def scroll(self, collection_name, limit, offset=None, **kwargs):
+        self._round_trip()
+        start = offset or 0
+        end = min(start + limit, self.points)
+        page = [
+            SimpleNamespace(id=i, payload={"document_id": f"doc-{i // 20}", "document_path": f"/doc-{i // 20}.pdf"})
+            for i in range(start, end)
+        ]
+        return page, (end if end < self.points else None)
+
+    def search(self, collection_name, query_vector, limit, **kwargs):
+        self._round_trip()
+        return [
+            SimpleNamespace(id=i, score=0.9 - i * 0.01, payload={"document_id": f"doc-{i}", "text": "Kaution"})
+            for i in range(limit)
+        ]
+
+
+def search_before(service, query, query_vector, top_k):
+    """Altes Verhalten: Dokumentliste, get_collections und get_collection vor jeder Suche"""
+    if not service._scroll_document_registry():
+        return []
+    collections = service.client.get_collections()
+    if service.collection_name not in [collection.name for collection in collections.collections]:
+        return []
+    if service.client.get_collection(service.collection_name).points_count == 0:
+        return []
+    return service._dense_search(query, query_vector, top_k)
+
+
+def search_after(service, query, query_vector, top_k):
+    """Neues Verhalten: gecachte Registry und gecachter Collection-Zustand"""
+    if not service.has_indexed_documents():
+        return []
+    return service.search(query, top_k, query_vector=query_vector, mode="dense", rerank=False)
+
+
+def bench(name, func, service, count):
+    service.client.requests = 0
+    query_vector = [0.1] * 384
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        func(service, "Wie hoch ist die Kaution?", query_vector, 5)
+        timings.append(time.perf_counter() - started)
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(f"{name:<22} mean {statistics.mean(timings_ms):7.3f} ms   median {statistics.median(timings_ms):7.3f} ms   "
+          f"p95 {p95:7.3f} ms   {service.client.requests / count:.1f} Qdrant-Anfragen pro Suche")
+    return statistics.mean(timings_ms)
+
+
+def main(count, rtt_ms, points):
+    service = QdrantService()
+    service.client = StubQdrantClient(service.collection_name, points, rtt_ms / 1000)
+    # Wie nach dem Warm-up: Registry geladen, Collection-Zustand bekannt
+    service.refresh_document_registry()
+    service._set_collection_state(points_count=points)
+
+    pages = (points + SCROLL_PAGE_SIZE - 1) // SCROLL_PAGE_SIZE
+    print(f"{count} Suchen, {rtt_ms} ms Round-Trip pro Qdrant-Anfrage, {points} Punkte ({pages} Scroll-Seiten)")
+    before = bench("Prüfung pro Suche", search_before, service, count)
+    after = bench("Gecachter Zustand", search_after, service, count)
+    print(f"Gesparte Latenz pro Suche: {before - after:.3f} ms ({before / after:.1f}x schneller, ohne Embedding)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--searches", type=int, default=200, help="Anzahl Suchen pro Variante")
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="Simulierte Round-Trip-Zeit pro Qdrant-Anfrage")
+    parser.add_argument("--points", type=int, default=5000, help="Punkte in der Collection")
+    args = parser.parse_args()
+    # Die Services loggen jede Suche auf INFO
+    logging.disable(logging.INFO)
+    main(args.searches, args.rtt_ms, args.points)
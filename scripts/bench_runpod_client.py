@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Vergleicht den Overhead pro RunPod-Aufruf: neuer Client pro Anfrage vs. geteilter Verbindungspool
+
+Startet einen lokalen Stub-Server, der wie RunPods /runsync antwortet, und
+misst die Latenz von N Anfragen in beiden Varianten. Aufruf aus dem
+Projektverzeichnis:
+
+    python scripts/bench_runpod_client.py --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.llm_service import LLMService
+
+STUB_RESPONSE = json.dumps({
+    "id": "stub-job",
+    "status": "COMPLETED",
+    "output": [{"choices": [{"tokens": ["Die Kaution beträgt drei Nettokaltmieten."]}]}]
+}).encode("utf-8")
+
+
+class StubRunPodHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Header und Body werden getrennt geschrieben; ohne TCP_NODELAY misst man Nagles Verzögerung
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(STUB_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(STUB_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRunPodHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+async def bench_fresh_client(url, payload, headers, count):
+    """Altes Verhalten: ein neuer AsyncClient pro Anfrage"""
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            response = await client.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+async def bench_shared_client(llm_service, payload, count):
+    """Neues Verhalten: der Verbindungspool des LLMService"""
+    await llm_service.startup()
+    timings = []
+    try:
+        for _ in range(count):
+            started = time.perf_counter()
+            response = await llm_service._get_client().post(llm_service.api_url, json=payload, headers=llm_service.headers)
+            response.raise_for_status()
+            timings.append(time.perf_counter() - started)
+    finally:
+        await llm_service.aclose()
+    return timings
+
+
+def report(name, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(f"{name:<20} mean {statistics.mean(timings_ms):7.3f} ms   "
+          f"median {statistics.median(timings_ms):7.3f} ms   p95 {p95:7.3f} ms")
+    return statistics.mean(timings_ms)
+
+
+async def main(count):
+    server = start_stub_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v2/stub/runsync"
+
+    llm_service = LLMService()
+    llm_service.api_url = url
+    llm_service.headers = {"Content-Type": "application/json", "Authorization": "stub-key"}
+    payload = {"input": {"prompt": "Wie hoch ist die Kaution?", "max_new_tokens": 16}}
+
+    try:
+        fresh = await bench_fresh_client(url, payload, llm_service.headers, count)
+        shared = await bench_shared_client(llm_service, payload, count)
+    finally:
+        server.shutdown()
+
+    print(f"{count} Anfragen gegen lokalen Stub-Server {url}")
+    fresh_mean = report("Neuer Client", fresh)
+    shared_mean = report("Geteilter Pool", shared)
+    print(f"Gesparter Overhead pro Anfrage: {fresh_mean - shared_mean:.3f} ms "
+          f"(ohne TLS; gegen RunPod kommt der TLS-Handshake hinzu)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="Anzahl Anfragen pro Variante")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 import os
 import sys
-import time
 import logging
 import json
+import argparse
 import requests
 from datetime import datetime
 from pathlib import Path
@@ -24,103 +24,100 @@ logger = logging.getLogger("dropbox_sync")
 # Pfad zu einer Statusdatei, in der der letzte Sync gespeichert wird
 STATUS_FILE = "/opt/immobilien-rag/data/sync_status.json"
 
+# Projektverzeichnis, damit der lokale Modus die App-Services importieren kann
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# "http": über die API des laufenden Servers, "local": direkt mit Dropbox und Qdrant
+SYNC_MODE = os.getenv("SYNC_MODE", "http")
+
 def ensure_dirs_exist():
     """Stelle sicher, dass alle benötigten Verzeichnisse existieren"""
     Path("/opt/immobilien-rag/logs").mkdir(parents=True, exist_ok=True)
     Path("/opt/immobilien-rag/data").mkdir(parents=True, exist_ok=True)
 
+# Dateitypen, die indiziert werden
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.md', '.docx', '.doc')
+
+def empty_status():
+    """Status ohne vorherigen Sync"""
+    return {
+        "last_sync": None,
+        # Dokument-ID -> Dropbox content_hash und rev der indizierten Version
+        "documents": {},
+        "last_full_sync": None,
+        # Dropbox list_folder-Cursor des letzten Syncs
+        "cursor": None,
+        # Dokumente, deren Indizierung fehlgeschlagen ist und beim nächsten Lauf wiederholt wird
+        "pending_documents": [],
+        # Gelöschte Dokumente, deren Entfernung aus dem Index fehlgeschlagen ist; Dropbox meldet
+        # die Löschung nach dem neuen Cursor nicht noch einmal
+        "pending_removals": []
+    }
+
 def load_status():
     """Lade den letzten Sync-Status aus der Statusdatei"""
+    status = empty_status()
     if not os.path.exists(STATUS_FILE):
-        return {
-            "last_sync": None,
-            "indexed_documents": [],
-            "last_full_sync": None
-        }
+        return status
     
     try:
         with open(STATUS_FILE, 'r') as f:
-            return json.load(f)
+            status.update(json.load(f))
     except Exception as e:
         logger.error(f"Fehler beim Laden der Statusdatei: {e}")
-        return {
-            "last_sync": None,
-            "indexed_documents": [],
-            "last_full_sync": None
+        return empty_status()
+    
+    # Ältere Statusdateien enthalten nur die Pfade, teils mit und teils ohne führenden Slash
+    legacy_documents = status.pop("indexed_documents", None)
+    if legacy_documents and not status["documents"]:
+        status["documents"] = {
+            document_id(path): {"content_hash": None, "rev": None} for path in legacy_documents
         }
+    return status
 
 def save_status(status):
-    """Speichere den aktuellen Sync-Status in der Statusdatei"""
+    """Speichere den aktuellen Sync-Status atomar in der Statusdatei"""
     try:
-        with open(STATUS_FILE, 'w') as f:
+        tmp_file = f"{STATUS_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(status, f, indent=2)
+        os.replace(tmp_file, STATUS_FILE)
     except Exception as e:
         logger.error(f"Fehler beim Speichern der Statusdatei: {e}")
 
-def get_all_documents():
-    """Hole eine Liste aller Dokumente aus Dropbox"""
-    logger.info("Hole alle Dokumente aus Dropbox...")
-    
-    documents = []
-    
-    # Hole Authentifizierungs-Token
-    token = get_auth_token()
-    if not token:
-        logger.error("Konnte kein Authentifizierungs-Token erhalten")
-        return documents
-    
-    try:
-        # Rekursive Funktion, um alle Dokumente aus Dropbox zu holen
-        documents = get_documents_recursive("", token, [])
-        logger.info(f"Insgesamt {len(documents)} Dokumente gefunden")
-        return documents
-    except Exception as e:
-        logger.error(f"Fehler beim Holen der Dokumente: {e}")
-        return documents
+def document_id(path):
+    """Dokument-ID im Index zu einem Dropbox-Pfad (ohne führenden Slash)"""
+    return path[1:] if path.startswith('/') else path
+
+def is_supported(path):
+    return path.lower().endswith(SUPPORTED_EXTENSIONS)
 
-def get_documents_recursive(path, token, documents):
-    """Rekursiv alle Dokumente in einem Pfad und seinen Unterordnern holen"""
+def get_changes(cursor, token):
+    """Hole die Änderungen seit dem Cursor aus Dropbox, ohne Cursor alle Dateien
+    
+    Gibt None zurück, wenn die Änderungen nicht abgerufen werden konnten.
+    """
+    logger.info("Hole Änderungen aus Dropbox..." if cursor else "Kein Cursor vorhanden, hole alle Dokumente aus Dropbox...")
     try:
-        logger.info(f"Verarbeite Pfad: {path}")
-        
         response = requests.get(
-            f"http://localhost:8000/api/documents/list?path={path}",
+            "http://localhost:8000/api/documents/changes",
+            params={"cursor": cursor} if cursor else {},
             headers={"Authorization": f"Bearer {token}"}
         )
         
         if response.status_code != 200:
-            logger.error(f"Fehler beim Holen der Dokumente für Pfad {path}: {response.status_code}")
-            return documents
-        
-        path_documents = response.json()
-        logger.info(f"{len(path_documents)} Dokumente/Ordner in Pfad {path} gefunden")
-        
-        for doc in path_documents:
-            if doc['type'] == 'folder':
-                # Rekursiv in Ordner vordringen
-                documents = get_documents_recursive(doc['path'], token, documents)
-            elif doc['type'] == 'file':
-                # Datei zur Liste hinzufügen
-                if doc['path'].lower().endswith(('.pdf', '.txt', '.md', '.docx', '.doc')):
-                    documents.append(doc)
-                    logger.debug(f"Dokument hinzugefügt: {doc['path']}")
-                else:
-                    logger.debug(f"Überspringe nicht unterstützten Dateityp: {doc['path']}")
+            logger.error(f"Fehler beim Holen der Änderungen: {response.status_code}")
+            return None
         
-        return documents
+        return response.json()
     except Exception as e:
-        logger.error(f"Fehler bei get_documents_recursive für Pfad {path}: {e}")
-        return documents
+        logger.error(f"Fehler beim Holen der Änderungen: {e}")
+        return None
 
-def get_indexed_documents():
-    """Hole eine Liste aller indexierten Dokumente"""
+def get_indexed_documents(token):
+    """Hole alle indexierten Dokumente mit content_hash und rev, None bei einem Fehler"""
     logger.info("Hole indexierte Dokumente...")
     
-    token = get_auth_token()
-    if not token:
-        logger.error("Konnte kein Authentifizierungs-Token erhalten")
-        return []
-    
     try:
         response = requests.get(
             "http://localhost:8000/api/documents/check-indexes",
@@ -129,13 +126,16 @@ def get_indexed_documents():
         
         if response.status_code != 200:
             logger.error(f"Fehler beim Holen der indexierten Dokumente: {response.status_code}")
-            return []
+            return None
         
         data = response.json()
-        return data.get("indexes", [])
+        return {
+            doc_id: {"content_hash": info.get("dropbox_content_hash"), "rev": info.get("dropbox_rev")}
+            for doc_id, info in data.get("documents", {}).items()
+        }
     except Exception as e:
         logger.error(f"Fehler beim Holen der indexierten Dokumente: {e}")
-        return []
+        return None
 
 def get_auth_token():
     """Authentifizierung und Token-Erhalt"""
@@ -159,18 +159,23 @@ def get_auth_token():
         logger.error(f"Fehler bei der Authentifizierung: {e}")
         return None
 
-def index_document(doc_path, token):
-    """Indiziere ein einzelnes Dokument"""
+def index_document(doc_path, token, content_hash=None):
+    """Indiziere ein einzelnes Dokument
+    
+    Gibt content_hash und rev der indizierten Version zurück, None bei einem Fehler.
+    Mit content_hash überspringt der Server Dokumente, die in dieser Version
+    bereits indiziert sind.
+    """
     try:
         # Entferne führenden Slash falls vorhanden
-        if doc_path.startswith('/'):
-            doc_path = doc_path[1:]
+        doc_path = document_id(doc_path)
             
         logger.info(f"Indiziere Dokument: {doc_path}")
         
         # Realer API-Aufruf
         response = requests.post(
             f"http://localhost:8000/api/documents/index/{doc_path}",
+            params={"content_hash": content_hash} if content_hash else {},
             headers={
                 "Authorization": f"Bearer {token}",
                 "Content-Type": "application/json"
@@ -187,68 +192,245 @@ def index_document(doc_path, token):
                 logger.error(f"Fehlerdetails: {error_details}")
             except:
                 logger.error(f"Antworttext: {response.text}")
-            return False
+            return None
         
-        logger.info(f"Dokument erfolgreich indiziert: {doc_path}")
-        return True
+        data = response.json()
+        if data.get("skipped"):
+            logger.info(f"Dokument unverändert, übersprungen: {doc_path}")
+        else:
+            logger.info(f"Dokument erfolgreich indiziert: {doc_path}")
+        return {"content_hash": data.get("dropbox_content_hash"), "rev": data.get("dropbox_rev")}
     except Exception as e:
         logger.error(f"Exception beim Indizieren von {doc_path}: {e}")
+        return None
+
+def remove_document(doc_id, token):
+    """Entferne ein Dokument aus dem Index"""
+    try:
+        logger.info(f"Entferne Dokument aus dem Index: {doc_id}")
+        response = requests.delete(
+            f"http://localhost:8000/api/documents/index/{doc_id}",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"Fehler beim Entfernen von {doc_id}: {response.status_code}")
+            return False
+        return True
+    except Exception as e:
+        logger.error(f"Exception beim Entfernen von {doc_id}: {e}")
         return False
 
-def perform_sync():
-    """Führe eine vollständige Synchronisierung durch"""
+def deleted_document_ids(deleted_paths, indexed_ids):
+    """Indexierte Dokumente, die gelöscht wurden, auch als Teil eines gelöschten Ordners"""
+    deleted = {document_id(path).lower() for path in deleted_paths}
+    removed = []
+    for doc_id in indexed_ids:
+        lower = doc_id.lower()
+        # Dropbox meldet bei einem gelöschten Ordner nur den Ordner selbst
+        if lower in deleted or any(lower.startswith(f"{path}/") for path in deleted):
+            removed.append(doc_id)
+    return removed
+
+class HttpBackend:
+    """Synchronisiert über die API des laufenden Servers"""
+    
+    def __init__(self):
+        # Ein Token für den ganzen Lauf
+        self.token = get_auth_token()
+        if not self.token:
+            raise RuntimeError("Konnte kein Authentifizierungs-Token erhalten")
+    
+    def get_changes(self, cursor):
+        return get_changes(cursor, self.token)
+    
+    def get_indexed_documents(self):
+        return get_indexed_documents(self.token)
+    
+    def index_documents(self, docs):
+        """Indiziere (Dokument-ID, content_hash)-Paare nacheinander, gibt ID -> Version oder None zurück"""
+        return {doc_id: index_document(doc_id, self.token, content_hash) for doc_id, content_hash in docs}
+    
+    def remove_document(self, doc_id):
+        return remove_document(doc_id, self.token)
+    
+    def close(self):
+        pass
+
+class LocalBackend:
+    """Synchronisiert im eigenen Prozess mit DropboxService und QdrantService
+    
+    Kein HTTP, keine Authentifizierung und kein zweiter Download durch den
+    Server; läuft auch, wenn der Webserver nicht läuft. Die Dokumente werden
+    mit der IndexingPipeline parallel geladen, extrahiert, eingebettet und
+    gespeichert. Der BM25-Index wird in dieselbe Datei geschrieben wie vom
+    Server; beide sperren die Datei beim Speichern und übernehmen die Dokumente
+    des anderen Prozesses. Ein laufender Server sieht die Änderungen erst bei
+    der nächsten Suche, dann werden auch seine Registry und die gecachten
+    Antworten zu den geänderten Dokumenten verworfen.
+    """
+    
+    def __init__(self):
+        if PROJECT_DIR not in sys.path:
+            sys.path.insert(0, PROJECT_DIR)
+        # Erst hier importiert, der HTTP-Modus braucht weder Modell noch Dropbox-SDK
+        from app.services.dropbox_service import DropboxService
+        from app.services.qdrant_service import QdrantService
+        from app.services.indexing_pipeline import IndexingPipeline
+        
+        self.dropbox = DropboxService()
+        # Bricht mit RuntimeError ab, wenn der Dropbox-Token ungültig ist
+        self.dropbox.warm_up()
+        self.qdrant = QdrantService()
+        self.qdrant.warm_up()
+        self.pipeline = IndexingPipeline(self.dropbox, self.qdrant)
+    
+    def get_changes(self, cursor):
+        try:
+            return self.dropbox.list_changes(cursor)
+        except Exception as e:
+            logger.error(f"Fehler beim Holen der Änderungen: {e}")
+            return None
+    
+    def get_indexed_documents(self):
+        return {
+            doc_id: {"content_hash": entry.get("dropbox_content_hash"), "rev": entry.get("dropbox_rev")}
+            for doc_id, entry in self.qdrant.get_document_registry().items()
+        }
+    
+    def index_documents(self, docs):
+        """Indiziere (Dokument-ID, content_hash)-Paare parallel, gibt ID -> Version oder None zurück"""
+        results = self.pipeline.run(docs)
+        return {
+            doc_id: {"content_hash": result["content_hash"], "rev": result["rev"]} if result["success"] else None
+            for doc_id, result in results.items()
+        }
+    
+    def remove_document(self, doc_id):
+        try:
+            logger.info(f"Entferne Dokument aus dem Index: {doc_id}")
+            self.qdrant.delete_document(doc_id)
+            return True
+        except Exception as e:
+            logger.error(f"Exception beim Entfernen von {doc_id}: {e}")
+            return False
+    
+    def close(self):
+        # Ausstehende Änderungen am BM25-Index schreiben
+        self.qdrant.close()
+
+BACKENDS = {"http": HttpBackend, "local": LocalBackend}
+
+def perform_sync(backend, full=False):
+    """Führe eine Synchronisierung durch
+    
+    Mit gespeichertem Cursor werden nur die seit dem letzten Lauf geänderten
+    und gelöschten Einträge von Dropbox geholt; ohne Änderungen kostet das
+    einen einzigen Dropbox-Aufruf. Ohne Cursor, oder wenn Dropbox den Cursor
+    zurückgesetzt hat, wird der komplette Bestand mit dem Index abgeglichen.
+    In beiden Fällen werden nur Dateien neu indiziert, deren Dropbox
+    content_hash sich gegenüber der indizierten Version geändert hat.
+    Mit full=True wird der gespeicherte Cursor ignoriert.
+    """
     logger.info("Starte Synchronisierung...")
     
     # Lade aktuellen Status
     status = load_status()
     
-    # Hole Authentifizierungs-Token
-    token = get_auth_token()
-    if not token:
-        logger.error("Konnte kein Authentifizierungs-Token erhalten, breche ab")
+    changes = backend.get_changes(None if full else status.get("cursor"))
+    if changes is None:
         return False
     
-    # Hole alle Dokumente aus Dropbox
-    all_documents = get_all_documents()
-    dropbox_paths = [doc["path"] for doc in all_documents]
-    logger.info(f"{len(dropbox_paths)} Dokumente in Dropbox gefunden")
+    # Dokument-ID -> content_hash der aktuellen Dropbox-Version
+    changed = {
+        document_id(doc["path"]): doc.get("content_hash")
+        for doc in changes["files"] if is_supported(doc["path"])
+    }
     
-    # Hole alle indexierten Dokumente
-    indexed_docs = get_indexed_documents()
-    logger.info(f"{len(indexed_docs)} Dokumente im Index gefunden")
+    if changes["reset"]:
+        # Vollständiger Abgleich: der Index ist die Referenz, nicht die Statusdatei
+        indexed_docs = backend.get_indexed_documents()
+        if indexed_docs is None:
+            return False
+        docs_to_remove = sorted(set(indexed_docs) - set(changed))
+        pending = []
+        logger.info(f"{len(changed)} Dokumente in Dropbox, {len(indexed_docs)} Dokumente im Index gefunden")
+    else:
+        # Delta: geänderte Dateien prüfen, gelöschte entfernen
+        indexed_docs = status["documents"]
+        docs_to_remove = []
+        if changes["deleted"]:
+            indexed = backend.get_indexed_documents()
+            if indexed is None:
+                return False
+            docs_to_remove = deleted_document_ids(changes["deleted"], indexed)
+        # Fehlgeschlagene Entfernungen wiederholen, außer die Datei ist wieder da
+        docs_to_remove = [
+            doc_id for doc_id in dict.fromkeys(status.get("pending_removals", []) + docs_to_remove)
+            if doc_id not in changed
+        ]
+        pending = status.get("pending_documents", [])
+        deleted_pending = set(deleted_document_ids(changes["deleted"], pending))
+        pending = [doc_id for doc_id in pending if doc_id not in deleted_pending and doc_id not in changed]
     
-    # Identifiziere neue und gelöschte Dokumente
-    docs_to_index = [path for path in dropbox_paths if path not in indexed_docs]
-    docs_to_remove = [path for path in indexed_docs if path not in dropbox_paths]
+    # Neu indizieren, wenn der Hash abweicht; ohne bekannten Hash (alter Index) einmal neu indizieren
+    docs_to_index = [(doc_id, None) for doc_id in pending] + [
+        (doc_id, content_hash) for doc_id, content_hash in changed.items()
+        if not content_hash or indexed_docs.get(doc_id, {}).get("content_hash") != content_hash
+    ]
+    unchanged = len(changed) - (len(docs_to_index) - len(pending))
     
-    logger.info(f"{len(docs_to_index)} neue Dokumente zu indizieren")
+    logger.info(f"{len(docs_to_index)} Dokumente zu indizieren, {unchanged} unverändert")
     logger.info(f"{len(docs_to_remove)} Dokumente zu entfernen")
     
-    # Indiziere neue Dokumente
-    newly_indexed = []
-    for doc_path in docs_to_index:
-        doc_details = next((doc for doc in all_documents if doc["path"] == doc_path), None)
-        if doc_details:
-            success = index_document(doc_path, token)
-            if success:
-                newly_indexed.append(doc_path)
-                # Ein kurze Pause, um den Server nicht zu überlasten
-                time.sleep(1)
+    documents = {doc_id: dict(info) for doc_id, info in indexed_docs.items()}
+    removed, failed_removals = 0, []
+    for doc_id in docs_to_remove:
+        if backend.remove_document(doc_id):
+            documents.pop(doc_id, None)
+            removed += 1
+        else:
+            failed_removals.append(doc_id)
+    
+    indexed, failed = 0, []
+    versions = backend.index_documents(docs_to_index)
+    for doc_id, _ in docs_to_index:
+        version = versions.get(doc_id)
+        if version:
+            documents[doc_id] = version
+            indexed += 1
+        else:
+            failed.append(doc_id)
     
-    # Aktualisiere Status
-    status["last_sync"] = datetime.now().isoformat()
-    status["indexed_documents"] = indexed_docs + newly_indexed
-    status["last_full_sync"] = datetime.now().isoformat()
+    # Aktualisiere Status; fehlgeschlagene Indizierungen und Entfernungen werden beim nächsten Lauf wiederholt
+    now = datetime.now().isoformat()
+    status["cursor"] = changes["cursor"]
+    status["pending_documents"] = failed
+    status["pending_removals"] = failed_removals
+    status["documents"] = dict(sorted(documents.items()))
+    status["last_sync"] = now
+    if changes["reset"]:
+        status["last_full_sync"] = now
     save_status(status)
     
-    logger.info(f"Synchronisierung abgeschlossen. {len(newly_indexed)} Dokumente indiziert.")
+    logger.info(f"Synchronisierung abgeschlossen. {indexed} Dokumente indiziert, {unchanged} unverändert, "
+                f"{removed} entfernt, {len(failed) + len(failed_removals)} fehlgeschlagen.")
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synchronisiert Dropbox-Dokumente mit dem Index")
+    parser.add_argument("--mode", choices=sorted(BACKENDS), default=SYNC_MODE,
+                        help="http: über die API des Servers, local: direkt im eigenen Prozess")
+    parser.add_argument("--full", action="store_true",
+                        help="Gespeicherten Cursor ignorieren und den kompletten Bestand abgleichen")
+    args = parser.parse_args()
+    
+    backend = None
     try:
         ensure_dirs_exist()
-        logger.info("Starte Dropbox Synchronisierung...")
-        success = perform_sync()
+        logger.info(f"Starte Dropbox Synchronisierung (Modus: {args.mode})...")
+        backend = BACKENDS[args.mode]()
+        success = perform_sync(backend, full=args.full)
         if success:
             logger.info("Dropbox Synchronisierung erfolgreich abgeschlossen.")
             sys.exit(0)
@@ -258,3 +440,6 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error(f"Unerwarteter Fehler bei der Synchronisierung: {e}")
         sys.exit(1)
+    finally:
+        if backend is not None:
+            backend.close()
@@ -12,8 +12,9 @@ cd /opt/immobilien-rag
 # Virtuelle Umgebung aktivieren
 source venv/bin/activate
 
-# Führe das Synchronisierungsskript aus
-python /opt/immobilien-rag/scripts/dropbox_sync.py
+# Führe das Synchronisierungsskript aus; lokal statt über HTTP, damit die Dokumente
+# parallel indiziert werden und nicht einzeln nacheinander an den Server gehen
+python /opt/immobilien-rag/scripts/dropbox_sync.py --mode local --full "$@"
 
 # Zeige die letzten 20 Zeilen des Logs an
 echo ""
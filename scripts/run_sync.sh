@@ -1,4 +1,4 @@
 #!/bin/bash
 cd /opt/immobilien-rag
 source venv/bin/activate
-python /opt/immobilien-rag/scripts/dropbox_sync.py
+python /opt/immobilien-rag/scripts/dropbox_sync.py "$@"